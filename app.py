@@ -1,166 +1,65 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, send_file, abort, stream_with_context
+import base64
+import json
 import os
 import secrets
-import threading
-import time
 import traceback
-import uuid
 from datetime import datetime
-from werkzeug.utils import secure_filename
-from services.gemini_service import suggest_hashtags, add_tags_to_content
-from services.publisher_service import publish_to_both
+from services.gemini_service import suggest_hashtags, add_tags_to_content, add_tags_to_contents, GEMINI_BATCH_MAX_ITEMS
+from services.publisher_service import start_zhihu_pool
+from services.image_service import get_variant
+from services import cache_store
+from sqlalchemy import func, tuple_
 from dotenv import load_dotenv
-from models import db, PostHistory
-from PIL import Image
-import io
+from models import db, PostHistory, PostPlatformResult, migrate_post_history, upgrade_schema
+import db_config
+import history_ops
+import history_search
+import job_queue
+import uploads
+import multiprocessing
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY') or secrets.token_hex(32)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///posts.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# 数据库地址和 SQLite 连接参数（WAL、busy_timeout 等）见 db_config
+db_config.configure(app)
+# 旧的一次性 multipart 上传最多 9 张图，超过的请求体在读取前就被拒绝
+app.config['MAX_CONTENT_LENGTH'] = 9 * uploads.MAX_FILE_SIZE
 
 db.init_app(app)
 
 with app.app_context():
     db.create_all()
+    upgrade_schema()
+    migrate_post_history()
+    history_search.init_fts()
 
 INITIAL_IMAGES = []
-PUBLISH_JOBS = {}
-PUBLISH_LOCK = threading.Lock()
-JOB_MAX_AGE = 600  # 已完成的 job 保留10分钟
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
-
-# 用于取消发布的事件
-CANCEL_EVENTS = {}
-CANCEL_EVENTS_LOCK = threading.Lock()
-
-def _now_label():
-    return time.strftime('%H:%M:%S')
-
-def _job_append(job_id, message):
-    with PUBLISH_LOCK:
-        job = PUBLISH_JOBS.get(job_id)
-        if not job:
-            return
-        job['steps'].append({'time': _now_label(), 'message': message})
-
-def _job_update(job_id, **fields):
-    with PUBLISH_LOCK:
-        job = PUBLISH_JOBS.get(job_id)
-        if not job:
-            return
-        job.update(fields)
-        if fields.get('status') in ('done', 'error'):
-            job['finished_at'] = time.time()
-
-def _cleanup_jobs():
-    """清理过期的已完成 job"""
-    now = time.time()
-    with PUBLISH_LOCK:
-        expired = [
-            jid for jid, j in PUBLISH_JOBS.items()
-            if j.get('finished_at') and now - j['finished_at'] > JOB_MAX_AGE
-        ]
-        for jid in expired:
-            del PUBLISH_JOBS[jid]
-
-def _run_publish_job(job_id, content, platforms, image_paths):
-    def progress(message):
-        # 检查是否已取消
-        with CANCEL_EVENTS_LOCK:
-            cancel_event = CANCEL_EVENTS.get(job_id)
-        if cancel_event and cancel_event.is_set():
-            return
-        _job_append(job_id, message)
-
-    # 创建取消事件
-    cancel_event = threading.Event()
-    with CANCEL_EVENTS_LOCK:
-        CANCEL_EVENTS[job_id] = cancel_event
+UPLOAD_DIR = uploads.UPLOAD_DIR
+HISTORY_MAX_PER_PAGE = 100
+# 历史总数缓存时间（秒），删除记录时立即失效
+HISTORY_TOTAL_TTL = 60
 
-    try:
-        progress('开始发布任务')
-        
-        # 检查是否已取消
-        if cancel_event.is_set():
-            _job_update(
-                job_id,
-                status='cancelled',
-                success=False,
-                message='发布已被用户取消'
-            )
-            return
-            
-        abs_paths = []
-        image_urls = []
-        for p in image_paths or []:
-            if not p:
-                continue
-            clean = p.replace('\\', '/').lstrip('/')
-            abs_paths.append(os.path.join(app.root_path, clean))
-            if clean.startswith('static/'):
-                image_urls.append('/' + clean)
-        
-        results = publish_to_both(content, platforms, image_paths=abs_paths, progress=progress, cancel_event=cancel_event)
-        
-        # 检查是否被取消
-        if cancel_event.is_set():
-            _job_update(
-                job_id,
-                status='cancelled',
-                success=False,
-                message='发布已被用户取消'
-            )
-            return
-            
-        success = results['twitter'] or results['zhihu']
-        message = ' | '.join(results['messages'])
-
-        with app.app_context():
-            history = PostHistory(
-                content=content,
-                platforms=','.join(platforms),
-                twitter_success=results['twitter'],
-                zhihu_success=results['zhihu'],
-                image_paths=','.join(image_urls)
-            )
-            db.session.add(history)
-            db.session.commit()
-
-        _job_update(
-            job_id,
-            status='done',
-            success=success,
-            message=message,
-            results=results
-        )
-    except Exception as e:
-        if cancel_event.is_set():
-            _job_update(
-                job_id,
-                status='cancelled',
-                success=False,
-                message='发布已被用户取消'
-            )
-        else:
-            traceback.print_exc()
-            _job_update(
-                job_id,
-                status='error',
-                success=False,
-                message=f'发布失败: {str(e)}'
-            )
-    finally:
-        # 清理取消事件
-        with CANCEL_EVENTS_LOCK:
-            if job_id in CANCEL_EVENTS:
-                del CANCEL_EVENTS[job_id]
+uploads.init_app(app)
+
+# 图片处理子进程（spawn 模式）会重新导入本模块，后台线程只在主进程中启动
+if multiprocessing.parent_process() is None:
+    # 启动时预热知乎浏览器（默认在第一次发布时启动，之后常驻）
+    prewarm_zhihu = os.getenv('ZHIHU_PREWARM', '0') == '1'
+    if prewarm_zhihu and job_queue.JOB_EXECUTION_MODE != 'async':
+        start_zhihu_pool()
+
+    # 发布任务持久化在数据库中，由 job_queue 的 worker 线程（或 async 模式的事件循环）执行
+    job_queue.start(app, prewarm_zhihu=prewarm_zhihu)
+    # 定期清理没有被引用的上传图片
+    uploads.start_maintenance()
 
 @app.route('/')
 def index():
-    return render_template('index.html', images=INITIAL_IMAGES, active_page='publish')
+    return render_template('index.html', images=INITIAL_IMAGES, active_page='publish',
+                           refine_batch_max_items=GEMINI_BATCH_MAX_ITEMS)
 
 @app.route('/api/suggest-hashtags', methods=['POST'])
 def api_suggest_hashtags():
@@ -189,6 +88,35 @@ def api_refine():
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'服务器错误: {str(e)}'})
 
+@app.route('/api/refine/batch', methods=['POST'])
+def api_refine_batch():
+    """批量添加标签，items: [{id, content}]，按原顺序返回每条的结果"""
+    try:
+        data = request.get_json() or {}
+        items = data.get('items') or []
+
+        if not isinstance(items, list) or not items:
+            return jsonify({'success': False, 'message': '内容不能为空'})
+        if len(items) > GEMINI_BATCH_MAX_ITEMS:
+            return jsonify({'success': False, 'message': f'一次最多处理 {GEMINI_BATCH_MAX_ITEMS} 条'})
+
+        contents = [str((item or {}).get('content') or '') for item in items]
+        refined = add_tags_to_contents(contents)
+
+        results = []
+        for item, content, (new_content, tags) in zip(items, contents, refined):
+            results.append({
+                'id': (item or {}).get('id'),
+                'success': bool(content.strip()),
+                'content': new_content,
+                'hashtags': tags
+            })
+        return jsonify({'success': True, 'results': results})
+    except Exception as e:
+        print(f"API refine batch 错误: {e}")
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'服务器错误: {str(e)}'})
+
 @app.route('/api/publish', methods=['POST'])
 def api_publish():
     data = request.get_json()
@@ -199,44 +127,63 @@ def api_publish():
     if not content:
         return jsonify({'success': False, 'message': '内容不能为空'})
     
-    job_id = uuid.uuid4().hex
-    with PUBLISH_LOCK:
-        PUBLISH_JOBS[job_id] = {
-            'status': 'running',
-            'success': False,
-            'message': '',
-            'steps': [{'time': _now_label(), 'message': '任务已创建，准备开始'}]
-        }
-
-    thread = threading.Thread(
-        target=_run_publish_job,
-        args=(job_id, content, platforms, image_paths),
-        daemon=True
-    )
-    thread.start()
-
+    job_id = job_queue.enqueue_job(content, platforms, image_paths)
     return jsonify({'success': True, 'job_id': job_id})
 
-def resize_image_if_needed(image_path, max_size=1080):
-    """Resize image if any dimension exceeds max_size"""
+@app.route('/api/publish/bulk', methods=['POST'])
+def api_publish_bulk():
+    """
+    批量发布。posts: [{content, image_paths, platforms}]，platforms 不填时使用外层的 platforms；
+    spacing: 相邻两条开始发布的间隔（秒），concurrency: 同时发布的条数
+    """
+    data = request.get_json() or {}
+    posts = data.get('posts') or []
+    default_platforms = data.get('platforms', ['twitter', 'zhihu'])
+
+    if not isinstance(posts, list) or not posts:
+        return jsonify({'success': False, 'message': '内容不能为空'})
+    if len(posts) > job_queue.BULK_MAX_ITEMS:
+        return jsonify({'success': False, 'message': f'一次最多提交 {job_queue.BULK_MAX_ITEMS} 条'})
+
     try:
-        with Image.open(image_path) as img:
-            width, height = img.size
-            if width > max_size or height > max_size:
-                ratio = min(max_size / width, max_size / height)
-                new_width = int(width * ratio)
-                new_height = int(height * ratio)
-                resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                if img.mode in ('RGBA', 'P'):
-                    resized = resized.convert('RGB')
-                resized.save(image_path, quality=90, optimize=True)
-                return True
-    except Exception as e:
-        print(f"Resize error: {e}")
-    return False
+        spacing = max(0.0, float(data.get('spacing', job_queue.BULK_DEFAULT_SPACING)))
+        concurrency = max(1, int(data.get('concurrency', job_queue.BULK_DEFAULT_CONCURRENCY)))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'spacing 或 concurrency 格式错误'})
+
+    items = []
+    empty = []
+    for index, post in enumerate(posts):
+        post = post if isinstance(post, dict) else {'content': post}
+        content = str(post.get('content') or '')
+        if not content.strip():
+            empty.append(index + 1)
+            continue
+        items.append((content, post.get('platforms') or default_platforms, post.get('image_paths') or []))
+    if empty:
+        return jsonify({'success': False, 'message': f'第 {", ".join(map(str, empty))} 条内容为空'})
+
+    batch_id, job_ids = job_queue.enqueue_batch(items, spacing=spacing, concurrency=concurrency)
+    return jsonify({'success': True, 'batch_id': batch_id, 'job_ids': job_ids, 'total': len(job_ids)})
+
+@app.route('/api/publish/batch/<batch_id>')
+def api_publish_batch(batch_id):
+    """批量发布的汇总进度"""
+    batch = job_queue.get_batch(batch_id)
+    if not batch:
+        return jsonify({'success': False, 'message': '批量任务不存在'})
+    return jsonify({'success': True, 'batch': batch})
+
+@app.route('/api/publish/batch/<batch_id>/cancel', methods=['POST'])
+def api_cancel_publish_batch(batch_id):
+    """取消批量中所有未完成的任务"""
+    count = job_queue.cancel_batch(batch_id)
+    if count is None:
+        return jsonify({'success': False, 'message': '批量任务不存在'})
+    return jsonify({'success': True, 'message': f'正在取消 {count} 条任务'})
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp'}
-MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
+MAX_FILE_SIZE = uploads.MAX_FILE_SIZE
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -248,7 +195,6 @@ def api_upload():
         if not files:
             return jsonify({'success': False, 'message': '未找到图片文件'})
 
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
         results = []
         errors = []
 
@@ -268,22 +214,13 @@ def api_upload():
                 errors.append(f'{f.filename}: 文件大小超过20MB限制')
                 continue
                 
-            safe_name = secure_filename(f.filename)
-            if not safe_name:
-                continue
-            file_id = uuid.uuid4().hex
-            filename = f'{file_id}_{safe_name}'
-            save_path = os.path.join(UPLOAD_DIR, filename)
-            f.save(save_path)
-            resize_image_if_needed(save_path, max_size=2048)
-            rel_path = os.path.join('static', 'uploads', filename)
-            url = '/' + rel_path.replace('\\', '/')
-            results.append({
-                'id': file_id,
-                'url': url,
-                'path': rel_path.replace('\\', '/')
-            })
-            print(f"图片上传成功: {filename}, URL: {url}")
+            ext = f.filename.rsplit('.', 1)[1].lower()
+            # 按内容哈希存储，重复上传同一张图片时直接复用，不再保存和缩放
+            image, is_new = uploads.store_upload(f.stream, ext)
+            data = image.to_dict()
+            data['deduplicated'] = not is_new
+            results.append(data)
+            print(f"图片上传成功: {image.path}{'' if is_new else ' (已存在，复用)'}")
 
         if not results:
             return jsonify({'success': False, 'message': '图片上传失败', 'errors': errors})
@@ -294,29 +231,103 @@ def api_upload():
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'上传失败: {str(e)}'})
 
+@app.route('/api/upload/init', methods=['POST'])
+def api_upload_init():
+    """分片上传第一步：声明文件名和大小，超过限制直接拒绝"""
+    data = request.get_json() or {}
+    filename = data.get('filename', '')
+    if not allowed_file(filename):
+        return jsonify({'success': False, 'message': f'{filename}: 不支持的文件格式'})
+    try:
+        size = int(data.get('size', 0))
+        session = uploads.init_chunked(filename.rsplit('.', 1)[1].lower(), size)
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': f'{filename}: {e}'})
+    return jsonify({'success': True, **session})
+
+@app.route('/api/upload/<upload_id>/chunk/<int:index>', methods=['PUT'])
+def api_upload_chunk(upload_id, index):
+    """分片上传第二步：请求体就是分片的原始字节，直接写入磁盘"""
+    try:
+        result = uploads.write_chunk(upload_id, index, request.stream, request.content_length)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    return jsonify({'success': True, **result})
+
+@app.route('/api/upload/<upload_id>', methods=['GET'])
+def api_upload_session(upload_id):
+    """查询已收到的分片，用于断点续传"""
+    try:
+        return jsonify({'success': True, **uploads.chunked_status(upload_id)})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/upload/<upload_id>/finalize', methods=['POST'])
+def api_upload_finalize(upload_id):
+    """分片上传第三步：校验分片、计算哈希并开始后台处理"""
+    try:
+        image, is_new = uploads.finalize_chunked(upload_id)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'上传失败: {str(e)}'})
+    data = image.to_dict()
+    data['deduplicated'] = not is_new
+    return jsonify({'success': True, 'image': data})
+
+@app.route('/api/upload/status')
+def api_upload_status():
+    """查询图片的后台处理状态：processing / ready / error"""
+    ids = [i for i in request.args.get('ids', '').split(',') if i]
+    if not ids:
+        return jsonify({'success': False, 'message': '未提供图片ID'})
+    return jsonify({'success': True, 'images': uploads.get_statuses(ids)})
+
+@app.route('/api/image/thumb')
+def api_image_thumb():
+    """历史记录用的缩略图，首次访问时生成并缓存"""
+    rel_path = request.args.get('path', '').replace('\\', '/').lstrip('/')
+    abs_path = os.path.realpath(os.path.join(app.root_path, rel_path))
+    if not abs_path.startswith(os.path.realpath(UPLOAD_DIR) + os.sep) or not os.path.isfile(abs_path):
+        abort(404)
+    try:
+        thumb = get_variant(abs_path, 'thumb')
+    except Exception as e:
+        print(f"缩略图生成失败: {e}")
+        return send_file(abs_path, max_age=3600)
+    return send_file(thumb, max_age=7 * 24 * 3600)
+
 @app.route('/api/publish/status/<job_id>')
 def api_publish_status(job_id):
-    _cleanup_jobs()
-    with PUBLISH_LOCK:
-        job = PUBLISH_JOBS.get(job_id)
-        if not job:
-            return jsonify({'success': False, 'message': '任务不存在'})
-        return jsonify({'success': True, 'job': job})
+    job = job_queue.get_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '任务不存在'})
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/publish/stream/<job_id>')
+def api_publish_stream(job_id):
+    """以 Server-Sent Events 推送发布进度，支持 Last-Event-ID 续传"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or '0'
+    try:
+        last_step_id = int(last_event_id)
+    except ValueError:
+        last_step_id = 0
+
+    return Response(
+        job_queue.stream_job(job_id, last_step_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/api/publish/cancel/<job_id>', methods=['POST'])
 def api_cancel_publish(job_id):
     """取消正在进行的发布任务"""
-    with CANCEL_EVENTS_LOCK:
-        cancel_event = CANCEL_EVENTS.get(job_id)
-        if cancel_event:
-            cancel_event.set()
-            return jsonify({'success': True, 'message': '正在取消发布...'})
-    
-    with PUBLISH_LOCK:
-        job = PUBLISH_JOBS.get(job_id)
-        if job and job['status'] in ('done', 'error', 'cancelled'):
-            return jsonify({'success': False, 'message': '任务已完成或已取消'})
-    
+    state = job_queue.request_cancel(job_id)
+    if state in ('cancelling', 'cancelled'):
+        return jsonify({'success': True, 'message': '正在取消发布...'})
+    if state == 'finished':
+        return jsonify({'success': False, 'message': '任务已完成或已取消'})
     return jsonify({'success': False, 'message': '任务不存在或已结束'})
 
 @app.route('/history')
@@ -325,39 +336,116 @@ def history_page():
 
 @app.route('/api/history')
 def api_history():
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 20, type=int)
-    
-    posts = PostHistory.query.order_by(PostHistory.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
+    """
+    按 (created_at, id) 倒序的游标分页：传入上一页返回的 next_cursor 取下一页，
+    查询直接走复合索引，翻到多深都不需要 OFFSET。include_total=1 时附带（缓存的）总数
+    """
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), HISTORY_MAX_PER_PAGE)
+    cursor = request.args.get('cursor')
+
+    query = PostHistory.query
+    if cursor:
+        try:
+            created_at, post_id = _decode_cursor(cursor)
+        except (ValueError, TypeError):
+            return jsonify({'success': False, 'message': '无效的分页游标'}), 400
+        query = query.filter(tuple_(PostHistory.created_at, PostHistory.id) < (created_at, post_id))
+    posts = (
+        query.order_by(PostHistory.created_at.desc(), PostHistory.id.desc())
+        .limit(per_page + 1)
+        .all()
     )
-    
-    return jsonify({
-        'posts': [post.to_dict() for post in posts.items],
-        'total': posts.total,
-        'pages': posts.pages,
-        'current_page': page
-    })
+    has_more = len(posts) > per_page
+    posts = posts[:per_page]
+
+    data = {
+        'posts': [post.to_dict() for post in posts],
+        'has_more': has_more,
+        'next_cursor': _encode_cursor(posts[-1]) if has_more else None
+    }
+    if request.args.get('include_total') == '1':
+        data['total'] = _history_total()
+    return jsonify(data)
+
+@app.route('/api/history/search')
+def api_history_search():
+    """
+    全文搜索发布历史。q: 关键词（空格分隔，全部命中）；platform: twitter / zhihu；
+    success: 1 / 0；has_images: 1 / 0；from、to: YYYY-MM-DD；limit、offset 分页
+    """
+    success = request.args.get('success')
+    has_images = request.args.get('has_images')
+    try:
+        posts, has_more = history_search.search(
+            request.args.get('q', ''),
+            platform=request.args.get('platform') or None,
+            success=None if success in (None, '') else success == '1',
+            has_images=None if has_images in (None, '') else has_images == '1',
+            date_from=request.args.get('from') or None,
+            date_to=request.args.get('to') or None,
+            limit=request.args.get('limit', 20, type=int),
+            offset=request.args.get('offset', 0, type=int)
+        )
+    except ValueError:
+        return jsonify({'success': False, 'message': '日期格式应为 YYYY-MM-DD'}), 400
+    return jsonify({'success': True, 'posts': posts, 'has_more': has_more})
+
+@app.route('/api/history/stats')
+def api_history_stats():
+    """各平台的发布数、成功数和平均耗时"""
+    rows = db.session.query(
+        PostPlatformResult.platform,
+        PostPlatformResult.status,
+        func.count(PostPlatformResult.id),
+        func.avg(PostPlatformResult.latency_ms)
+    ).group_by(PostPlatformResult.platform, PostPlatformResult.status).all()
+
+    stats = {}
+    for platform, status, count, avg_latency in rows:
+        item = stats.setdefault(platform, {'total': 0, 'success': 0, 'failed': 0, 'avg_latency_ms': None})
+        item['total'] += count
+        item[status] = item.get(status, 0) + count
+        if status == 'success' and avg_latency is not None:
+            item['avg_latency_ms'] = round(avg_latency)
+    return jsonify({'success': True, 'stats': stats})
+
+def _encode_cursor(post):
+    raw = json.dumps([post.created_at.isoformat(), post.id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    created_at, post_id = json.loads(raw)
+    return datetime.fromisoformat(created_at), int(post_id)
+
+def _history_total():
+    total = cache_store.get_value('history', 'total')
+    if total is None:
+        total = db.session.query(func.count(PostHistory.id)).scalar()
+        cache_store.set_value('history', 'total', total, HISTORY_TOTAL_TTL)
+    return total
+
+def _invalidate_history_total():
+    cache_store.delete_value('history', 'total')
 
 @app.route('/api/history/<int:post_id>', methods=['DELETE'])
 def api_delete_history(post_id):
-    post = PostHistory.query.get(post_id)
-    if not post:
+    if not history_ops.delete_posts([post_id]):
         return jsonify({'success': False, 'message': '记录不存在'})
-    
-    db.session.delete(post)
-    db.session.commit()
+    _invalidate_history_total()
     return jsonify({'success': True, 'message': '删除成功'})
 
 @app.route('/api/history/clear', methods=['POST'])
 def api_clear_history():
+    """分批删除全部历史，每批一个短事务，删除过程中发布和查询不会被长时间阻塞"""
     try:
-        PostHistory.query.delete()
-        db.session.commit()
-        return jsonify({'success': True, 'message': '清空成功'})
+        deleted = history_ops.clear_posts()
+        return jsonify({'success': True, 'message': f'清空成功，共删除 {deleted} 条记录'})
     except Exception as e:
-        db.session.rollback()
+        traceback.print_exc()
         return jsonify({'success': False, 'message': str(e)})
+    finally:
+        _invalidate_history_total()
 
 @app.route('/api/history/batch-delete', methods=['POST'])
 def api_batch_delete_history():
@@ -368,12 +456,49 @@ def api_batch_delete_history():
         return jsonify({'success': False, 'message': '未提供要删除的ID'})
     
     try:
-        PostHistory.query.filter(PostHistory.id.in_(ids)).delete(synchronize_session=False)
-        db.session.commit()
-        return jsonify({'success': True, 'message': f'成功删除 {len(ids)} 条记录'})
+        deleted = history_ops.delete_posts(ids)
+        return jsonify({'success': True, 'message': f'成功删除 {deleted} 条记录'})
     except Exception as e:
-        db.session.rollback()
         return jsonify({'success': False, 'message': str(e)})
+    finally:
+        _invalidate_history_total()
+
+@app.route('/api/history/purge', methods=['POST'])
+def api_purge_history():
+    """按条件删除历史，条件同 /api/history/search：platform、success、has_images、from、to"""
+    data = request.get_json() or {}
+    success = data.get('success')
+    has_images = data.get('has_images')
+    try:
+        deleted = history_ops.purge_posts(
+            platform=data.get('platform') or None,
+            success=None if success in (None, '') else bool(int(success)),
+            date_from=data.get('from') or None,
+            date_to=data.get('to') or None,
+            has_images=None if has_images in (None, '') else bool(int(has_images))
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    finally:
+        _invalidate_history_total()
+    return jsonify({'success': True, 'message': f'成功删除 {deleted} 条记录', 'deleted': deleted})
+
+@app.route('/api/history/export')
+def api_export_history():
+    """流式导出全部历史，format=ndjson（默认）或 csv"""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'success': False, 'message': '不支持的导出格式'}), 400
+    filename = f"history-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    if fmt == 'csv':
+        body, content_type = history_ops.export_csv(), 'text/csv; charset=utf-8'
+    else:
+        body, content_type = history_ops.export_ndjson(), 'application/x-ndjson; charset=utf-8'
+    return Response(
+        stream_with_context(body),
+        content_type=content_type,
+        headers={'Content-Disposition': f'attachment; filename={filename}', 'X-Accel-Buffering': 'no'}
+    )
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000, use_reloader=False)
@@ -0,0 +1,104 @@
+"""
+SQLite 连接配置和批量写入。
+
+- 每个新连接都设置 WAL、synchronous=NORMAL、mmap、缓存大小和 busy_timeout：
+  WAL 下读不阻塞写、写也不阻塞读，发布任务写历史时历史页的查询不用等锁
+- BatchWriter 把多个线程提交的写操作合并成一个事务提交，批量发布时不必每条记录单独 fsync
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///posts.db')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+# 页缓存大小（KB）
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '20000'))
+# 批量写入：最多合并多少个写操作，第一个写操作最多等待多久（秒）再提交
+DB_BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', '50'))
+DB_BATCH_WAIT = float(os.getenv('DB_BATCH_WAIT', '0.05'))
+
+
+@event.listens_for(Engine, 'connect')
+def _apply_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+    cursor.close()
+
+
+def configure(app):
+    """在 db.init_app 之前调用"""
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+
+class BatchWriter:
+    """
+    合并写操作的后台线程。submit(fn) 返回 Future：fn 在写线程的 app context 里执行，
+    只做 db.session 上的改动，不要自己 commit；同一批的改动一起提交，提交后 Future 完成。
+    整批提交失败时逐个重试，一个出错的写操作不会连累同批的其他写操作。
+    """
+
+    def __init__(self, app, max_batch=DB_BATCH_SIZE, max_wait=DB_BATCH_WAIT):
+        self._app = app
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn):
+        future = Future()
+        self._queue.put((fn, future))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='db-batch-writer', daemon=True)
+                self._thread.start()
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        with self._app.app_context():
+            try:
+                results = [fn() for fn, _ in batch]
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                if len(batch) > 1:
+                    for item in batch:
+                        self._flush([item])
+                else:
+                    traceback.print_exc()
+                    batch[0][1].set_exception(e)
+                return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
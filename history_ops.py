@@ -0,0 +1,143 @@
+"""
+发布历史的批量操作：分块删除、按条件清理和流式导出。
+
+- 删除按 HISTORY_DELETE_CHUNK 条一个事务，每个事务很短，不会长时间占着写锁；
+  IN (...) 的参数个数不超过 SQLite 的 999 个上限
+- 导出按 (created_at, id) 做键集分页逐批读取、边读边输出，不会把全部记录读进内存，
+  也不会让一个读事务贯穿整个下载过程
+"""
+import csv
+import io
+import json
+
+from sqlalchemy import tuple_
+
+import uploads
+from history_search import _filters
+from models import db, PostHistory, PostImage, PostPlatformResult
+
+# 旧版 SQLite 单条语句最多 999 个参数
+SQLITE_MAX_PARAMS = 999
+HISTORY_DELETE_CHUNK = 500
+HISTORY_EXPORT_BATCH = 500
+CSV_COLUMNS = ['id', 'created_at', 'content', 'platforms', 'results', 'remote_ids', 'image_paths']
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _delete_chunk(ids):
+    """在一个事务里删除一批历史（连同平台结果、图片关联）并减少图片引用，返回删除的条数"""
+    image_paths = [path for (path,) in db.session.query(PostImage.path).filter(PostImage.post_id.in_(ids))]
+    uploads.change_refs(image_paths, -1)
+    PostPlatformResult.query.filter(PostPlatformResult.post_id.in_(ids)).delete(synchronize_session=False)
+    PostImage.query.filter(PostImage.post_id.in_(ids)).delete(synchronize_session=False)
+    deleted = PostHistory.query.filter(PostHistory.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def delete_posts(ids):
+    """按 ID 删除历史，返回删除的条数"""
+    ids = sorted({int(i) for i in ids})
+    deleted = 0
+    try:
+        for chunk in _chunks(ids, min(HISTORY_DELETE_CHUNK, SQLITE_MAX_PARAMS)):
+            deleted += _delete_chunk(chunk)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if deleted:
+            uploads.request_cleanup()
+    return deleted
+
+
+def _delete_matching(conditions):
+    deleted = 0
+    try:
+        while True:
+            ids = [post_id for (post_id,) in db.session.query(PostHistory.id).filter(*conditions)
+                   .order_by(PostHistory.id).limit(HISTORY_DELETE_CHUNK)]
+            if not ids:
+                break
+            deleted += _delete_chunk(ids)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if deleted:
+            uploads.request_cleanup()
+    return deleted
+
+
+def clear_posts():
+    """分批删除全部历史，返回删除的条数"""
+    return _delete_matching([])
+
+
+def purge_posts(platform=None, success=None, date_from=None, date_to=None, has_images=None):
+    """按条件（同历史搜索的筛选条件）分批删除，返回删除的条数。日期格式错误时抛出 ValueError"""
+    conditions = _filters(platform, success, date_from, date_to, has_images)
+    if not conditions:
+        raise ValueError('至少需要一个筛选条件')
+    return _delete_matching(conditions)
+
+
+def iter_posts(batch_size=HISTORY_EXPORT_BATCH):
+    """按时间倒序逐批读取全部历史，逐条返回 to_dict()"""
+    cursor = None
+    while True:
+        query = PostHistory.query
+        if cursor is not None:
+            query = query.filter(tuple_(PostHistory.created_at, PostHistory.id) < cursor)
+        posts = query.order_by(PostHistory.created_at.desc(), PostHistory.id.desc()).limit(batch_size).all()
+        if not posts:
+            return
+        cursor = (posts[-1].created_at, posts[-1].id)
+        rows = [post.to_dict() for post in posts]
+        # 读完一批就结束读事务并释放对象，长时间的下载不会阻止 WAL checkpoint
+        db.session.rollback()
+        db.session.expunge_all()
+        yield from rows
+
+
+def export_ndjson():
+    lines = []
+    for post in iter_posts():
+        lines.append(json.dumps(post, ensure_ascii=False) + '\n')
+        if len(lines) >= HISTORY_EXPORT_BATCH:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+def export_csv():
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    # 带 BOM，Excel 打开中文不乱码
+    buffer.write('\ufeff')
+    writer.writerow(CSV_COLUMNS)
+    for index, post in enumerate(iter_posts(), 1):
+        writer.writerow([
+            post['id'],
+            post['created_at'],
+            post['content'],
+            ' '.join(post['platforms']),
+            ' '.join(f"{r['platform']}:{r['status']}" for r in post['results']),
+            ' '.join(f"{r['platform']}:{r['remote_id']}" for r in post['results'] if r['remote_id']),
+            ' '.join(post['image_paths'])
+        ])
+        if index % HISTORY_EXPORT_BATCH == 0:
+            yield flush()
+    yield flush()
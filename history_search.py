@@ -0,0 +1,184 @@
+"""
+发布历史的全文搜索。
+
+post_history_fts 是 post_history.content 的 FTS5 外部内容表，由触发器保持同步；
+使用 trigram 分词，中文不需要分词也能按任意子串检索，结果按 bm25 排序并带高亮片段。
+trigram 只能匹配 3 个字符及以上的词，更短的查询（以及不支持 FTS5 的 SQLite）退回 LIKE。
+"""
+import re
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, exists
+
+from models import db, PostHistory, PostImage, PostPlatformResult
+
+FTS_TABLE = 'post_history_fts'
+SEARCH_MAX_LIMIT = 50
+# 片段中高亮的起止标记，前端转义内容后再替换成 <mark>
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+SNIPPET_TOKENS = 24
+TRIGRAM_MIN_LENGTH = 3
+
+_FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        content, content='post_history', content_rowid='id', tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON post_history BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON post_history BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF content ON post_history BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+
+fts_enabled = False
+
+
+def init_fts():
+    """创建全文索引表和同步触发器；第一次创建时为已有的历史建立索引。需要在 app context 中调用"""
+    global fts_enabled
+    try:
+        with db.engine.begin() as conn:
+            found = conn.execute(
+                db.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': FTS_TABLE}
+            ).first()
+            if not found:
+                conn.execute(db.text(_FTS_DDL[0]))
+            # 触发器每次启动都确认一遍：post_history 表被重建（旧版 SQLite 的迁移）时触发器会随旧表删除
+            for ddl in _FTS_DDL[1:]:
+                conn.execute(db.text(ddl))
+            if not found:
+                conn.execute(db.text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+                print('已建立发布历史的全文索引')
+        fts_enabled = True
+    except Exception:
+        # SQLite 没有编译 FTS5 或版本低于 3.34（不支持 trigram）
+        traceback.print_exc()
+        print('全文索引不可用，历史搜索使用 LIKE')
+        fts_enabled = False
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+def _filters(platform=None, success=None, date_from=None, date_to=None, has_images=None):
+    """
+    platform: twitter / zhihu；success: True / False（指定平台时看该平台，否则看是否有平台成功）；
+    has_images: True / False。平台和状态条件走 post_platform_result 的 (platform, status, post_id) 索引
+    """
+    conditions = []
+    result_conditions = [PostPlatformResult.post_id == PostHistory.id]
+    if platform:
+        result_conditions.append(PostPlatformResult.platform == platform)
+        if success is not None:
+            result_conditions.append(PostPlatformResult.status == ('success' if success else 'failed'))
+        conditions.append(exists().where(*result_conditions))
+    elif success is not None:
+        any_success = exists().where(*result_conditions, PostPlatformResult.status == 'success')
+        conditions.append(any_success if success else ~any_success)
+    if has_images is not None:
+        with_images = exists().where(PostImage.post_id == PostHistory.id)
+        conditions.append(with_images if has_images else ~with_images)
+    start = _parse_date(date_from)
+    if start:
+        conditions.append(PostHistory.created_at >= start)
+    end = _parse_date(date_to)
+    if end:
+        # 结束日期包含当天
+        conditions.append(PostHistory.created_at < end + timedelta(days=1))
+    return conditions
+
+
+def _match_expression(terms):
+    # 每个词作为一个短语，多个词之间为 AND；双引号转义，用户输入不会被当作 FTS5 语法
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _like_snippet(content, terms, width=40):
+    """LIKE 搜索时在 Python 里生成片段：截取第一个命中词附近的内容并标出所有命中"""
+    lower = content.lower()
+    positions = [lower.find(term.lower()) for term in terms]
+    first = min((p for p in positions if p >= 0), default=0)
+    start = max(0, first - width // 2)
+    text = content[start:start + width * 2]
+    # 先在原文上收集所有命中区间并合并重叠的，一个词包含另一个词时也只标一次
+    spans = sorted(
+        match.span()
+        for term in set(terms) if term
+        for match in re.finditer(re.escape(term), text, re.IGNORECASE)
+    )
+    merged = []
+    for begin, end in spans:
+        if merged and begin <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([begin, end])
+    parts = []
+    cursor = 0
+    for begin, end in merged:
+        parts.append(text[cursor:begin] + HIGHLIGHT_START + text[begin:end] + HIGHLIGHT_END)
+        cursor = end
+    text = ''.join(parts) + text[cursor:]
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if start + width * 2 < len(content) else ''
+    return prefix + text + suffix
+
+
+def _search_fts(terms, conditions, limit, offset):
+    rank = db.func.bm25(db.literal_column(FTS_TABLE))
+    snippet = db.func.snippet(db.literal_column(FTS_TABLE), 0, HIGHLIGHT_START, HIGHLIGHT_END, '…', SNIPPET_TOKENS)
+    fts = db.table(FTS_TABLE, db.column('rowid'))
+    rows = db.session.execute(
+        db.select(PostHistory, snippet)
+        .join(fts, fts.c.rowid == PostHistory.id)
+        .where(db.literal_column(FTS_TABLE).op('MATCH')(_match_expression(terms)), *conditions)
+        .order_by(rank, PostHistory.id.desc())
+        .limit(limit)
+        .offset(offset)
+    ).all()
+    return [(post, snippet_text) for post, snippet_text in rows]
+
+
+def _search_like(terms, conditions, limit, offset):
+    posts = (
+        PostHistory.query
+        .filter(and_(*[PostHistory.content.contains(term, autoescape=True) for term in terms]), *conditions)
+        .order_by(PostHistory.created_at.desc(), PostHistory.id.desc())
+        .limit(limit)
+        .offset(offset)
+        .all()
+    )
+    return [(post, _like_snippet(post.content, terms)) for post in posts]
+
+
+def search(query, platform=None, success=None, date_from=None, date_to=None, has_images=None, limit=20, offset=0):
+    """
+    搜索发布历史，返回 (结果列表, 是否还有更多)。
+    每条结果是 PostHistory.to_dict() 加上 snippet（命中处用 HIGHLIGHT_START / HIGHLIGHT_END 标出）。
+    query 为空时只按条件筛选，按时间倒序。日期格式错误时抛出 ValueError
+    """
+    limit = min(max(limit, 1), SEARCH_MAX_LIMIT)
+    offset = max(offset, 0)
+    terms = (query or '').split()
+    conditions = _filters(platform, success, date_from, date_to, has_images)
+
+    # 多取一条判断是否还有下一页
+    if terms and fts_enabled and all(len(term) >= TRIGRAM_MIN_LENGTH for term in terms):
+        rows = _search_fts(terms, conditions, limit + 1, offset)
+    else:
+        rows = _search_like(terms, conditions, limit + 1, offset)
+
+    results = []
+    for post, snippet in rows[:limit]:
+        data = post.to_dict()
+        data['snippet'] = snippet if terms else None
+        results.append(data)
+    return results, len(rows) > limit
@@ -0,0 +1,782 @@
+"""
+基于 SQLite 的持久化发布队列。
+
+任务写入 publish_job 表，每个进程启动固定数量的 worker 线程，
+通过带租约的原子 UPDATE 认领任务；进程崩溃后租约过期，任务会被其他 worker 接手。
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import and_, exists, func, or_, select, update
+from sqlalchemy.orm import aliased
+
+from db_config import BatchWriter
+from models import db, PostHistory, PostImage, PostPlatformResult, PublishBatch, PublishJob, PublishJobStep
+from services import async_publisher, platforms as platform_registry
+import uploads
+
+JOB_WORKERS = max(1, int(os.getenv('PUBLISH_WORKERS', '4')))
+JOB_LEASE_SECONDS = int(os.getenv('PUBLISH_LEASE_SECONDS', '60'))
+JOB_MAX_ATTEMPTS = int(os.getenv('PUBLISH_MAX_ATTEMPTS', '3'))
+JOB_POLL_INTERVAL = float(os.getenv('PUBLISH_POLL_INTERVAL', '1'))
+# 多久检查一次其他进程发来的取消请求（秒），进行中的发布和图片上传在这个时间内开始停止
+JOB_CANCEL_POLL_INTERVAL = float(os.getenv('PUBLISH_CANCEL_SYNC_INTERVAL', '1'))
+# 失败平台的自动重试：最多重试次数，退避基数和上限（秒），按指数退避并加随机抖动
+JOB_RETRY_MAX = int(os.getenv('PUBLISH_RETRY_MAX', '3'))
+JOB_RETRY_BASE = float(os.getenv('PUBLISH_RETRY_BASE', '30'))
+JOB_RETRY_MAX_DELAY = float(os.getenv('PUBLISH_RETRY_MAX_DELAY', '900'))
+# 批量发布：一次最多提交的条数，默认的开始间隔（秒）和同时执行数
+BULK_MAX_ITEMS = int(os.getenv('PUBLISH_BULK_MAX_ITEMS', '500'))
+BULK_DEFAULT_SPACING = float(os.getenv('PUBLISH_BULK_SPACING', '0'))
+BULK_DEFAULT_CONCURRENCY = int(os.getenv('PUBLISH_BULK_CONCURRENCY', '2'))
+JOB_MAX_AGE = 600  # 已完成的 job 保留10分钟
+# 每个平台同时进行的发布数上限（跨进程生效），由各平台适配器声明
+PLATFORM_CONCURRENCY = {adapter.name: adapter.max_concurrency for adapter in platform_registry.all_adapters()}
+FINISHED_STATUSES = ('done', 'error', 'cancelled')
+# SSE：跨进程的更新靠轮询发现，本进程的更新通过条件变量立即推送
+STREAM_POLL_INTERVAL = float(os.getenv('PUBLISH_STREAM_POLL_INTERVAL', '1'))
+STREAM_KEEPALIVE = 15
+STREAM_MAX_DURATION = 600
+
+# 执行方式：thread = 每个 worker 一个线程（默认）；
+# async = 所有任务作为协程跑在一个事件循环线程里（X 用 httpx，知乎用 playwright.async_api）
+JOB_EXECUTION_MODE = os.getenv('PUBLISH_EXECUTION_MODE', 'thread').strip().lower()
+JOB_ASYNC_CONCURRENCY = int(os.getenv('PUBLISH_ASYNC_CONCURRENCY', '100'))
+
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}'
+
+_app = None
+_started = False
+_start_lock = threading.Lock()
+_wakeup = threading.Event()
+# 本进程正在执行的任务 -> 取消事件
+_active_jobs = {}
+_active_lock = threading.Lock()
+# 任务有新步骤或状态变化时通知正在推送的 SSE 连接
+_changed = threading.Condition()
+# async 模式：事件循环、循环内的唤醒事件、串行执行数据库写入的线程
+_loop = None
+_loop_wakeup = None
+_db_executor = None
+# 任务完成时的历史记录和状态写入，多个任务同时完成时合并成一个事务
+_history_writer = None
+
+
+def _now_label():
+    return time.strftime('%H:%M:%S')
+
+
+def _notify_change():
+    with _changed:
+        _changed.notify_all()
+
+
+def append_step(job_id, message):
+    with _app.app_context():
+        db.session.add(PublishJobStep(job_id=job_id, time=_now_label(), message=message))
+        db.session.commit()
+    _notify_change()
+
+
+def _finish_statement(job_id, status, success=False, message='', results=None):
+    values = {
+        'status': status,
+        'success': success,
+        'message': message,
+        'finished_at': time.time(),
+        'lease_owner': None,
+        'lease_expires_at': None
+    }
+    if results is not None:
+        values['results'] = json.dumps(results, ensure_ascii=False)
+    return update(PublishJob).where(PublishJob.id == job_id).values(**values)
+
+
+def _finish(job_id, status, success=False, message='', results=None):
+    with _app.app_context():
+        db.session.execute(_finish_statement(job_id, status, success, message, results))
+        db.session.commit()
+    _notify_change()
+
+
+def _finish_cancelled(job_id):
+    """结束已取消的任务，并在步骤中记录从发出取消到任务真正停止的耗时"""
+    with _app.app_context():
+        requested_at = db.session.execute(
+            select(PublishJob.cancel_requested_at).where(PublishJob.id == job_id)
+        ).scalar()
+    if requested_at:
+        append_step(job_id, f'发布已停止，取消耗时 {(time.time() - requested_at) * 1000:.0f}ms')
+    _finish(job_id, 'cancelled', message='发布已被用户取消')
+
+
+def enqueue_job(content, platforms, image_paths):
+    job_id = uuid.uuid4().hex
+    with _app.app_context():
+        db.session.add(PublishJob(
+            id=job_id,
+            content=content,
+            platforms=','.join(platforms),
+            image_paths=json.dumps(image_paths or [], ensure_ascii=False)
+        ))
+        db.session.add(PublishJobStep(job_id=job_id, time=_now_label(), message='任务已创建，准备开始'))
+        db.session.commit()
+    _signal_work()
+    return job_id
+
+
+def enqueue_batch(posts, spacing=BULK_DEFAULT_SPACING, concurrency=BULK_DEFAULT_CONCURRENCY):
+    """
+    批量创建任务，posts: [(content, platforms, image_paths)]。
+    相邻两条开始执行至少间隔 spacing 秒，同一批同时执行的任务不超过 concurrency 个，
+    两者都在认领时检查（见 _batch_has_room）。返回 (batch_id, job_ids)
+    """
+    batch_id = uuid.uuid4().hex
+    now = time.time()
+    # next_run_at 只用来保持提交顺序，间隔由认领时的 last_started_at 控制
+    step = 0.001
+    job_ids = []
+    with _app.app_context():
+        db.session.add(PublishBatch(id=batch_id, total=len(posts), spacing=spacing, concurrency=concurrency))
+        for index, (content, platforms, image_paths) in enumerate(posts):
+            job_id = uuid.uuid4().hex
+            job_ids.append(job_id)
+            db.session.add(PublishJob(
+                id=job_id,
+                content=content,
+                platforms=','.join(platforms),
+                image_paths=json.dumps(image_paths or [], ensure_ascii=False),
+                batch_id=batch_id,
+                next_run_at=now + index * step
+            ))
+            db.session.add(PublishJobStep(job_id=job_id, time=_now_label(),
+                                          message=f'任务已创建（批量 {index + 1}/{len(posts)}），准备开始'))
+        db.session.commit()
+    _signal_work()
+    return batch_id, job_ids
+
+
+def get_job(job_id):
+    job = db.session.get(PublishJob, job_id)
+    if not job:
+        return None
+    steps = PublishJobStep.query.filter_by(job_id=job_id).order_by(PublishJobStep.id).all()
+    return job.to_dict(steps=steps)
+
+
+def get_batch(batch_id):
+    """批量发布的汇总进度和每条任务的状态"""
+    batch = db.session.get(PublishBatch, batch_id)
+    if not batch:
+        return None
+    jobs = PublishJob.query.filter_by(batch_id=batch_id).order_by(PublishJob.next_run_at).all()
+    counts = {}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    finished = sum(counts.get(status, 0) for status in FINISHED_STATUSES)
+    return {
+        'id': batch.id,
+        'total': batch.total,
+        'spacing': batch.spacing,
+        'concurrency': batch.concurrency,
+        'counts': counts,
+        'finished': finished,
+        'succeeded': sum(1 for job in jobs if job.status == 'done' and job.success),
+        'failed': sum(1 for job in jobs if job.status == 'error' or (job.status == 'done' and not job.success)),
+        'done': finished == len(jobs),
+        'jobs': [
+            dict(job.to_dict(), content=job.content[:50])
+            for job in jobs
+        ]
+    }
+
+
+def cancel_batch(batch_id):
+    """取消批量中所有未结束的任务，返回发出取消的任务数；批量不存在返回 None"""
+    if not db.session.get(PublishBatch, batch_id):
+        return None
+    job_ids = db.session.execute(
+        select(PublishJob.id).where(PublishJob.batch_id == batch_id, PublishJob.status.notin_(FINISHED_STATUSES))
+    ).scalars().all()
+    return sum(1 for job_id in job_ids if request_cancel(job_id) in ('cancelling', 'cancelled'))
+
+
+def _sse(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False))
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream_job(job_id, last_step_id=0):
+    """
+    生成任务的 SSE 事件流：只推送 id 大于 last_step_id 的新步骤，
+    状态变化时推送 status 事件，任务结束后关闭。事件 id 即步骤 id，可用 Last-Event-ID 续传。
+    """
+    last_status = None
+    started = time.time()
+    last_sent = started
+    yield 'retry: 2000\n\n'
+    while True:
+        with _app.app_context():
+            job = db.session.get(PublishJob, job_id)
+            if not job:
+                yield _sse('missing', {'message': '任务不存在'})
+                return
+            steps = (
+                PublishJobStep.query
+                .filter(PublishJobStep.job_id == job_id, PublishJobStep.id > last_step_id)
+                .order_by(PublishJobStep.id)
+                .all()
+            )
+            job_data = job.to_dict()
+
+        for step in steps:
+            last_step_id = step.id
+            yield _sse('step', step.to_dict(), event_id=step.id)
+            last_sent = time.time()
+
+        if job_data['status'] != last_status:
+            last_status = job_data['status']
+            yield _sse('status', job_data, event_id=last_step_id)
+            last_sent = time.time()
+        if last_status in FINISHED_STATUSES:
+            return
+
+        now = time.time()
+        if now - started > STREAM_MAX_DURATION:
+            # 让浏览器带着 Last-Event-ID 重连，避免单个连接长期占用线程
+            return
+        if now - last_sent > STREAM_KEEPALIVE:
+            yield ': keep-alive\n\n'
+            last_sent = now
+
+        with _changed:
+            _changed.wait(STREAM_POLL_INTERVAL)
+
+
+def request_cancel(job_id):
+    """
+    标记任务为取消。返回 'cancelling'（已通知执行中的 worker）、
+    'cancelled'（尚未开始，直接取消）、'finished' 或 None（任务不存在）
+    """
+    job = db.session.get(PublishJob, job_id)
+    if not job:
+        return None
+    if job.status in FINISHED_STATUSES:
+        return 'finished'
+
+    if job.status in ('queued', 'retry_wait'):
+        result = db.session.execute(
+            update(PublishJob)
+            .where(PublishJob.id == job_id, PublishJob.status.in_(('queued', 'retry_wait')))
+            .values(status='cancelled', success=False, cancel_requested=True,
+                    cancel_requested_at=time.time(), message='发布已被用户取消', finished_at=time.time())
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            _notify_change()
+            return 'cancelled'
+
+    db.session.execute(
+        update(PublishJob)
+        .where(PublishJob.id == job_id, PublishJob.cancel_requested.isnot(True))
+        .values(cancel_requested=True, cancel_requested_at=time.time())
+    )
+    db.session.commit()
+    # 任务就在本进程执行时立即通知，其他进程由 _cancel_watcher 轮询到
+    with _active_lock:
+        cancel_event = _active_jobs.get(job_id)
+    if cancel_event:
+        cancel_event.set()
+    return 'cancelling'
+
+
+def _claimable(now):
+    return or_(
+        and_(PublishJob.status == 'queued', or_(PublishJob.next_run_at.is_(None), PublishJob.next_run_at <= now)),
+        and_(PublishJob.status == 'retry_wait', PublishJob.next_run_at <= now),
+        and_(PublishJob.status == 'running', PublishJob.lease_expires_at < now)
+    )
+
+
+def _batch_spacing_elapsed(now):
+    return or_(PublishBatch.last_started_at.is_(None), PublishBatch.last_started_at + PublishBatch.spacing <= now)
+
+
+def _batch_has_room(now):
+    """
+    不属于批量，或者所在批量正在执行的任务数低于 concurrency、且距上一条开始已经过了 spacing 秒。
+    间隔按实际开始时间计算，concurrency 限住时积压的任务也不会在空出位置后接连开始
+    """
+    other = aliased(PublishJob)
+    running = (
+        select(func.count())
+        .select_from(other)
+        .where(other.batch_id == PublishBatch.id, other.status == 'running', other.lease_expires_at >= now)
+        .scalar_subquery()
+    )
+    ready = exists().where(
+        PublishBatch.id == PublishJob.batch_id,
+        running < PublishBatch.concurrency,
+        _batch_spacing_elapsed(now)
+    )
+    return or_(PublishJob.batch_id.is_(None), ready)
+
+
+def _running_count(platform, now):
+    other = aliased(PublishJob)
+    return (
+        select(func.count())
+        .select_from(other)
+        .where(
+            other.status == 'running',
+            other.lease_expires_at >= now,
+            other.platforms.like(f'%{platform}%')
+        )
+        .scalar_subquery()
+    )
+
+
+def _claim_next(owner):
+    """原子地认领一个可执行的任务；平台并发上限写在同一条 UPDATE 里，避免多进程竞争"""
+    now = time.time()
+    candidates = db.session.execute(
+        select(PublishJob.id, PublishJob.platforms, PublishJob.batch_id)
+        .where(_claimable(now), _batch_has_room(now))
+        .order_by(func.coalesce(PublishJob.next_run_at, PublishJob.created_at))
+        .limit(20)
+    ).all()
+
+    for job_id, platforms, batch_id in candidates:
+        conditions = [PublishJob.id == job_id, _claimable(now), _batch_has_room(now)]
+        for platform in platforms.split(','):
+            limit = PLATFORM_CONCURRENCY.get(platform)
+            if limit:
+                conditions.append(_running_count(platform, now) < limit)
+        result = db.session.execute(
+            update(PublishJob)
+            .where(*conditions)
+            .values(status='running', lease_owner=owner,
+                    lease_expires_at=now + JOB_LEASE_SECONDS,
+                    attempts=PublishJob.attempts + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 1 and batch_id:
+            # 和认领在同一个事务里记下批量的开始时间；间隔未到（被其他进程抢先）时放弃这次认领
+            started = db.session.execute(
+                update(PublishBatch)
+                .where(PublishBatch.id == batch_id, _batch_spacing_elapsed(now))
+                .values(last_started_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            if started.rowcount != 1:
+                db.session.rollback()
+                continue
+        db.session.commit()
+        if result.rowcount == 1:
+            return job_id
+    return None
+
+
+class _JobRun:
+    """一次任务执行的上下文，同步和异步两种执行方式共用"""
+
+    def __init__(self, job_id, content, platforms, image_paths, previous, attempts, retry_count=0):
+        self.job_id = job_id
+        self.content = content
+        self.platforms = platforms
+        self.image_paths = image_paths
+        self.attempts = attempts
+        self.retry_count = retry_count
+        self.cancel_event = threading.Event()
+        self.partial = {p: bool(previous.get(p)) for p in platforms}
+        # 各平台最近一次的结果明细，写入历史时使用
+        self.details = dict(previous.get('details') or {})
+        self.remaining = [p for p in platforms if not self.partial.get(p)]
+        self.skipped = [p for p in platforms if self.partial.get(p)]
+        self.abs_paths = []
+        self.image_urls = []
+        for p in image_paths or []:
+            if not p:
+                continue
+            clean = p.replace('\\', '/').lstrip('/')
+            self.abs_paths.append(os.path.join(_app.root_path, clean))
+            if clean.startswith('static/'):
+                self.image_urls.append('/' + clean)
+
+    def progress(self, message):
+        # 已取消的任务不再记录后续进度
+        if self.cancel_event.is_set():
+            return
+        append_step(self.job_id, message)
+
+    def on_result(self, platform, success, detail=None):
+        # 每个平台完成就落库，崩溃恢复时不会重复发布已成功的平台
+        self.partial[platform] = success
+        if detail is not None:
+            self.details[platform] = detail
+        with _app.app_context():
+            db.session.execute(
+                update(PublishJob).where(PublishJob.id == self.job_id)
+                .values(results=json.dumps(dict(self.partial, details=self.details), ensure_ascii=False))
+            )
+            db.session.commit()
+
+
+def _begin_job(job_id):
+    """读取任务并登记为执行中；不需要执行（已取消、超过重试次数）时结束任务并返回 None"""
+    with _app.app_context():
+        job = db.session.get(PublishJob, job_id)
+        run = _JobRun(
+            job_id, job.content, [p for p in job.platforms.split(',') if p],
+            job.get_image_paths(), job.get_results(), job.attempts, job.retry_count or 0
+        )
+        cancelled = job.cancel_requested
+
+    if cancelled:
+        _finish_cancelled(job_id)
+        return None
+    if run.attempts > JOB_MAX_ATTEMPTS:
+        _finish(job_id, 'error', message=f'任务已尝试 {run.attempts - 1} 次仍未完成，放弃')
+        return None
+
+    with _active_lock:
+        _active_jobs[job_id] = run.cancel_event
+
+    if run.attempts > 1:
+        run.progress(f'任务恢复执行（第 {run.attempts} 次尝试）')
+    elif run.retry_count:
+        run.progress(f'开始第 {run.retry_count}/{JOB_RETRY_MAX} 次重试')
+    else:
+        run.progress('开始发布任务')
+    if run.skipped:
+        run.progress('跳过已成功的平台: ' + ', '.join(run.skipped))
+    return run
+
+
+def _wait_images(run):
+    if run.remaining and run.image_paths:
+        # 只等待本次发布用到的图片处理完成
+        pending = uploads.wait_until_ready(run.image_paths)
+        if pending:
+            run.progress(f'有 {len(pending)} 张图片处理超时，使用原图发布')
+
+
+def _retry_delay(retry_count, retry_after=0):
+    """第 retry_count 次重试前的等待秒数：指数退避，取一半固定、一半随机，且不早于平台要求的时间"""
+    backoff = min(JOB_RETRY_MAX_DELAY, JOB_RETRY_BASE * 2 ** retry_count)
+    return max(retry_after, backoff / 2 + random.uniform(0, backoff / 2))
+
+
+def _schedule_retry(run, failed, results):
+    """只重试失败的平台：已成功的平台记录在 results 里，下次执行时跳过"""
+    delay = _retry_delay(run.retry_count, max(failed.values()))
+    next_run_at = time.time() + delay
+    retry_count = run.retry_count + 1
+    labels = ', '.join(platform_registry.get_adapter(p).label for p in failed)
+    message = (f'{labels} 发布失败，将于 {time.strftime("%H:%M:%S", time.localtime(next_run_at))} '
+               f'重试（第 {retry_count}/{JOB_RETRY_MAX} 次）')
+    append_step(run.job_id, message)
+    with _app.app_context():
+        db.session.execute(
+            update(PublishJob).where(PublishJob.id == run.job_id)
+            .values(status='retry_wait', next_run_at=next_run_at, retry_count=retry_count, attempts=0,
+                    message=' | '.join(results['messages'] + [message]),
+                    lease_owner=None, lease_expires_at=None)
+        )
+        db.session.commit()
+    _notify_change()
+
+
+def _complete_job(run, results):
+    """
+    记录任务结果。写历史和结束任务交给 _history_writer 合并提交，返回它的 Future；
+    任务被取消或安排了重试时直接处理完，返回 None
+    """
+    # 检查是否被取消
+    if run.cancel_event.is_set():
+        _finish_cancelled(run.job_id)
+        return
+
+    retry = results.pop('retry', {})
+    failed = {p: retry[p] for p in run.remaining if p in retry and not results.get(p)}
+    if failed and run.retry_count < JOB_RETRY_MAX:
+        _schedule_retry(run, failed, results)
+        return
+
+    for p in run.skipped:
+        results[p] = True
+        results['messages'].insert(0, f'{p} 已在之前的尝试中发布成功')
+    if run.retry_count:
+        results['messages'].append(f'已自动重试 {run.retry_count} 次')
+    success = any(results.get(p) for p in run.platforms)
+    message = ' | '.join(results['messages'])
+
+    details = dict(run.details, **results.get('details', {}))
+
+    def write():
+        history = PostHistory(content=run.content)
+        for platform in run.platforms:
+            detail = details.get(platform) or {}
+            history.results.append(PostPlatformResult(
+                platform=platform,
+                status='success' if results.get(platform) else 'failed',
+                remote_id=detail.get('remote_id'),
+                latency_ms=detail.get('latency_ms'),
+                error=detail.get('error')
+            ))
+        history.images = [PostImage(position=i, path=url) for i, url in enumerate(run.image_urls)]
+        db.session.add(history)
+        uploads.change_refs(run.image_urls, 1)
+        # 历史记录和任务状态在同一个事务里，不会出现任务已完成但历史没写入的情况
+        db.session.execute(_finish_statement(run.job_id, 'done', success, message, results))
+
+    future = _history_writer.submit(write)
+    future.add_done_callback(lambda _: _notify_change())
+    return future
+
+
+def _fail_job(run, error):
+    if run.cancel_event.is_set():
+        _finish_cancelled(run.job_id)
+    else:
+        traceback.print_exception(type(error), error, error.__traceback__)
+        _finish(run.job_id, 'error', message=f'发布失败: {str(error)}')
+
+
+def _release_job(run):
+    with _active_lock:
+        _active_jobs.pop(run.job_id, None)
+
+
+def _run_job(job_id):
+    run = _begin_job(job_id)
+    if run is None:
+        return
+    try:
+        _wait_images(run)
+        if run.remaining:
+            results = platform_registry.publish_to_platforms(
+                run.content, run.remaining, image_paths=run.abs_paths, progress=run.progress,
+                cancel_event=run.cancel_event, on_result=run.on_result
+            )
+        else:
+            results = {'messages': []}
+        future = _complete_job(run, results)
+        if future is not None:
+            future.result()
+    except Exception as e:
+        _fail_job(run, e)
+    finally:
+        _release_job(run)
+
+
+async def _run_job_async(job_id):
+    loop = asyncio.get_running_loop()
+    run = await loop.run_in_executor(_db_executor, _begin_job, job_id)
+    if run is None:
+        return
+
+    # 数据库写入交给单独的线程按顺序执行，不阻塞事件循环
+    def progress(message):
+        if not run.cancel_event.is_set():
+            _db_executor.submit(append_step, job_id, message)
+
+    def on_result(platform, success, detail=None):
+        _db_executor.submit(run.on_result, platform, success, detail)
+
+    try:
+        await asyncio.to_thread(_wait_images, run)
+        if run.remaining:
+            results = await platform_registry.publish_to_platforms_async(
+                run.content, run.remaining, image_paths=run.abs_paths, progress=progress,
+                cancel_event=run.cancel_event, on_result=on_result
+            )
+        else:
+            results = {'messages': []}
+        future = await loop.run_in_executor(_db_executor, _complete_job, run, results)
+        if future is not None:
+            await asyncio.wrap_future(future)
+    except Exception as e:
+        await loop.run_in_executor(_db_executor, _fail_job, run, e)
+    finally:
+        _release_job(run)
+
+
+def _claim(owner):
+    with _app.app_context():
+        return _claim_next(owner)
+
+
+def _worker_loop(index):
+    owner = f'{WORKER_ID}-{index}'
+    while True:
+        try:
+            job_id = _claim(owner)
+        except Exception:
+            traceback.print_exc()
+            job_id = None
+
+        if not job_id:
+            _wakeup.wait(JOB_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+
+        try:
+            _run_job(job_id)
+        except Exception:
+            traceback.print_exc()
+
+
+def _set_loop_wakeup():
+    if _loop_wakeup is not None:
+        _loop_wakeup.set()
+
+
+def _signal_work():
+    _wakeup.set()
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_set_loop_wakeup)
+
+
+async def _async_main(prewarm_zhihu=False):
+    """async 模式的调度循环：认领任务后作为协程并发执行，同时最多 JOB_ASYNC_CONCURRENCY 个"""
+    global _loop_wakeup
+    _loop_wakeup = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    owner = f'{WORKER_ID}-async'
+    running = set()
+
+    if prewarm_zhihu:
+        loop.create_task(async_publisher.start_zhihu_browser())
+
+    while True:
+        job_id = None
+        if len(running) < JOB_ASYNC_CONCURRENCY:
+            try:
+                job_id = await loop.run_in_executor(_db_executor, _claim, owner)
+            except Exception:
+                traceback.print_exc()
+
+        if job_id:
+            task = loop.create_task(_run_job_async(job_id))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            # 有任务结束时立即尝试认领下一个
+            task.add_done_callback(lambda _: _loop_wakeup.set())
+            continue
+
+        try:
+            await asyncio.wait_for(_loop_wakeup.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _loop_wakeup.clear()
+
+
+def _run_event_loop(prewarm_zhihu):
+    asyncio.set_event_loop(_loop)
+    try:
+        _loop.run_until_complete(_async_main(prewarm_zhihu))
+    finally:
+        _loop.run_until_complete(async_publisher.aclose())
+
+
+def _cleanup_jobs():
+    """清理过期的已完成 job；批量中的 job 等整批结束并过期后一起清理"""
+    expired_before = time.time() - JOB_MAX_AGE
+    active_batches = select(PublishJob.batch_id).where(
+        PublishJob.batch_id.isnot(None),
+        or_(PublishJob.status.notin_(FINISHED_STATUSES), PublishJob.finished_at >= expired_before)
+    )
+    expired_conditions = (
+        PublishJob.status.in_(FINISHED_STATUSES),
+        PublishJob.finished_at < expired_before,
+        or_(PublishJob.batch_id.is_(None), PublishJob.batch_id.notin_(active_batches))
+    )
+    expired = select(PublishJob.id).where(*expired_conditions)
+    PublishJobStep.query.filter(PublishJobStep.job_id.in_(expired)).delete(synchronize_session=False)
+    PublishJob.query.filter(*expired_conditions).delete(synchronize_session=False)
+    PublishBatch.query.filter(
+        PublishBatch.created_at < expired_before,
+        PublishBatch.id.notin_(select(PublishJob.batch_id).where(PublishJob.batch_id.isnot(None)))
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def _lease_keeper():
+    """续租本进程正在执行的任务，并定期清理旧任务"""
+    last_cleanup = 0
+    while True:
+        time.sleep(max(1, JOB_LEASE_SECONDS / 3))
+        try:
+            with _active_lock:
+                active = dict(_active_jobs)
+            with _app.app_context():
+                if active:
+                    db.session.execute(
+                        update(PublishJob)
+                        .where(PublishJob.id.in_(list(active)), PublishJob.status == 'running')
+                        .values(lease_expires_at=time.time() + JOB_LEASE_SECONDS)
+                        .execution_options(synchronize_session=False)
+                    )
+                    db.session.commit()
+
+                if time.time() - last_cleanup > 60:
+                    _cleanup_jobs()
+                    last_cleanup = time.time()
+        except Exception:
+            traceback.print_exc()
+
+
+def _cancel_watcher():
+    """同步其他进程发来的取消请求；本进程没有任务在执行时不查询数据库"""
+    while True:
+        time.sleep(JOB_CANCEL_POLL_INTERVAL)
+        with _active_lock:
+            active = {job_id: event for job_id, event in _active_jobs.items() if not event.is_set()}
+        if not active:
+            continue
+        try:
+            with _app.app_context():
+                cancelled = db.session.execute(
+                    select(PublishJob.id).where(
+                        PublishJob.id.in_(list(active)),
+                        PublishJob.cancel_requested.is_(True)
+                    )
+                ).scalars().all()
+            for job_id in cancelled:
+                active[job_id].set()
+        except Exception:
+            traceback.print_exc()
+
+
+def start(app, prewarm_zhihu=False):
+    """启动本进程的 worker 线程或事件循环（只会启动一次）"""
+    global _app, _started, _loop, _db_executor, _history_writer
+    with _start_lock:
+        if _started:
+            return
+        _app = app
+        _started = True
+        _history_writer = BatchWriter(app)
+        if JOB_EXECUTION_MODE == 'async':
+            _db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='publish-db')
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_run_event_loop, args=(prewarm_zhihu,),
+                             name='publish-event-loop', daemon=True).start()
+        else:
+            for i in range(JOB_WORKERS):
+                threading.Thread(target=_worker_loop, args=(i,), name=f'publish-worker-{i}', daemon=True).start()
+        threading.Thread(target=_lease_keeper, name='publish-lease-keeper', daemon=True).start()
+        threading.Thread(target=_cancel_watcher, name='publish-cancel-watcher', daemon=True).start()
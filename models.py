@@ -1,26 +1,264 @@
+import json
+import sqlite3
+import time
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.schema import CreateTable
 from datetime import datetime
 
 db = SQLAlchemy()
 
 class PostHistory(db.Model):
+    """一条发布记录；各平台的结果和图片分别在 post_platform_result、post_image 表中"""
     __tablename__ = 'post_history'
+    # 历史列表按 (created_at, id) 倒序做游标分页
+    __table_args__ = (db.Index('ix_post_history_created_at_id', 'created_at', 'id'),)
     
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    platforms = db.Column(db.String(100), nullable=False)
-    twitter_success = db.Column(db.Boolean, default=False)
-    zhihu_success = db.Column(db.Boolean, default=False)
-    image_paths = db.Column(db.Text, default='')
     created_at = db.Column(db.DateTime, default=datetime.now)
+    results = db.relationship('PostPlatformResult', order_by='PostPlatformResult.id', lazy='selectin',
+                              cascade='all, delete-orphan')
+    images = db.relationship('PostImage', order_by='PostImage.position', lazy='selectin',
+                             cascade='all, delete-orphan')
     
     def to_dict(self):
         return {
             'id': self.id,
             'content': self.content,
-            'platforms': self.platforms,
-            'twitter_success': self.twitter_success,
-            'zhihu_success': self.zhihu_success,
-            'image_paths': self.image_paths.split(',') if self.image_paths else [],
+            'platforms': [result.platform for result in self.results],
+            'results': [result.to_dict() for result in self.results],
+            'image_paths': [image.path for image in self.images],
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M')
         }
+
+class PostPlatformResult(db.Model):
+    """一条发布记录在某个平台上的结果"""
+    __tablename__ = 'post_platform_result'
+    # 按平台 + 状态筛选、统计时走索引
+    __table_args__ = (db.Index('ix_post_platform_result_platform_status', 'platform', 'status', 'post_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post_history.id'), nullable=False, index=True)
+    platform = db.Column(db.String(20), nullable=False)
+    # success / failed
+    status = db.Column(db.String(20), nullable=False)
+    # 平台上的内容 ID（推文 ID、知乎想法 ID），取不到时为空
+    remote_id = db.Column(db.String(64))
+    latency_ms = db.Column(db.Integer)
+    error = db.Column(db.Text)
+
+    def to_dict(self):
+        return {
+            'platform': self.platform,
+            'status': self.status,
+            'remote_id': self.remote_id,
+            'latency_ms': self.latency_ms,
+            'error': self.error
+        }
+
+class PostImage(db.Model):
+    __tablename__ = 'post_image'
+
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post_history.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    # 图片 URL（/static/uploads/...）
+    path = db.Column(db.String(255), nullable=False, index=True)
+
+class PublishJob(db.Model):
+    """持久化的发布任务，多个进程通过租约（lease）认领执行"""
+    __tablename__ = 'publish_job'
+
+    id = db.Column(db.String(32), primary_key=True)
+    # queued -> running -> done / error / cancelled；有平台失败可重试时 running -> retry_wait -> running
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    content = db.Column(db.Text, nullable=False)
+    platforms = db.Column(db.String(100), nullable=False)
+    image_paths = db.Column(db.Text, default='[]')
+    success = db.Column(db.Boolean, default=False)
+    message = db.Column(db.Text, default='')
+    results = db.Column(db.Text, default='{}')
+    cancel_requested = db.Column(db.Boolean, default=False)
+    cancel_requested_at = db.Column(db.Float)
+    lease_owner = db.Column(db.String(100))
+    lease_expires_at = db.Column(db.Float)
+    attempts = db.Column(db.Integer, default=0)
+    # 失败平台的自动重试次数；next_run_at 为最早执行时间（批量发布的间隔、重试的退避）
+    retry_count = db.Column(db.Integer, default=0)
+    next_run_at = db.Column(db.Float)
+    batch_id = db.Column(db.String(32), db.ForeignKey('publish_batch.id'), index=True)
+    created_at = db.Column(db.Float, default=time.time, index=True)
+    finished_at = db.Column(db.Float)
+
+    def get_image_paths(self):
+        return json.loads(self.image_paths or '[]')
+
+    def get_results(self):
+        return json.loads(self.results or '{}')
+
+    def to_dict(self, steps=None):
+        data = {
+            'id': self.id,
+            'status': self.status,
+            'success': self.success,
+            'message': self.message or '',
+            'results': self.get_results(),
+            'attempts': self.attempts,
+            'retry_count': self.retry_count or 0,
+            'next_run_at': self.next_run_at,
+            'batch_id': self.batch_id
+        }
+        if steps is not None:
+            data['steps'] = [step.to_dict() for step in steps]
+        return data
+
+class PublishJobStep(db.Model):
+    __tablename__ = 'publish_job_step'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(32), db.ForeignKey('publish_job.id'), nullable=False, index=True)
+    time = db.Column(db.String(8), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+
+    def to_dict(self):
+        return {'time': self.time, 'message': self.message}
+
+class PublishBatch(db.Model):
+    """批量发布：一批任务按间隔依次开始，同时执行的数量不超过 concurrency"""
+    __tablename__ = 'publish_batch'
+
+    id = db.Column(db.String(32), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    spacing = db.Column(db.Float, nullable=False, default=0)
+    concurrency = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.Float, default=time.time, index=True)
+    # 最近一条任务开始执行的时间，下一条要等到 last_started_at + spacing 之后才能认领
+    last_started_at = db.Column(db.Float)
+
+class UploadedImage(db.Model):
+    """上传的图片及其后台处理状态"""
+    __tablename__ = 'uploaded_image'
+
+    id = db.Column(db.String(64), primary_key=True)
+    path = db.Column(db.String(255), nullable=False, unique=True)
+    # processing -> ready / error
+    status = db.Column(db.String(20), nullable=False, default='processing')
+    error = db.Column(db.Text)
+    # 被多少条发布历史引用，为 0 且超过保留期的文件会被清理
+    ref_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+    created_at = db.Column(db.Float, default=time.time)
+    # 引用它的历史记录被删除的时间；删除历史后的图片不必等满保留期
+    released_at = db.Column(db.Float)
+
+    @property
+    def url(self):
+        return '/' + self.path
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'path': self.path,
+            'status': self.status
+        }
+
+def _sql_literal(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def upgrade_schema():
+    """
+    为已存在的表补上新增的列和索引。
+    db.create_all() 只会创建缺失的表，不会修改已有的表。
+    """
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=db.engine.dialect)}'
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if default is not None:
+                    ddl += f' DEFAULT {_sql_literal(default)}'
+                    if not column.nullable:
+                        ddl += ' NOT NULL'
+                conn.execute(db.text(ddl))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+# 迁移前旧列数据的备份
+LEGACY_BACKUP_TABLE = 'post_history_legacy'
+
+def migrate_post_history():
+    """
+    把旧版 post_history 中逗号拼接的 platforms / image_paths 和 twitter_success / zhihu_success
+    拆到 post_platform_result、post_image 表，完成后删除这些旧列。
+    旧列的原始数据先备份到 post_history_legacy 表，迁移后出问题还可以找回。
+    SQLite 3.35+ 直接 DROP COLUMN，更早的版本重建 post_history 表。
+    整个迁移在一个事务里，中途失败不会留下一半的数据。
+    """
+    inspector = db.inspect(db.engine)
+    if 'twitter_success' not in {c['name'] for c in inspector.get_columns('post_history')}:
+        return
+    legacy_columns = ('platforms', 'twitter_success', 'zhihu_success', 'image_paths')
+    migrated = 0
+    with db.engine.begin() as conn:
+        last_id = 0
+        while True:
+            rows = conn.execute(db.text(
+                'SELECT id, platforms, twitter_success, zhihu_success, image_paths FROM post_history '
+                'WHERE id > :last_id ORDER BY id LIMIT 1000'
+            ), {'last_id': last_id}).all()
+            if not rows:
+                break
+            results = []
+            images = []
+            for post_id, platforms, twitter_success, zhihu_success, image_paths in rows:
+                success = {'twitter': twitter_success, 'zhihu': zhihu_success}
+                for platform in dict.fromkeys(p for p in (platforms or '').split(',') if p):
+                    results.append({
+                        'post_id': post_id,
+                        'platform': platform,
+                        'status': 'success' if success.get(platform) else 'failed'
+                    })
+                for position, path in enumerate(p for p in (image_paths or '').split(',') if p):
+                    images.append({'post_id': post_id, 'position': position, 'path': path})
+            if results:
+                conn.execute(PostPlatformResult.__table__.insert(), results)
+            if images:
+                conn.execute(PostImage.__table__.insert(), images)
+            migrated += len(rows)
+            last_id = rows[-1][0]
+        conn.execute(db.text(
+            f"CREATE TABLE IF NOT EXISTS {LEGACY_BACKUP_TABLE} AS SELECT id, {', '.join(legacy_columns)} FROM post_history"
+        ))
+        if sqlite3.sqlite_version_info >= (3, 35):
+            for column in legacy_columns:
+                conn.execute(db.text(f'ALTER TABLE post_history DROP COLUMN {column}'))
+        else:
+            print(f'SQLite {sqlite3.sqlite_version} 不支持 DROP COLUMN，重建 post_history 表')
+            _rebuild_post_history(conn)
+    print(f'已迁移 {migrated} 条发布历史到新的表结构，旧列的数据备份在 {LEGACY_BACKUP_TABLE} 表')
+
+def _rebuild_post_history(conn):
+    """
+    按当前模型新建表、复制数据后替换旧表。新表先用临时名字创建：直接重命名旧表
+    会让 post_platform_result 等表的外键跟着指向改名后的旧表。
+    旧表上的索引和全文索引触发器随旧表删除，索引在这里重建，触发器由 init_fts 补上
+    """
+    table = PostHistory.__table__
+    rebuilt = table.to_metadata(db.MetaData(), name='post_history_rebuild')
+    conn.execute(CreateTable(rebuilt))
+    columns = ', '.join(column.name for column in table.columns)
+    conn.execute(db.text(f'INSERT INTO post_history_rebuild ({columns}) SELECT {columns} FROM post_history'))
+    conn.execute(db.text('DROP TABLE post_history'))
+    conn.execute(db.text('ALTER TABLE post_history_rebuild RENAME TO post_history'))
+    for index in table.indexes:
+        index.create(conn)
@@ -0,0 +1,478 @@
+"""
+asyncio 版本的发布流程（PUBLISH_EXECUTION_MODE=async 时由 job_queue 使用）。
+
+所有任务跑在同一个事件循环里：X 接口用 httpx.AsyncClient，OAuth1 签名用 oauthlib，
+知乎用 playwright.async_api；等待网络和浏览器时不占用线程。
+平台参数、选择器和缓存沿用 publisher_service 中的配置，结果格式与 publish_to_both 一致。
+"""
+import asyncio
+import mimetypes
+import os
+import time
+import traceback
+from pathlib import Path
+from urllib.parse import urlencode
+
+import httpx
+from oauthlib.oauth1 import Client as OAuth1Client
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+
+from services import cache_store, http_client
+from services.browser_pool import BROWSER_HEADLESS, BROWSER_MAX_USES
+from services.image_service import file_hash
+from services.publisher_service import (
+    COOKIES_FILE, ZHIHU_URL, ZHIHU_EDITOR_TIMEOUT, ZHIHU_UPLOAD_TIMEOUT, ZHIHU_PUBLISH_TIMEOUT,
+    ZHIHU_IMAGE_INPUT_SELECTOR, ZHIHU_IMAGE_BUTTON_SELECTOR,
+    X_MEDIA_UPLOAD_URL, X_MEDIA_UPLOAD_MODE, X_MEDIA_CHUNKED_THRESHOLD, X_MEDIA_SEGMENT_SIZE,
+    X_MEDIA_SEGMENT_RETRIES, X_MEDIA_CACHE_NAMESPACE, X_MEDIA_DEFAULT_TTL, X_MEDIA_TTL_MARGIN,
+    PublishCancelled, _account_key, _check_media_response, _check_rate_limit, _checkpoint,
+    _emit, _get_x_env, _pin_id, _platform_image, _read_cookies, _write_cookies,
+    _remove_hashtags, _is_upload_response, _is_publish_response
+)
+
+X_TWEETS_URL = 'https://api.x.com/2/tweets'
+# 事件循环内同时保持的连接数
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', '100'))
+
+_client = None
+
+
+def _get_client():
+    """httpx 客户端绑定事件循环，只在事件循环线程中创建和使用"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(http_client.HTTP_READ_TIMEOUT, connect=http_client.HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=http_client.HTTP_POOL_MAXSIZE),
+            transport=httpx.AsyncHTTPTransport(retries=http_client.HTTP_RETRIES)
+        )
+    return _client
+
+
+async def aclose():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    await _zhihu_browser.close()
+
+
+async def _request(method, url, retry_post=False, **kwargs):
+    """
+    和 http_client.request 一样按接口设置读超时，429 / 5xx 按 Retry-After 或指数退避重试；
+    同样只自动重发幂等的请求，POST 需要调用方用 retry_post=True 打开
+    """
+    _, read_timeout = http_client.default_timeout(url)
+    kwargs.setdefault('timeout', httpx.Timeout(read_timeout, connect=http_client.HTTP_CONNECT_TIMEOUT))
+    retries = http_client.HTTP_RETRIES if retry_post or method.upper() in http_client.HTTP_IDEMPOTENT_METHODS else 0
+    for attempt in range(retries + 1):
+        response = await _get_client().request(method, url, **kwargs)
+        if response.status_code not in http_client.HTTP_RETRY_STATUSES or attempt == retries:
+            return response
+        retry_after = response.headers.get('retry-after')
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else \
+            http_client.HTTP_RETRY_BACKOFF * (2 ** attempt)
+        await asyncio.sleep(delay)
+    return response
+
+
+def _signed_headers(creds, method, url, params=None, form=None):
+    """
+    OAuth1 签名。查询参数和 application/x-www-form-urlencoded 表单参与签名，
+    multipart 和 JSON 请求体不参与（与 requests_oauthlib 的行为一致）
+    """
+    client = OAuth1Client(
+        creds['api_key'],
+        client_secret=creds['api_key_secret'],
+        resource_owner_key=creds['access_token'],
+        resource_owner_secret=creds['access_token_secret']
+    )
+    if params:
+        url = f'{url}?{urlencode(params)}'
+    if form is not None:
+        _, headers, _ = client.sign(url, http_method=method, body=urlencode(form),
+                                    headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    else:
+        _, headers, _ = client.sign(url, http_method=method)
+    return {'Authorization': headers['Authorization']}
+
+
+async def _upload_media_simple(image_path, creds):
+    data = await asyncio.to_thread(Path(image_path).read_bytes)
+    response = await _request(
+        'POST', X_MEDIA_UPLOAD_URL,
+        headers=_signed_headers(creds, 'POST', X_MEDIA_UPLOAD_URL),
+        files={'media': (os.path.basename(image_path), data)}
+    )
+    data = _check_media_response(response, 'UPLOAD', creds)
+    return data.get('media_id_string'), data.get('expires_after_secs')
+
+
+def _read_segment(image_path, offset):
+    with open(image_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(X_MEDIA_SEGMENT_SIZE)
+
+
+async def _form_post(creds, form, retry_post=False):
+    return await _request(
+        'POST', X_MEDIA_UPLOAD_URL,
+        headers={**_signed_headers(creds, 'POST', X_MEDIA_UPLOAD_URL, form=form),
+                 'Content-Type': 'application/x-www-form-urlencoded'},
+        content=urlencode(form),
+        retry_post=retry_post
+    )
+
+
+async def _upload_media_chunked(image_path, creds, progress=None):
+    """分段上传（INIT / APPEND / FINALIZE），流程与 publisher_service._upload_media_chunked 相同"""
+    total_bytes = os.path.getsize(image_path)
+    if total_bytes == 0:
+        raise RuntimeError(f'图片为空: {image_path}')
+    media_type = mimetypes.guess_type(image_path)[0] or 'image/jpeg'
+    media_category = 'tweet_gif' if media_type == 'image/gif' else 'tweet_image'
+
+    data = _check_media_response(await _form_post(creds, {
+        'command': 'INIT', 'total_bytes': total_bytes,
+        'media_type': media_type, 'media_category': media_category
+    }), 'INIT', creds)
+    media_id = data['media_id_string']
+
+    for index, offset in enumerate(range(0, total_bytes, X_MEDIA_SEGMENT_SIZE)):
+        segment = await asyncio.to_thread(_read_segment, image_path, offset)
+        for attempt in range(1, X_MEDIA_SEGMENT_RETRIES + 1):
+            try:
+                response = await _request(
+                    'POST', X_MEDIA_UPLOAD_URL,
+                    headers=_signed_headers(creds, 'POST', X_MEDIA_UPLOAD_URL),
+                    data={'command': 'APPEND', 'media_id': media_id, 'segment_index': str(index)},
+                    files={'media': ('segment', segment)}
+                )
+                _check_media_response(response, 'APPEND', creds)
+                break
+            except (httpx.HTTPError, RuntimeError) as e:
+                if attempt == X_MEDIA_SEGMENT_RETRIES:
+                    raise RuntimeError(f'第 {index + 1} 段上传失败: {e}')
+                _emit(progress, f'X: 第 {index + 1} 段上传失败，重试 ({attempt}/{X_MEDIA_SEGMENT_RETRIES - 1})')
+                await asyncio.sleep(attempt)
+
+    data = _check_media_response(await _form_post(creds, {'command': 'FINALIZE', 'media_id': media_id}, retry_post=True),
+                                 'FINALIZE', creds)
+
+    processing = data.get('processing_info')
+    while processing and processing.get('state') in ('pending', 'in_progress'):
+        _emit(progress, f'X: 等待媒体处理 {processing.get("progress_percent", 0)}%')
+        await asyncio.sleep(processing.get('check_after_secs', 1))
+        params = {'command': 'STATUS', 'media_id': media_id}
+        data = _check_media_response(await _request(
+            'GET', X_MEDIA_UPLOAD_URL,
+            headers=_signed_headers(creds, 'GET', X_MEDIA_UPLOAD_URL, params=params),
+            params=params
+        ), 'STATUS', creds)
+        processing = data.get('processing_info')
+    if processing and processing.get('state') == 'failed':
+        raise RuntimeError(f'媒体处理失败: {processing.get("error")}')
+
+    return media_id, data.get('expires_after_secs')
+
+
+def _media_cache_key(image_path, creds):
+    return f'{_account_key(creds)}:{file_hash(image_path)}'
+
+
+async def _upload_media_cached(image_path, creds, progress=None):
+    name = os.path.basename(image_path)
+    key = await asyncio.to_thread(_media_cache_key, image_path, creds)
+    media_id = await asyncio.to_thread(cache_store.get_value, X_MEDIA_CACHE_NAMESPACE, key)
+    if media_id:
+        _emit(progress, f'X: 复用已上传的图片 {name}')
+        return media_id
+
+    _emit(progress, f'X: 上传图片 {name}')
+    if X_MEDIA_UPLOAD_MODE == 'chunked':
+        chunked = True
+    elif X_MEDIA_UPLOAD_MODE == 'simple':
+        chunked = False
+    else:
+        chunked = image_path.lower().endswith('.gif') or os.path.getsize(image_path) > X_MEDIA_CHUNKED_THRESHOLD
+    if chunked:
+        media_id, expires_after = await _upload_media_chunked(image_path, creds, progress)
+    else:
+        media_id, expires_after = await _upload_media_simple(image_path, creds)
+
+    ttl = (expires_after or X_MEDIA_DEFAULT_TTL) - X_MEDIA_TTL_MARGIN
+    if ttl > 0:
+        await asyncio.to_thread(cache_store.set_value, X_MEDIA_CACHE_NAMESPACE, key, media_id, ttl)
+    return media_id
+
+
+async def publish_to_twitter(content, image_paths=None, progress=None, cancel_event=None):
+    creds = _get_x_env()
+    _emit(progress, 'X: 初始化客户端')
+
+    upload_paths = []
+    for image_path in image_paths or []:
+        if not image_path:
+            continue
+        if not os.path.exists(image_path):
+            _emit(progress, f'X: 未找到图片 {image_path}')
+            continue
+        upload_paths.append(await asyncio.to_thread(_platform_image, image_path, 'x'))
+
+    # 多张图片并发上传，gather 保证 media_id 的顺序和图片顺序一致
+    media_ids = list(await asyncio.gather(*(
+        _upload_media_cached(path, creds, progress) for path in upload_paths
+    )))
+
+    body = {'text': content}
+    if media_ids:
+        body['media'] = {'media_ids': media_ids}
+
+    # 协程被取消时 httpx 会中断进行中的请求；这里再检查一次，避免取消后仍发出推文
+    _checkpoint(cancel_event)
+    _emit(progress, 'X: 发送内容')
+    response = await _request('POST', X_TWEETS_URL, headers=_signed_headers(creds, 'POST', X_TWEETS_URL), json=body)
+    _check_rate_limit(response, creds)
+    if response.status_code >= 400:
+        raise RuntimeError(f'发布失败: {response.status_code} {response.text}')
+    _emit(progress, 'X: 发布完成')
+    return response.json()
+
+
+class _AsyncZhihuBrowser:
+    """
+    事件循环内常驻的知乎浏览器（同 BrowserPool 的单个槽位）：
+    预热登录态，发布 BROWSER_MAX_USES 次或出错后重建，同一时间只执行一个发布。
+    """
+
+    def __init__(self):
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._page = None
+        self._lock = None
+        self._uses = 0
+
+    async def _launch(self):
+        await self._close_browser()
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(headless=BROWSER_HEADLESS)
+        viewport = {'width': 1280, 'height': 900} if BROWSER_HEADLESS else None
+        self._context = await self._browser.new_context(viewport=viewport)
+        self._page = await self._context.new_page()
+        if os.path.exists(COOKIES_FILE):
+            await self._context.add_cookies(await asyncio.to_thread(_read_cookies))
+        await self._page.goto(ZHIHU_URL)
+        await self._page.wait_for_load_state('domcontentloaded')
+        self._uses = 0
+        print('[zhihu-async] 浏览器已预热')
+
+    async def _close_browser(self):
+        for obj in (self._context, self._browser):
+            if obj is None:
+                continue
+            try:
+                await obj.close()
+            except Exception:
+                pass
+        self._browser = None
+        self._context = None
+        self._page = None
+
+    async def _is_healthy(self):
+        try:
+            if not self._browser or not self._browser.is_connected():
+                return False
+            if not self._page or self._page.is_closed():
+                return False
+            return await self._page.evaluate('1 + 1') == 2
+        except Exception:
+            return False
+
+    async def run(self, fn):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not await self._is_healthy():
+                await self._launch()
+            try:
+                result = await fn(self._page, self._context)
+                self._uses += 1
+            except (asyncio.CancelledError, PublishCancelled):
+                # 取消时立即关闭浏览器释放资源，下次发布前再重新启动
+                await self._close_browser()
+                raise
+            except BaseException:
+                # 出错后页面状态未知，直接重建
+                try:
+                    await self._launch()
+                except Exception:
+                    traceback.print_exc()
+                raise
+
+            try:
+                if self._uses >= BROWSER_MAX_USES:
+                    await self._launch()
+                else:
+                    await self._page.goto(ZHIHU_URL)
+                    await self._page.wait_for_load_state('domcontentloaded')
+            except Exception:
+                traceback.print_exc()
+                await self._close_browser()
+            return result
+
+    async def start(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not await self._is_healthy():
+                await self._launch()
+
+    async def close(self):
+        await self._close_browser()
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+
+_zhihu_browser = _AsyncZhihuBrowser()
+
+
+async def start_zhihu_browser():
+    """提前启动知乎浏览器（预热登录态）"""
+    try:
+        await _zhihu_browser.start()
+    except Exception:
+        traceback.print_exc()
+
+
+async def _wait_uploads(page, count, action, progress=None):
+    uploaded = []
+
+    def on_response(response):
+        if _is_upload_response(response):
+            uploaded.append(response)
+
+    page.on('response', on_response)
+    try:
+        await action()
+        deadline = time.monotonic() + ZHIHU_UPLOAD_TIMEOUT / 1000
+        while len(uploaded) < count:
+            remaining = int((deadline - time.monotonic()) * 1000)
+            if remaining <= 0:
+                raise PlaywrightTimeoutError('upload timeout')
+            await page.wait_for_event('response', _is_upload_response, timeout=remaining)
+    except PlaywrightTimeoutError:
+        _emit(progress, f'知乎: 已确认 {len(uploaded)}/{count} 张图片上传，等待超时 ({ZHIHU_UPLOAD_TIMEOUT}ms)，继续')
+    finally:
+        page.remove_listener('response', on_response)
+
+    failed = [r for r in uploaded if r.status >= 400]
+    if failed:
+        raise RuntimeError(f'知乎图片上传失败: {failed[0].status}')
+
+
+async def _attach_images(page, image_paths, progress=None):
+    files = [str(Path(p).resolve()) for p in image_paths]
+
+    async def action():
+        file_input = page.locator(ZHIHU_IMAGE_INPUT_SELECTOR)
+        if await file_input.count() > 0:
+            await file_input.first.set_input_files(files)
+            return
+        async with page.expect_file_chooser(timeout=ZHIHU_EDITOR_TIMEOUT) as chooser_info:
+            await page.locator(ZHIHU_IMAGE_BUTTON_SELECTOR).first.click()
+        chooser = await chooser_info.value
+        await chooser.set_files(files)
+
+    await _wait_uploads(page, len(files), action, progress)
+
+
+async def _dismiss_popups(page):
+    try:
+        await page.keyboard.press('Escape')
+    except Exception:
+        pass
+
+
+async def _click_publish(page):
+    try:
+        await page.get_by_role('button', name='发布').click(timeout=5000, force=True)
+    except Exception:
+        try:
+            await page.locator("button:has-text('发布')").first.click(force=True)
+        except Exception:
+            try:
+                await page.keyboard.press('Control+Enter')
+            except Exception:
+                pass
+
+
+async def _post_idea(page, content, image_paths, progress=None, cancel_event=None):
+    _checkpoint(cancel_event)
+    _emit(progress, '知乎: 打开想法输入框')
+    started = time.perf_counter()
+    await page.get_by_text('分享此刻的想法').click(timeout=ZHIHU_EDITOR_TIMEOUT)
+    editor = page.get_by_role('textbox').nth(1)
+    await editor.wait_for(state='visible', timeout=ZHIHU_EDITOR_TIMEOUT)
+    _emit(progress, f'知乎: 编辑器就绪，耗时 {(time.perf_counter() - started) * 1000:.0f}ms')
+
+    await editor.fill(_remove_hashtags(content))
+    await _dismiss_popups(page)
+    _emit(progress, '知乎: 内容已填写')
+
+    # 剪贴板方式依赖 Windows 同步 API，异步模式统一使用文件输入框
+    image_paths = [p for p in (image_paths or []) if p and os.path.exists(p)]
+    if image_paths:
+        _emit(progress, f'知乎: 上传 {len(image_paths)} 张图片')
+        started = time.perf_counter()
+        await _attach_images(page, image_paths, progress)
+        _emit(progress, f'知乎: {len(image_paths)} 张图片上传完成，耗时 {(time.perf_counter() - started) * 1000:.0f}ms')
+
+    _checkpoint(cancel_event)
+    _emit(progress, '知乎: 点击发布')
+    await _dismiss_popups(page)
+    started = time.perf_counter()
+    response = None
+    try:
+        async with page.expect_response(_is_publish_response, timeout=ZHIHU_PUBLISH_TIMEOUT) as info:
+            await _click_publish(page)
+        response = await info.value
+    except PlaywrightTimeoutError:
+        _emit(progress, f'知乎: 发布: 等待响应超时 ({ZHIHU_PUBLISH_TIMEOUT}ms)，继续')
+    _emit(progress, f'知乎: 发布请求完成，耗时 {(time.perf_counter() - started) * 1000:.0f}ms')
+    if response is not None and response.status >= 400:
+        raise RuntimeError(f'知乎发布接口返回 {response.status}')
+
+    _emit(progress, '知乎: 发布完成')
+    if response is None:
+        return None
+    try:
+        return _pin_id(await response.json())
+    except Exception:
+        return None
+
+
+async def publish_to_zhihu(content, image_paths=None, progress=None, cancel_event=None):
+    valid_image_paths = [
+        await asyncio.to_thread(_platform_image, p, 'zhihu')
+        for p in (image_paths or []) if p and os.path.exists(p)
+    ]
+
+    async def task(page, context):
+        _emit(progress, '知乎: 已获取预热的浏览器')
+        pin_id = await _post_idea(page, content, valid_image_paths, progress, cancel_event)
+        await asyncio.to_thread(_write_cookies, await context.cookies())
+        _emit(progress, '知乎: Cookies 已保存')
+        return pin_id
+
+    _emit(progress, '知乎: 等待浏览器')
+    try:
+        return await _zhihu_browser.run(task)
+    except PublishCancelled:
+        raise
+    except Exception as e:
+        _emit(progress, f'知乎: 发布出错 - {str(e)}')
+        raise
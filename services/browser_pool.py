@@ -0,0 +1,243 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeoutError
+
+from playwright.sync_api import sync_playwright
+
+
+def _env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+BROWSER_HEADLESS = _env_flag('ZHIHU_HEADLESS', False)
+BROWSER_POOL_SIZE = max(1, int(os.getenv('ZHIHU_POOL_SIZE', '1')))
+# 每个 context 发布多少次后重建，避免页面长时间运行导致内存膨胀
+BROWSER_MAX_USES = max(1, int(os.getenv('ZHIHU_MAX_POSTS_PER_CONTEXT', '20')))
+# 空闲时多久做一次健康检查（秒）
+BROWSER_HEALTH_INTERVAL = int(os.getenv('ZHIHU_HEALTH_CHECK_INTERVAL', '120'))
+# 单次发布任务最长等待时间（秒）
+BROWSER_TASK_TIMEOUT = int(os.getenv('ZHIHU_TASK_TIMEOUT', '180'))
+# 等待任务时检查取消的间隔（秒）
+BROWSER_CANCEL_POLL_INTERVAL = 0.2
+
+
+class BrowserTaskRunning(Exception):
+    """等待超时时任务已经在浏览器里执行，无法撤销，结果未知"""
+
+
+class _BrowserSlot(threading.Thread):
+    """
+    一个常驻浏览器槽位。
+    sync Playwright 的对象只能在创建它的线程中使用，
+    所以每个槽位独占一个线程，发布任务通过队列交给它执行。
+    """
+
+    def __init__(self, pool, index):
+        super().__init__(name=f'{pool.name}-browser-{index}', daemon=True)
+        self.pool = pool
+        self.index = index
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._page = None
+        self._uses = 0
+
+    def _log(self, message):
+        print(f'[{self.name}] {message}')
+
+    def _launch(self):
+        self._close()
+        self._browser = self._playwright.chromium.launch(headless=self.pool.headless)
+        # 有界面时沿用窗口大小，无头模式使用默认视口
+        viewport = {'width': 1280, 'height': 900} if self.pool.headless else None
+        self._context = self._browser.new_context(viewport=viewport)
+        self._page = self._context.new_page()
+        if self.pool.warmup:
+            self.pool.warmup(self._context, self._page)
+        self._uses = 0
+        self._log('浏览器已预热')
+
+    def _close(self):
+        for obj in (self._context, self._browser):
+            if obj is None:
+                continue
+            try:
+                obj.close()
+            except Exception:
+                pass
+        self._browser = None
+        self._context = None
+        self._page = None
+
+    def _is_healthy(self):
+        try:
+            if not self._browser or not self._browser.is_connected():
+                return False
+            if not self._page or self._page.is_closed():
+                return False
+            return self._page.evaluate('1 + 1') == 2
+        except Exception:
+            return False
+
+    def _ensure_ready(self):
+        if self._is_healthy():
+            return
+        self._log('浏览器不可用，重新启动')
+        self._launch()
+
+    def _reset_page(self):
+        """任务结束后回到初始页面，为下一次发布做好准备"""
+        if self._uses >= self.pool.max_uses:
+            self._log(f'已发布 {self._uses} 次，回收浏览器')
+            self._launch()
+            return
+        try:
+            if self.pool.reset:
+                self.pool.reset(self._context, self._page)
+        except Exception:
+            traceback.print_exc()
+            self._launch()
+
+    def run(self):
+        with sync_playwright() as p:
+            self._playwright = p
+            try:
+                self._launch()
+            except Exception:
+                traceback.print_exc()
+            while True:
+                try:
+                    task = self.pool._tasks.get(timeout=self.pool.health_interval)
+                except queue.Empty:
+                    try:
+                        self._ensure_ready()
+                    except Exception:
+                        traceback.print_exc()
+                    continue
+
+                if task is None:
+                    break
+
+                fn, future = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    self._ensure_ready()
+                    result = fn(self._page, self._context)
+                    self._uses += 1
+                except Exception as e:
+                    future.set_exception(e)
+                    # 出错或被取消后页面状态未知，关闭当前 context 并重建
+                    try:
+                        self._launch()
+                    except Exception:
+                        traceback.print_exc()
+                    continue
+
+                future.set_result(result)
+                self._reset_page()
+
+            self._close()
+
+
+class BrowserPool:
+    """
+    常驻的 Playwright 浏览器池：
+    - 每个槽位保持一个已登录、已打开首页的 context
+    - 空闲时定期做健康检查，崩溃或发布 N 次后自动重建
+    - run(fn) 把一个 fn(page, context) 交给空闲槽位执行并返回结果
+    """
+
+    def __init__(self, name, warmup=None, reset=None, size=BROWSER_POOL_SIZE,
+                 headless=BROWSER_HEADLESS, max_uses=BROWSER_MAX_USES,
+                 health_interval=BROWSER_HEALTH_INTERVAL):
+        self.name = name
+        self.warmup = warmup
+        self.reset = reset
+        self.size = size
+        self.headless = headless
+        self.max_uses = max_uses
+        self.health_interval = health_interval
+        self._tasks = queue.Queue()
+        self._slots = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._slots:
+                return
+            for i in range(self.size):
+                slot = _BrowserSlot(self, i)
+                slot.start()
+                self._slots.append(slot)
+
+    def submit(self, fn):
+        self.start()
+        future = Future()
+        self._tasks.put((fn, future))
+        return future
+
+    def run(self, fn, timeout=BROWSER_TASK_TIMEOUT, cancel_event=None):
+        """
+        执行 fn 并等待结果。cancel_event 被设置时：还在排队的任务直接撤销（抛出 CancelledError）；
+        已经开始的任务需要 fn 自己检查 cancel_event 并尽快结束。
+        超过 timeout 时还在排队的任务撤销并抛出 FutureTimeoutError；已经开始的任务不能丢下不管
+        （它仍可能发布成功），有 cancel_event 时继续等到它结束或在检查点退出，否则抛出 BrowserTaskRunning。
+        """
+        future = self.submit(fn)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if future.cancel():
+                    raise FutureTimeoutError()
+                if cancel_event is None:
+                    raise BrowserTaskRunning(f'浏览器任务超过 {timeout} 秒仍在执行')
+                remaining = BROWSER_CANCEL_POLL_INTERVAL
+            try:
+                return future.result(timeout=min(remaining, BROWSER_CANCEL_POLL_INTERVAL))
+            except FutureTimeoutError:
+                if future.done():
+                    # fn 自己抛出的 TimeoutError
+                    raise
+                if cancel_event is not None and cancel_event.is_set() and future.cancel():
+                    raise CancelledError()
+
+    def shutdown(self, wait_seconds=5):
+        with self._lock:
+            slots = list(self._slots)
+            self._slots = []
+        for _ in slots:
+            self._tasks.put(None)
+        deadline = time.time() + wait_seconds
+        for slot in slots:
+            slot.join(max(0, deadline - time.time()))
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(name, **kwargs):
+    """按名称获取（或创建）进程内唯一的浏览器池"""
+    with _POOLS_LOCK:
+        pool = _POOLS.get(name)
+        if pool is None:
+            pool = BrowserPool(name, **kwargs)
+            _POOLS[name] = pool
+        return pool
+
+
+@atexit.register
+def _shutdown_pools():
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    for pool in pools:
+        pool.shutdown()
@@ -0,0 +1,65 @@
+"""
+基于 SQLite 的键值缓存（带过期时间），进程之间、重启之后都能共享。
+直接使用标准库 sqlite3，不依赖 Flask 应用上下文，services 里的模块都可以用。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CACHE_DB_PATH = os.getenv(
+    'CACHE_DB_PATH',
+    str(Path(__file__).resolve().parent.parent / 'instance' / 'cache.db')
+)
+
+_local = threading.local()
+
+
+def _conn():
+    # sqlite3 连接不能跨线程共享，每个线程各用一个
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(CACHE_DB_PATH), exist_ok=True)
+        conn = sqlite3.connect(CACHE_DB_PATH, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache_entry ('
+            ' namespace TEXT NOT NULL,'
+            ' key TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' PRIMARY KEY (namespace, key))'
+        )
+        _local.conn = conn
+    return conn
+
+
+def get_value(namespace, key):
+    row = _conn().execute(
+        'SELECT value, expires_at FROM cache_entry WHERE namespace = ? AND key = ?',
+        (namespace, key)
+    ).fetchone()
+    if not row:
+        return None
+    value, expires_at = row
+    if expires_at < time.time():
+        delete_value(namespace, key)
+        return None
+    return json.loads(value)
+
+
+def set_value(namespace, key, value, ttl):
+    _conn().execute(
+        'INSERT OR REPLACE INTO cache_entry (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+        (namespace, key, json.dumps(value, ensure_ascii=False), time.time() + ttl)
+    )
+
+
+def delete_value(namespace, key):
+    _conn().execute('DELETE FROM cache_entry WHERE namespace = ? AND key = ?', (namespace, key))
+
+
+def purge_expired():
+    _conn().execute('DELETE FROM cache_entry WHERE expires_at < ?', (time.time(),))
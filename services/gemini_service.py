@@ -1,8 +1,15 @@
 import os
-import requests
+import re
+import hashlib
+import threading
+import time
 import json
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 
+from services import cache_store, http_client
+
 load_dotenv()
 
 # =========================================================================
@@ -18,77 +25,241 @@ MODELS = [
     "gemini-2.5-flash"
 ]
 
-def _call_gemini_api(prompt, system_instruction=None):
+# 对冲请求：主模型 GEMINI_HEDGE_DELAY 秒内没有结果就并行启动下一个模型，取最先返回的有效结果
+# 设为负数则退回逐个尝试
+GEMINI_HEDGE_DELAY = float(os.getenv('GEMINI_HEDGE_DELAY', '2.5'))
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '15'))
+# 延迟和错误率的指数滑动平均系数
+GEMINI_STATS_ALPHA = 0.3
+
+_model_stats = {name: {'latency': 3.0, 'error_rate': 0.0, 'calls': 0} for name in MODELS}
+_stats_lock = threading.Lock()
+_gemini_executor = ThreadPoolExecutor(max_workers=len(MODELS) * 4, thread_name_prefix='gemini')
+
+
+def _record_stats(model_name, latency, ok):
+    with _stats_lock:
+        stats = _model_stats[model_name]
+        stats['latency'] += GEMINI_STATS_ALPHA * (latency - stats['latency'])
+        stats['error_rate'] += GEMINI_STATS_ALPHA * ((0.0 if ok else 1.0) - stats['error_rate'])
+        stats['calls'] += 1
+
+
+def _ordered_models():
+    """按历史表现排序：平均延迟越低、错误率越低越靠前，分数相同时保持 MODELS 的顺序"""
+    with _stats_lock:
+        scores = {
+            name: stats['latency'] * (1 + 4 * stats['error_rate'])
+            for name, stats in _model_stats.items()
+        }
+    return sorted(MODELS, key=lambda name: (scores[name], MODELS.index(name)))
+
+
+def get_model_stats():
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _model_stats.items()}
+
+
+def _call_model(model_name, prompt, system_instruction=None, generation_config=None):
+    """请求单个模型，成功返回文本，失败返回 None"""
     api_key = os.getenv('GEMINI_API_KEY', '')
-    
-    for model_name in MODELS:
-        try:
-            # 这里的 URL 需要包含模型名称和 API KEY
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
-            
-            payload = {
-                "contents": [
-                    {
-                        "parts": [{"text": prompt}]
-                    }
-                ]
-            }
-            
-            # 如果有系统指令，添加到请求中
-            if system_instruction:
-                payload["system_instruction"] = {
-                    "parts": [{"text": system_instruction}]
+    started = time.time()
+    text = None
+    try:
+        # 这里的 URL 需要包含模型名称和 API KEY
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+
+        payload = {
+            "contents": [
+                {
+                    "parts": [{"text": prompt}]
                 }
+            ]
+        }
+
+        # 如果有系统指令，添加到请求中
+        if system_instruction:
+            payload["system_instruction"] = {
+                "parts": [{"text": system_instruction}]
+            }
+        if generation_config:
+            payload["generationConfig"] = generation_config
+
+        headers = {'Content-Type': 'application/json'}
+
+        # 生成请求没有副作用，429 / 5xx 时可以重发
+        response = http_client.post(url, headers=headers, json=payload, timeout=GEMINI_TIMEOUT, retry_post=True)
+
+        if response.status_code == 200:
+            data = response.json()
+            # 按照 Google API 响应结构提取文本
+            if "candidates" in data and len(data["candidates"]) > 0:
+                candidate = data["candidates"][0]
+                if "content" in candidate and "parts" in candidate["content"]:
+                    text = candidate["content"]["parts"][0]["text"]
+        else:
+            print(f"模型 {model_name} 返回错误: {response.status_code} - {response.text}")
+
+    except Exception as e:
+        print(f"模型 {model_name} 请求异常: {e}")
+
+    _record_stats(model_name, time.time() - started, text is not None)
+    return text
+
+
+def _call_gemini_api(prompt, system_instruction=None, generation_config=None):
+    models = _ordered_models()
+
+    if GEMINI_HEDGE_DELAY < 0:
+        for model_name in models:
+            text = _call_model(model_name, prompt, system_instruction, generation_config)
+            if text is not None:
+                return text
+        return None
+
+    deadline = time.time() + GEMINI_TIMEOUT + GEMINI_HEDGE_DELAY * len(models)
+    pending = set()
+    remaining = list(models)
+    while remaining or pending:
+        if remaining:
+            model_name = remaining.pop(0)
+            pending.add(_gemini_executor.submit(_call_model, model_name, prompt, system_instruction, generation_config))
+
+        # 还有备用模型时只等对冲延迟，否则等到整体超时
+        timeout = GEMINI_HEDGE_DELAY if remaining else max(0, deadline - time.time())
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            text = future.result()
+            if text is not None:
+                # 已发出的 HTTP 请求无法中断，只取消还没开始的；落后的结果直接丢弃
+                for other in pending:
+                    other.cancel()
+                return text
+        if time.time() >= deadline:
+            break
 
-            headers = {'Content-Type': 'application/json'}
-            
-            response = requests.post(url, headers=headers, json=payload, timeout=15)
-            
-            if response.status_code == 200:
-                data = response.json()
-                # 按照 Google API 响应结构提取文本
-                if "candidates" in data and len(data["candidates"]) > 0:
-                    candidate = data["candidates"][0]
-                    if "content" in candidate and "parts" in candidate["content"]:
-                        return candidate["content"]["parts"][0]["text"]
-            else:
-                print(f"模型 {model_name} 返回错误: {response.status_code} - {response.text}")
-                continue
-                
-        except Exception as e:
-            print(f"模型 {model_name} 请求异常: {e}")
-            continue
-            
     return None
 
+# 相同内容的结果缓存：内存 LRU + SQLite 持久化，重启后仍然有效
+GEMINI_CACHE_SIZE = int(os.getenv('GEMINI_CACHE_SIZE', '256'))
+GEMINI_CACHE_TTL = int(os.getenv('GEMINI_CACHE_TTL', str(7 * 24 * 3600)))
+GEMINI_CACHE_NAMESPACE = 'gemini'
+
+_memory_cache = OrderedDict()  # key -> (text, expires_at)
+_cache_lock = threading.Lock()
+_inflight = {}  # key -> Future，同一个 key 同时只发一个请求
+
+
+def _cache_key(prompt, system_instruction):
+    # 空白差异不影响结果，归一化后再算哈希
+    normalized = re.sub(r'\s+', ' ', prompt).strip()
+    raw = json.dumps([normalized, system_instruction or ''], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _memory_get(key):
+    with _cache_lock:
+        entry = _memory_cache.get(key)
+        if entry is None:
+            return None
+        text, expires_at = entry
+        if expires_at < time.time():
+            del _memory_cache[key]
+            return None
+        _memory_cache.move_to_end(key)
+        return text
+
+
+def _memory_set(key, text, expires_at):
+    with _cache_lock:
+        _memory_cache[key] = (text, expires_at)
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > GEMINI_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _cache_get(key):
+    text = _memory_get(key)
+    if text is not None:
+        return text
+    try:
+        text = cache_store.get_value(GEMINI_CACHE_NAMESPACE, key)
+    except Exception as e:
+        print(f"读取 Gemini 缓存失败: {e}")
+        return None
+    if text is not None:
+        # 持久化缓存命中，剩余有效期未知，按完整 TTL 放回内存
+        _memory_set(key, text, time.time() + GEMINI_CACHE_TTL)
+    return text
+
+
+def _cache_set(key, text):
+    _memory_set(key, text, time.time() + GEMINI_CACHE_TTL)
+    try:
+        cache_store.set_value(GEMINI_CACHE_NAMESPACE, key, text, GEMINI_CACHE_TTL)
+    except Exception as e:
+        print(f"写入 Gemini 缓存失败: {e}")
+
+
+def _call_gemini_cached(prompt, system_instruction=None):
+    """带缓存的 _call_gemini_api，失败结果（None）不缓存"""
+    key = _cache_key(prompt, system_instruction)
+    text = _memory_get(key)
+    if text is not None:
+        return text
+
+    with _cache_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _inflight[key] = future
+    if not owner:
+        return future.result()
+
+    try:
+        text = _cache_get(key)
+        if text is None:
+            text = _call_gemini_api(prompt, system_instruction)
+            if text is not None:
+                _cache_set(key, text)
+        future.set_result(text)
+        return text
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _cache_lock:
+            _inflight.pop(key, None)
+
+SUGGEST_SYSTEM_INSTRUCTION = "You are a social media expert. Suggest exactly 6 hashtags for the given content: 3 in English and 3 in Chinese. Prefer popular topics that are commonly recognized on platforms like X (Twitter) and Zhihu. Return only the hashtags as a comma-separated list without # symbols. Format: English1, English2, English3, 中文1, 中文2, 中文3"
+DEFAULT_TAGS = ['AI', 'Tech', 'Innovation', '人工智能', '科技', '创新']
+
+def _suggest_prompt(content):
+    return f"Content: {content}"
+
+def _parse_tags(response):
+    # 处理可能包含的原始回复内容 (有时候会带引号或额外的文字)
+    tags = [tag.strip().replace('#', '') for tag in response.split(',') if tag.strip()]
+    # 进一步清理，防止 AI 返回包含 "Here are the hashtags:" 之类的废话
+    clean_tags = []
+    for tag in tags:
+        # 只保留没有空格、不包含“建议”等字样的词
+        if ' ' not in tag and len(tag) < 20:
+            clean_tags.append(tag)
+    return clean_tags[:6]
+
 def suggest_hashtags(content):
     if not content.strip():
         return []
 
-    system_instruction = "You are a social media expert. Suggest exactly 6 hashtags for the given content: 3 in English and 3 in Chinese. Prefer popular topics that are commonly recognized on platforms like X (Twitter) and Zhihu. Return only the hashtags as a comma-separated list without # symbols. Format: English1, English2, English3, 中文1, 中文2, 中文3"
-    prompt = f"Content: {content}"
-    
-    response = _call_gemini_api(prompt, system_instruction)
+    response = _call_gemini_cached(_suggest_prompt(content), SUGGEST_SYSTEM_INSTRUCTION)
     if response:
-        # 处理可能包含的原始回复内容 (有时候会带引号或额外的文字)
-        tags = [tag.strip().replace('#', '') for tag in response.split(',') if tag.strip()]
-        # 进一步清理，防止 AI 返回包含 "Here are the hashtags:" 之类的废话
-        clean_tags = []
-        for tag in tags:
-            # 只保留没有空格、不包含“建议”等字样的词
-            if ' ' not in tag and len(tag) < 20:
-                clean_tags.append(tag)
-        return clean_tags[:6] if clean_tags else ['AI', 'Tech', 'Innovation', '人工智能', '科技', '创新']
+        return _parse_tags(response) or list(DEFAULT_TAGS)
     
-    return ['AI', 'Tech', 'Innovation', '人工智能', '科技', '创新']
+    return list(DEFAULT_TAGS)
 
-def add_tags_to_content(content):
-    """添加tags到内容末尾，不改写原文"""
-    if not content.strip():
-        return content
-    
-    # 获取tags
-    tags = suggest_hashtags(content)
+def _append_tags(content, tags):
     if not tags:
         return content
     
@@ -101,3 +272,102 @@ def add_tags_to_content(content):
     tags_str = " ".join(all_tags)
     
     return f"{content}\n\n{tags_str}"
+
+def add_tags_to_content(content):
+    """添加tags到内容末尾，不改写原文"""
+    if not content.strip():
+        return content
+    
+    # 获取tags
+    tags = suggest_hashtags(content)
+    return _append_tags(content, tags)
+
+# 批量打标签：多条内容打包进一个结构化输出请求（JSON 数组进，JSON 数组出）
+GEMINI_BATCH_SIZE = int(os.getenv('GEMINI_BATCH_SIZE', '10'))
+GEMINI_BATCH_WORKERS = int(os.getenv('GEMINI_BATCH_WORKERS', '4'))
+GEMINI_BATCH_MAX_ITEMS = int(os.getenv('GEMINI_BATCH_MAX_ITEMS', '100'))
+
+BATCH_SYSTEM_INSTRUCTION = "You are a social media expert. You receive a JSON array of posts, each with an integer id and content. For every post, suggest exactly 6 hashtags: 3 in English and 3 in Chinese, English first. Prefer popular topics that are commonly recognized on platforms like X (Twitter) and Zhihu. Hashtags must not contain # symbols or spaces. Return one result per input id."
+BATCH_GENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "id": {"type": "INTEGER"},
+                "hashtags": {"type": "ARRAY", "items": {"type": "STRING"}}
+            },
+            "required": ["id", "hashtags"]
+        }
+    }
+}
+
+# 批量请求在单独的线程池中运行，_call_gemini_api 内部还会用到 _gemini_executor
+_batch_executor = ThreadPoolExecutor(max_workers=GEMINI_BATCH_WORKERS, thread_name_prefix='gemini-batch')
+
+
+def _suggest_chunk(items):
+    """items 为 [(序号, 内容)]，返回 {序号: tags}，解析失败的条目不出现在结果中"""
+    prompt = json.dumps([{"id": i, "content": content} for i, content in items], ensure_ascii=False)
+    response = _call_gemini_api(prompt, BATCH_SYSTEM_INSTRUCTION, BATCH_GENERATION_CONFIG)
+    if not response:
+        return {}
+    try:
+        data = json.loads(response)
+    except ValueError:
+        print(f"批量打标签返回的不是 JSON: {response[:200]}")
+        return {}
+
+    wanted = {i for i, _ in items}
+    result = {}
+    for entry in data if isinstance(data, list) else []:
+        if not isinstance(entry, dict) or entry.get('id') not in wanted:
+            continue
+        tags = _parse_tags(', '.join(str(tag) for tag in entry.get('hashtags') or []))
+        if tags:
+            result[entry['id']] = tags
+    return result
+
+
+def suggest_hashtags_batch(contents):
+    """
+    为多条内容生成 hashtags，返回与 contents 顺序一致的列表。
+    已缓存的条目直接返回，其余每 GEMINI_BATCH_SIZE 条合并成一个请求并发发送；
+    结果按条写入缓存，和 suggest_hashtags 共用。
+    """
+    results = [None] * len(contents)
+    misses = []
+    for i, content in enumerate(contents):
+        if not content.strip():
+            results[i] = []
+            continue
+        cached = _cache_get(_cache_key(_suggest_prompt(content), SUGGEST_SYSTEM_INSTRUCTION))
+        tags = _parse_tags(cached) if cached else []
+        if tags:
+            results[i] = tags
+        else:
+            misses.append(i)
+
+    chunks = [misses[k:k + GEMINI_BATCH_SIZE] for k in range(0, len(misses), GEMINI_BATCH_SIZE)]
+    futures = [_batch_executor.submit(_suggest_chunk, [(i, contents[i]) for i in chunk]) for chunk in chunks]
+    for chunk, future in zip(chunks, futures):
+        try:
+            found = future.result()
+        except Exception as e:
+            print(f"批量打标签失败: {e}")
+            found = {}
+        for i in chunk:
+            tags = found.get(i)
+            if tags:
+                _cache_set(_cache_key(_suggest_prompt(contents[i]), SUGGEST_SYSTEM_INSTRUCTION), ', '.join(tags))
+                results[i] = tags
+            else:
+                results[i] = list(DEFAULT_TAGS)
+    return results
+
+
+def add_tags_to_contents(contents):
+    """批量版 add_tags_to_content，返回 [(新内容, tags)]"""
+    tags_list = suggest_hashtags_batch(contents)
+    return [(_append_tags(content, tags), tags) for content, tags in zip(contents, tags_list)]
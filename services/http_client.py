@@ -0,0 +1,92 @@
+"""
+共享的出站 HTTP 客户端：按主机复用连接池（keep-alive），统一重试和超时。
+services 里访问外部接口都通过这里，避免每次请求重新建立 TCP + TLS 连接。
+"""
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 每个主机的连接池大小（同时保持的连接数）
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+# 429 / 5xx 和连接错误的重试次数，间隔按 HTTP_RETRY_BACKOFF 指数增长，优先遵循 Retry-After
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.5'))
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# 收到 429 / 5xx 时只自动重发幂等的请求；POST 重发可能重复执行（如 X 的 INIT 会建出新的 media_id），
+# 能安全重发的调用方用 retry_post=True 单独打开
+HTTP_IDEMPOTENT_METHODS = Retry.DEFAULT_ALLOWED_METHODS
+# 不遵循 Retry-After 的主机：Gemini 限流时要求的等待可能远超调用方的超时，只按退避间隔重试
+IGNORE_RETRY_AFTER_HOSTS = {'generativelanguage.googleapis.com'}
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+
+# 各接口的读超时（秒），没有列出的主机使用 HTTP_READ_TIMEOUT
+ENDPOINT_READ_TIMEOUTS = {
+    'generativelanguage.googleapis.com': 15,
+    'upload.twitter.com': 60,
+    'api.twitter.com': 30,
+    'api.x.com': 30,
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _build_session(host, retry_post=False):
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,  # 读超时说明请求可能已被处理，不自动重发
+        status=HTTP_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=None if retry_post else HTTP_IDEMPOTENT_METHODS,
+        respect_retry_after_header=host not in IGNORE_RETRY_AFTER_HOSTS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(url, retry_post=False):
+    """返回该 URL 所在主机的共享 Session；retry_post=True 的 Session 在 429 / 5xx 时也重发 POST"""
+    host = urlsplit(url).netloc.lower()
+    key = (host, retry_post)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _build_session(urlsplit(url).hostname or '', retry_post)
+            _sessions[key] = session
+        return session
+
+
+def default_timeout(url):
+    host = urlsplit(url).hostname or ''
+    return (HTTP_CONNECT_TIMEOUT, ENDPOINT_READ_TIMEOUTS.get(host, HTTP_READ_TIMEOUT))
+
+
+def request(method, url, timeout=None, retry_post=False, **kwargs):
+    """
+    和 requests.request 用法相同。timeout 不传时按接口取 (连接超时, 读超时)；
+    只传一个数字时作为读超时。retry_post=True 表示这个 POST 重发也不会重复执行
+    """
+    if timeout is None:
+        timeout = default_timeout(url)
+    elif not isinstance(timeout, tuple):
+        timeout = (HTTP_CONNECT_TIMEOUT, timeout)
+    return get_session(url, retry_post).request(method, url, timeout=timeout, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
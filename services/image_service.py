@@ -0,0 +1,128 @@
+"""
+图片处理：这里的函数都是纯 CPU 计算，会被放到子进程中执行，
+所以只依赖 PIL 和文件路径，不访问数据库和 Flask 对象。
+"""
+import hashlib
+import os
+import threading
+import uuid
+from pathlib import Path
+
+from PIL import Image
+
+# 各平台的图片版本保存在 static/variants，按 内容哈希 + 版本名 命名，同一内容只生成一次
+VARIANT_DIR = Path(__file__).resolve().parent.parent / 'static' / 'variants'
+VARIANT_PROFILES = {
+    # X 图片上限 5MB，长边不超过 4096
+    'x': {'max_size': 4096, 'format': 'JPEG', 'quality': 85, 'max_bytes': 5 * 1024 * 1024},
+    'zhihu': {'max_size': 2048, 'format': 'JPEG', 'quality': 88},
+    'thumb': {'max_size': 400, 'format': 'WEBP', 'quality': 75},
+}
+_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+def resize_image_if_needed(image_path, max_size=1080):
+    """Resize image if any dimension exceeds max_size"""
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+            if width > max_size or height > max_size:
+                ratio = min(max_size / width, max_size / height)
+                new_width = int(width * ratio)
+                new_height = int(height * ratio)
+                resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                if img.mode in ('RGBA', 'P'):
+                    resized = resized.convert('RGB')
+                # 先写临时文件再原子替换，同一张图被重新处理时不会读到半个文件
+                tmp = os.path.join(os.path.dirname(str(image_path)),
+                                   f'.{uuid.uuid4().hex}{os.path.splitext(str(image_path))[1]}')
+                try:
+                    resized.save(tmp, quality=90, optimize=True)
+                    os.replace(tmp, image_path)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                return True
+    except Exception as e:
+        print(f"Resize error: {e}")
+    return False
+
+def file_hash(image_path):
+    """文件内容的 SHA-256，按 (路径, 修改时间, 大小) 缓存"""
+    stat = os.stat(image_path)
+    key = (str(image_path), stat.st_mtime_ns, stat.st_size)
+    with _hash_lock:
+        cached = _hash_cache.get(key)
+    if cached:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    value = digest.hexdigest()
+    with _hash_lock:
+        _hash_cache[key] = value
+    return value
+
+def variant_path(content_hash, profile):
+    ext = _EXTENSIONS[VARIANT_PROFILES[profile]['format']]
+    return VARIANT_DIR / f'{content_hash}_{profile}.{ext}'
+
+def _encode_variant(img, spec, target):
+    img.thumbnail((spec['max_size'], spec['max_size']), Image.Resampling.LANCZOS)
+    if spec['format'] == 'JPEG' and img.mode != 'RGB':
+        # 透明背景铺白，避免 JPEG 转换后变黑
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[-1])
+        img = background
+
+    quality = spec['quality']
+    while True:
+        img.save(target, spec['format'], quality=quality, optimize=True)
+        max_bytes = spec.get('max_bytes')
+        if not max_bytes or os.path.getsize(target) <= max_bytes:
+            return
+        if quality > 50:
+            quality -= 10
+        else:
+            img = img.resize((int(img.width * 0.8), int(img.height * 0.8)), Image.Resampling.LANCZOS)
+
+def get_variant(image_path, profile):
+    """
+    返回图片在某个平台版本的路径，不存在时生成。
+    动图不做转换（X / 知乎都直接支持 GIF），缩略图除外。
+    """
+    target = variant_path(file_hash(image_path), profile)
+    if target.exists():
+        return str(target)
+
+    with Image.open(image_path) as img:
+        if profile != 'thumb' and getattr(img, 'is_animated', False):
+            return str(image_path)
+        VARIANT_DIR.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再原子替换，多个进程同时生成也不会读到半个文件
+        tmp = target.with_name(f'.{uuid.uuid4().hex}{target.suffix}')
+        try:
+            _encode_variant(img.copy(), VARIANT_PROFILES[profile], tmp)
+            os.replace(tmp, target)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+    return str(target)
+
+def build_variants(image_path, profiles=tuple(VARIANT_PROFILES)):
+    for profile in profiles:
+        try:
+            get_variant(image_path, profile)
+        except Exception as e:
+            print(f"Variant error ({profile}): {e}")
+
+def process_upload(image_path, max_size=2048):
+    """上传后的处理入口（在进程池中运行）：缩放后预先生成各平台版本"""
+    resize_image_if_needed(image_path, max_size=max_size)
+    build_variants(image_path)
+    return image_path
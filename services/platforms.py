@@ -0,0 +1,394 @@
+"""
+发布平台适配器注册表和并发调度。
+
+每个平台实现一个 PlatformAdapter 并通过 register() 注册；
+publish_to_platforms 同时向所有选中的平台发布，按完成顺序收集结果，
+每个平台有自己的并发上限和超时，整体耗时取决于最慢的那个平台而不是平台数量。
+"""
+import asyncio
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from services import async_publisher, publisher_service, rate_limiter
+from services.browser_pool import BROWSER_TASK_TIMEOUT, BrowserTaskRunning
+from services.rate_limiter import RateLimited
+
+# 所有发布任务共用的线程池（thread 模式）
+PLATFORM_EXECUTOR_WORKERS = int(os.getenv('PUBLISH_PLATFORM_THREADS', '16'))
+# 取消或超时后最多再等待各平台多少秒到达检查点，超过就不再等待（线程在下一个检查点退出）
+PUBLISH_CANCEL_GRACE = float(os.getenv('PUBLISH_CANCEL_GRACE', '3'))
+# 配置、凭证、文件缺失之类的错误重试也不会成功，不安排重试；
+# 浏览器任务超时仍在执行时结果未知，重试可能重复发布
+NON_RETRYABLE_ERRORS = (ValueError, FileNotFoundError, NotImplementedError, BrowserTaskRunning)
+
+
+class PlatformAdapter:
+    """
+    发布平台适配器。
+    name: 平台标识（与前端、数据库中的平台名一致）
+    label: 进度和结果消息中显示的名称
+    max_concurrency: 同时进行的发布数上限（job_queue 认领任务时跨进程生效，本进程内再用信号量限制）
+    timeout: 单次发布的最长时间（秒），超时按失败处理
+    publish 需要在各步骤之间检查 cancel_event，已取消时抛出 PublishCancelled；
+    成功时返回平台上的内容 ID（取不到时返回 None）
+    rate_key: 限流按 (平台, rate_key()) 计数，多账号的平台返回账号标识
+    """
+    name = ''
+    label = ''
+    max_concurrency = 1
+    timeout = 120
+
+    def rate_key(self):
+        return 'default'
+
+    def publish(self, content, image_paths=None, progress=None, cancel_event=None):
+        raise NotImplementedError
+
+    async def publish_async(self, content, image_paths=None, progress=None, cancel_event=None):
+        # 没有异步实现的平台放到线程里执行
+        return await asyncio.to_thread(self.publish, content, image_paths, progress, cancel_event)
+
+
+class TwitterAdapter(PlatformAdapter):
+    name = 'twitter'
+    label = 'X'
+    max_concurrency = int(os.getenv('PUBLISH_MAX_CONCURRENT_TWITTER', '4'))
+    timeout = int(os.getenv('PUBLISH_TIMEOUT_TWITTER', '120'))
+
+    def rate_key(self):
+        return publisher_service._account_key(publisher_service._get_x_env())
+
+    def publish(self, content, image_paths=None, progress=None, cancel_event=None):
+        return _tweet_id(publisher_service.publish_to_twitter(content, image_paths=image_paths, progress=progress,
+                                                              cancel_event=cancel_event))
+
+    async def publish_async(self, content, image_paths=None, progress=None, cancel_event=None):
+        return _tweet_id(await async_publisher.publish_to_twitter(content, image_paths=image_paths, progress=progress,
+                                                                  cancel_event=cancel_event))
+
+
+def _tweet_id(response):
+    """发推接口的返回（xdk 响应对象或 JSON）里取推文 ID"""
+    data = response.get('data') if isinstance(response, dict) else getattr(response, 'data', None)
+    tweet_id = data.get('id') if isinstance(data, dict) else getattr(data, 'id', None)
+    return str(tweet_id) if tweet_id else None
+
+
+class ZhihuAdapter(PlatformAdapter):
+    name = 'zhihu'
+    label = '知乎'
+    max_concurrency = int(os.getenv('PUBLISH_MAX_CONCURRENT_ZHIHU', '1'))
+    # 包含排队等待浏览器的时间，比浏览器池单次任务的超时略长
+    timeout = int(os.getenv('PUBLISH_TIMEOUT_ZHIHU', str(BROWSER_TASK_TIMEOUT + 20)))
+
+    def publish(self, content, image_paths=None, progress=None, cancel_event=None):
+        return publisher_service.publish_to_zhihu(content, image_paths=image_paths, progress=progress,
+                                                  cancel_event=cancel_event)
+
+    async def publish_async(self, content, image_paths=None, progress=None, cancel_event=None):
+        return await async_publisher.publish_to_zhihu(content, image_paths=image_paths, progress=progress,
+                                                      cancel_event=cancel_event)
+
+
+_REGISTRY = {}
+_semaphores = {}
+_async_semaphores = {}
+_executor = ThreadPoolExecutor(max_workers=PLATFORM_EXECUTOR_WORKERS, thread_name_prefix='platform')
+
+
+def register(adapter):
+    _REGISTRY[adapter.name] = adapter
+    _semaphores[adapter.name] = threading.BoundedSemaphore(adapter.max_concurrency)
+    return adapter
+
+
+def get_adapter(name):
+    return _REGISTRY.get(name)
+
+
+def all_adapters():
+    return list(_REGISTRY.values())
+
+
+register(TwitterAdapter())
+register(ZhihuAdapter())
+
+
+class Retryable:
+    """可以稍后重试的失败，retry_after 为最早可重试的秒数"""
+
+    def __init__(self, message, retry_after=0):
+        self.message = message
+        self.retry_after = retry_after
+
+
+def _failure(e):
+    if isinstance(e, RateLimited):
+        return Retryable(str(e), e.retry_after)
+    if isinstance(e, NON_RETRYABLE_ERRORS):
+        return f'error: {e}'
+    return Retryable(str(e))
+
+
+def _new_results():
+    results = {adapter.name: False for adapter in all_adapters()}
+    results['messages'] = []
+    # 失败但可以重试的平台 -> 最早可重试的秒数，由 job_queue 安排重试
+    results['retry'] = {}
+    # 各平台的结果明细：status、remote_id、latency_ms、error
+    results['details'] = {}
+    return results
+
+
+def _record(results, adapter, outcome, on_result, remote_id=None, latency_ms=None):
+    error = None
+    if isinstance(outcome, Retryable):
+        results['retry'][adapter.name] = outcome.retry_after
+        error = outcome.message
+    elif outcome == 'success':
+        results[adapter.name] = True
+        results['messages'].append(f'{adapter.label} 发布成功')
+    elif outcome == 'cancelled':
+        error = '发布被取消'
+        results['messages'].append(f'{adapter.label} 发布被取消')
+    elif outcome == 'timeout':
+        # 超时后已在检查点停下（或还没开始），没有发出去，可以重试
+        results['retry'][adapter.name] = 0
+        error = f'超过 {adapter.timeout} 秒未完成'
+        latency_ms = adapter.timeout * 1000
+    elif outcome == 'abandoned':
+        # 超时后仍在执行，可能已经发出去，重试会重复发布
+        error = f'超过 {adapter.timeout} 秒未完成，可能仍在发布，不自动重试'
+        latency_ms = adapter.timeout * 1000
+    else:
+        error = outcome.replace('error: ', '')
+    if error and outcome != 'cancelled':
+        results['messages'].append(f'{adapter.label} 发布失败: {error}')
+
+    detail = {
+        'status': 'success' if results[adapter.name] else 'failed',
+        'remote_id': remote_id,
+        'latency_ms': latency_ms,
+        'error': error
+    }
+    results['details'][adapter.name] = detail
+    if on_result:
+        on_result(adapter.name, results[adapter.name], detail)
+
+
+def _select(platforms, results, progress, cancel_event):
+    """解析平台列表；返回 None 表示不需要发布"""
+    adapters = []
+    for name in platforms or []:
+        adapter = get_adapter(name)
+        if adapter is None:
+            results['messages'].append(f'不支持的平台: {name}')
+        elif adapter not in adapters:
+            adapters.append(adapter)
+
+    if not adapters:
+        results['messages'].append('未选择发布平台')
+        return None
+    if cancel_event and cancel_event.is_set():
+        publisher_service._emit(progress, '发布已取消')
+        results['messages'].append('发布已被用户取消')
+        return None
+    return adapters
+
+
+def _elapsed_ms(started):
+    return int((time.perf_counter() - started) * 1000) if started else None
+
+
+def _run_adapter(adapter, content, image_paths, progress, cancel_event, deadline):
+    """返回 (结果, 内容 ID, 耗时毫秒)"""
+    semaphore = _semaphores[adapter.name]
+    if not semaphore.acquire(timeout=max(0, deadline - time.monotonic())):
+        return 'timeout', None, None
+    started = None
+    try:
+        if cancel_event and cancel_event.is_set():
+            return 'cancelled', None, None
+        if not rate_limiter.acquire(adapter.name, adapter.rate_key(), cancel_event):
+            return 'cancelled', None, None
+        publisher_service._emit(progress, f'{adapter.label}: 开始发布')
+        started = time.perf_counter()
+        remote_id = adapter.publish(content, image_paths=image_paths, progress=progress, cancel_event=cancel_event)
+        return 'success', remote_id, _elapsed_ms(started)
+    except publisher_service.PublishCancelled:
+        return 'cancelled', None, _elapsed_ms(started)
+    except Exception as e:
+        if not isinstance(e, RateLimited):
+            traceback.print_exc()
+        return _failure(e), None, _elapsed_ms(started)
+    finally:
+        semaphore.release()
+
+
+def publish_to_platforms(content, platforms, image_paths=None, progress=None, cancel_event=None, on_result=None):
+    """
+    并发发布到多个平台，先完成的先记录结果（on_result(platform, success)）。
+    每个平台有自己的取消事件，cancel_event 被设置时全部设置；平台超时只设置它自己的事件，
+    在 PUBLISH_CANCEL_GRACE 秒内停在检查点的按超时失败并安排重试，
+    仍在执行的不再等待、也不重试（它的线程可能还会发布成功）。
+    """
+    results = _new_results()
+    adapters = _select(platforms, results, progress, cancel_event)
+    if adapters is None:
+        return results
+
+    pending = {}
+    for adapter in adapters:
+        leg_cancel = threading.Event()
+        deadline = time.monotonic() + adapter.timeout
+        future = _executor.submit(_run_adapter, adapter, content, image_paths, progress, leg_cancel, deadline)
+        pending[future] = (adapter, leg_cancel, deadline)
+
+    timed_out = set()
+    cancel_deadline = None
+    while pending:
+        next_deadline = min(deadline for _, _, deadline in pending.values())
+        if cancel_deadline is not None:
+            next_deadline = min(next_deadline, cancel_deadline)
+        timeout = max(0, next_deadline - time.monotonic())
+        if cancel_event is not None and cancel_deadline is None:
+            timeout = min(timeout, publisher_service.CANCEL_POLL_INTERVAL)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            adapter, _, _ = pending.pop(future)
+            outcome, remote_id, latency_ms = future.result()
+            if outcome != 'success' and cancel_event and cancel_event.is_set():
+                outcome = 'cancelled'
+            elif outcome == 'cancelled' and adapter.name in timed_out:
+                outcome = 'timeout'
+            _record(results, adapter, outcome, on_result, remote_id, latency_ms)
+        now = time.monotonic()
+        if cancel_event is not None and cancel_event.is_set() and cancel_deadline is None:
+            cancel_deadline = now + PUBLISH_CANCEL_GRACE
+            for _, leg_cancel, _ in pending.values():
+                leg_cancel.set()
+        for future, (adapter, leg_cancel, deadline) in list(pending.items()):
+            if cancel_deadline is not None and now >= cancel_deadline:
+                # 取消后超过宽限时间仍未退出的平台不再等待
+                future.cancel()
+                pending.pop(future)
+                _record(results, adapter, 'cancelled', on_result)
+            elif now >= deadline and adapter.name not in timed_out:
+                # 超时：让这个平台在下一个检查点停下，停下之后才能安全重试
+                timed_out.add(adapter.name)
+                leg_cancel.set()
+                pending[future] = (adapter, leg_cancel, now + PUBLISH_CANCEL_GRACE)
+            elif now >= deadline:
+                future.cancel()
+                pending.pop(future)
+                _record(results, adapter, 'abandoned', on_result)
+
+    return results
+
+
+def _async_semaphore(adapter):
+    # asyncio 信号量绑定事件循环，在循环内第一次使用时创建
+    semaphore = _async_semaphores.get(adapter.name)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(adapter.max_concurrency)
+        _async_semaphores[adapter.name] = semaphore
+    return semaphore
+
+
+async def _run_adapter_async(adapter, content, image_paths, progress, cancel_event, deadline):
+    """返回 (adapter, 结果, 内容 ID, 耗时毫秒)"""
+    semaphore = _async_semaphore(adapter)
+    # 轮询等待空位，不用 wait_for 包住 acquire，超时和取得许可同时发生时不会漏掉释放
+    while semaphore.locked():
+        if time.monotonic() >= deadline:
+            return adapter, 'timeout', None, None
+        await asyncio.sleep(publisher_service.CANCEL_POLL_INTERVAL)
+    started = None
+    async with semaphore:
+        try:
+            if cancel_event.is_set():
+                return adapter, 'cancelled', None, None
+            if not await rate_limiter.acquire_async(adapter.name, adapter.rate_key(), cancel_event):
+                return adapter, 'cancelled', None, None
+            publisher_service._emit(progress, f'{adapter.label}: 开始发布')
+            started = time.perf_counter()
+            remote_id = await adapter.publish_async(content, image_paths=image_paths, progress=progress,
+                                                    cancel_event=cancel_event)
+            return adapter, 'success', remote_id, _elapsed_ms(started)
+        except publisher_service.PublishCancelled:
+            return adapter, 'cancelled', None, _elapsed_ms(started)
+        except Exception as e:
+            if not isinstance(e, RateLimited):
+                traceback.print_exc()
+            return adapter, _failure(e), None, _elapsed_ms(started)
+
+
+async def publish_to_platforms_async(content, platforms, image_paths=None, progress=None, cancel_event=None,
+                                     on_result=None):
+    """
+    publish_to_platforms 的协程版本。
+    cancel_event 被设置后直接取消各平台的协程：进行中的 httpx 请求立即中断，知乎浏览器被关闭。
+    平台超时不直接取消协程（发推请求或知乎的发布点击可能已经发出），和 thread 模式一样
+    只设置它自己的取消事件：宽限时间内停在检查点的按超时失败并重试，否则取消协程、不重试。
+    """
+    results = _new_results()
+    adapters = _select(platforms, results, progress, cancel_event)
+    if adapters is None:
+        return results
+
+    legs = {}
+    for adapter in adapters:
+        leg_cancel = threading.Event()
+        deadline = time.monotonic() + adapter.timeout
+        task = asyncio.ensure_future(
+            _run_adapter_async(adapter, content, image_paths, progress, leg_cancel, deadline)
+        )
+        legs[task] = [adapter, leg_cancel, deadline]
+    tasks = {task: leg[0] for task, leg in legs.items()}
+    timed_out = set()
+    pending = set(legs)
+    while pending:
+        next_deadline = min(legs[task][2] for task in pending)
+        timeout = min(publisher_service.CANCEL_POLL_INTERVAL, max(0, next_deadline - time.monotonic()))
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            adapter, outcome, remote_id, latency_ms = task.result()
+            if outcome != 'success' and cancel_event and cancel_event.is_set():
+                outcome = 'cancelled'
+            elif outcome == 'cancelled' and task in timed_out:
+                outcome = 'timeout'
+            _record(results, adapter, outcome, on_result, remote_id, latency_ms)
+
+        if pending and cancel_event and cancel_event.is_set():
+            for task in pending:
+                legs[task][1].set()
+                task.cancel()
+            await asyncio.wait(pending)
+            for task in pending:
+                # 取消前刚好完成的平台仍按实际结果记录
+                if not task.cancelled() and task.result()[1] == 'success':
+                    adapter, outcome, remote_id, latency_ms = task.result()
+                    _record(results, adapter, outcome, on_result, remote_id, latency_ms)
+                else:
+                    _record(results, tasks[task], 'cancelled', on_result)
+            pending = set()
+
+        now = time.monotonic()
+        for task in list(pending):
+            adapter, leg_cancel, deadline = legs[task]
+            if now < deadline:
+                continue
+            if task not in timed_out:
+                # 超时：让这个平台在下一个检查点停下，停下之后才能安全重试
+                timed_out.add(task)
+                leg_cancel.set()
+                legs[task][2] = now + PUBLISH_CANCEL_GRACE
+            else:
+                task.cancel()
+                pending.discard(task)
+                _record(results, adapter, 'abandoned', on_result)
+
+    return results
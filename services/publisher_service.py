@@ -1,26 +1,95 @@
+import hashlib
 import io
 import json
+import mimetypes
+import mmap
 import os
-import traceback
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from pathlib import Path
 
 import requests
 from requests_oauthlib import OAuth1 as RequestsOAuth1
 from xdk import Client
 from xdk.oauth1_auth import OAuth1
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 from PIL import Image
 from dotenv import dotenv_values
 
+from services.browser_pool import get_pool
+from services import http_client, rate_limiter
+from services import cache_store
+from services.rate_limiter import RateLimited
+from services.image_service import file_hash, get_variant
+
 COOKIES_FILE = os.getenv('ZHIHU_COOKIES_FILE', 'cookies.json')
 ZHIHU_URL = 'https://www.zhihu.com/'
+# 知乎流程中各步骤的最长等待时间（毫秒）
+ZHIHU_EDITOR_TIMEOUT = int(os.getenv('ZHIHU_EDITOR_TIMEOUT_MS', '10000'))
+ZHIHU_UPLOAD_TIMEOUT = int(os.getenv('ZHIHU_UPLOAD_TIMEOUT_MS', '30000'))
+ZHIHU_PUBLISH_TIMEOUT = int(os.getenv('ZHIHU_PUBLISH_TIMEOUT_MS', '15000'))
+# 图片上传方式：input = 直接写入编辑器的文件输入框（跨平台，默认）；clipboard = Windows 剪贴板粘贴
+ZHIHU_IMAGE_MODE = os.getenv('ZHIHU_IMAGE_MODE', 'input').strip().lower()
+ZHIHU_IMAGE_INPUT_SELECTOR = os.getenv('ZHIHU_IMAGE_INPUT_SELECTOR', 'input[type="file"][accept*="image"]')
+ZHIHU_IMAGE_BUTTON_SELECTOR = os.getenv('ZHIHU_IMAGE_BUTTON_SELECTOR', 'button[aria-label="图片"]')
 ENV_PATH = Path(__file__).resolve().parent.parent / '.env'
 _ENV_CACHE = None
 
+# X 图片并行上传的线程数（所有发布任务共用）
+X_MEDIA_UPLOAD_WORKERS = int(os.getenv('X_MEDIA_UPLOAD_WORKERS', '4'))
+# 已上传图片的 media_id 按内容哈希缓存，X 默认 24 小时后过期，提前一些失效
+X_MEDIA_CACHE_NAMESPACE = 'x_media'
+X_MEDIA_DEFAULT_TTL = 24 * 3600
+X_MEDIA_TTL_MARGIN = 600
+X_MEDIA_UPLOAD_URL = 'https://upload.twitter.com/1.1/media/upload.json'
+# 上传方式：auto = GIF 和大文件分段上传，其余一次上传；simple / chunked 强制使用某一种
+X_MEDIA_UPLOAD_MODE = os.getenv('X_MEDIA_UPLOAD_MODE', 'auto').strip().lower()
+X_MEDIA_CHUNKED_THRESHOLD = int(os.getenv('X_MEDIA_CHUNKED_THRESHOLD', str(1024 * 1024)))
+# 每段大小，X 限制单段不超过 5MB
+X_MEDIA_SEGMENT_SIZE = min(int(os.getenv('X_MEDIA_SEGMENT_SIZE', str(1024 * 1024))), 5 * 1024 * 1024)
+X_MEDIA_SEGMENT_RETRIES = 3
+
+_media_executor = ThreadPoolExecutor(max_workers=X_MEDIA_UPLOAD_WORKERS, thread_name_prefix='x-media')
+_oauth_cache = {}
+
+# 取消检查间隔（秒）：长时间的等待拆成小段，每段之间检查一次是否已取消
+CANCEL_POLL_INTERVAL = float(os.getenv('PUBLISH_CANCEL_POLL_INTERVAL', '0.2'))
+CANCEL_SLICE_MS = max(50, int(CANCEL_POLL_INTERVAL * 1000))
+
+class PublishCancelled(Exception):
+    """发布过程中检测到用户取消"""
+
+    def __init__(self, message='发布已被用户取消'):
+        super().__init__(message)
+
 def _emit(progress, message):
     if progress:
         progress(message)
 
+def _checkpoint(cancel_event):
+    """取消检查点：已取消时抛出 PublishCancelled"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise PublishCancelled()
+
+def _wait_future(future, cancel_event=None):
+    """等待 future，期间响应取消；取消后不再等待（还在进行的 HTTP 请求结果直接丢弃）"""
+    if cancel_event is None:
+        return future.result()
+    while True:
+        try:
+            return future.result(timeout=CANCEL_POLL_INTERVAL)
+        except FutureTimeoutError:
+            if cancel_event.is_set():
+                future.cancel()
+                raise PublishCancelled()
+
+def _cancellable_sleep(seconds, cancel_event=None):
+    if cancel_event is None:
+        time.sleep(seconds)
+    elif cancel_event.wait(seconds):
+        raise PublishCancelled()
+
 def _load_env_file():
     global _ENV_CACHE
     if _ENV_CACHE is not None:
@@ -60,27 +129,147 @@ def _get_x_env():
         'callback_url': callback_url
     }
 
-def _upload_media_v1(image_path, creds):
-    url = 'https://upload.twitter.com/1.1/media/upload.json'
-    oauth = RequestsOAuth1(
-        client_key=creds['api_key'],
-        client_secret=creds['api_key_secret'],
-        resource_owner_key=creds['access_token'],
-        resource_owner_secret=creds['access_token_secret']
-    )
+def _platform_image(image_path, profile):
+    """取平台专用的图片版本（已缓存则直接复用），失败时退回原图"""
+    try:
+        return get_variant(image_path, profile)
+    except Exception as e:
+        print(f'图片版本生成失败 ({profile}): {e}')
+        return image_path
+
+def _get_oauth(creds):
+    key = (creds['api_key'], creds['access_token'])
+    oauth = _oauth_cache.get(key)
+    if oauth is None:
+        oauth = RequestsOAuth1(
+            client_key=creds['api_key'],
+            client_secret=creds['api_key_secret'],
+            resource_owner_key=creds['access_token'],
+            resource_owner_secret=creds['access_token_secret']
+        )
+        _oauth_cache[key] = oauth
+    return oauth
 
+def _upload_media_v1(image_path, creds):
+    """上传一张图片，返回 (media_id, 有效期秒数)"""
     with open(image_path, 'rb') as f:
         files = {'media': f}
-        response = requests.post(url, auth=oauth, files=files, timeout=60)
+        response = http_client.post(X_MEDIA_UPLOAD_URL, auth=_get_oauth(creds), files=files)
 
-    if response.status_code >= 400:
-        raise RuntimeError(f'媒体上传失败: {response.status_code} {response.text}')
-
-    data = response.json()
+    data = _check_media_response(response, 'UPLOAD', creds)
     media_id = data.get('media_id_string')
     if not media_id:
         raise RuntimeError(f'未获取到 media_id: {data}')
 
+    return media_id, data.get('expires_after_secs')
+
+def _account_key(creds):
+    """限流和缓存按账号区分，不直接使用 token 本身"""
+    return hashlib.sha256(creds['access_token'].encode('utf-8')).hexdigest()[:16]
+
+def _check_rate_limit(response, creds):
+    until = rate_limiter.observe('twitter', _account_key(creds), response.headers, response.status_code)
+    if response.status_code == 429:
+        retry_after = max(1, (until or time.time()) - time.time())
+        raise RateLimited(f'X 接口限流，{time.strftime("%H:%M:%S", time.localtime(until))} 后重置', retry_after)
+
+def _check_media_response(response, step, creds=None):
+    if creds is not None:
+        _check_rate_limit(response, creds)
+    if response.status_code >= 400:
+        raise RuntimeError(f'媒体上传失败 ({step}): {response.status_code} {response.text}')
+    return response.json() if response.content else {}
+
+def _append_segment(media_id, index, segment, creds, progress=None, cancel_event=None):
+    """上传一段，失败只重试这一段（这里自己重试，不再叠加 http_client 的自动重发）"""
+    for attempt in range(1, X_MEDIA_SEGMENT_RETRIES + 1):
+        try:
+            response = http_client.post(
+                X_MEDIA_UPLOAD_URL, auth=_get_oauth(creds),
+                data={'command': 'APPEND', 'media_id': media_id, 'segment_index': index},
+                files={'media': ('segment', segment)}
+            )
+            _check_media_response(response, 'APPEND', creds)
+            return
+        except (requests.RequestException, RuntimeError) as e:
+            if attempt == X_MEDIA_SEGMENT_RETRIES:
+                raise RuntimeError(f'第 {index + 1} 段上传失败: {e}')
+            _emit(progress, f'X: 第 {index + 1} 段上传失败，重试 ({attempt}/{X_MEDIA_SEGMENT_RETRIES - 1})')
+            _cancellable_sleep(attempt, cancel_event)
+
+def _upload_media_chunked(image_path, creds, progress=None, cancel_event=None):
+    """
+    分段上传（INIT / APPEND / FINALIZE），返回 (media_id, 有效期秒数)。
+    文件通过 mmap 按段读取，内存占用不超过一段的大小；动图会轮询处理状态直到可用。
+    """
+    oauth = _get_oauth(creds)
+    total_bytes = os.path.getsize(image_path)
+    if total_bytes == 0:
+        raise RuntimeError(f'图片为空: {image_path}')
+    media_type = mimetypes.guess_type(image_path)[0] or 'image/jpeg'
+    media_category = 'tweet_gif' if media_type == 'image/gif' else 'tweet_image'
+
+    data = _check_media_response(http_client.post(
+        X_MEDIA_UPLOAD_URL, auth=oauth,
+        data={'command': 'INIT', 'total_bytes': total_bytes,
+              'media_type': media_type, 'media_category': media_category}
+    ), 'INIT', creds)
+    media_id = data['media_id_string']
+
+    with open(image_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for index, offset in enumerate(range(0, total_bytes, X_MEDIA_SEGMENT_SIZE)):
+            _checkpoint(cancel_event)
+            _append_segment(media_id, index, mapped[offset:offset + X_MEDIA_SEGMENT_SIZE], creds, progress, cancel_event)
+    _checkpoint(cancel_event)
+
+    # FINALIZE 重复提交结果相同，可以自动重发
+    data = _check_media_response(http_client.post(
+        X_MEDIA_UPLOAD_URL, auth=oauth,
+        data={'command': 'FINALIZE', 'media_id': media_id},
+        retry_post=True
+    ), 'FINALIZE', creds)
+
+    processing = data.get('processing_info')
+    while processing and processing.get('state') in ('pending', 'in_progress'):
+        _emit(progress, f'X: 等待媒体处理 {processing.get("progress_percent", 0)}%')
+        _cancellable_sleep(processing.get('check_after_secs', 1), cancel_event)
+        data = _check_media_response(http_client.get(
+            X_MEDIA_UPLOAD_URL, auth=oauth,
+            params={'command': 'STATUS', 'media_id': media_id}
+        ), 'STATUS', creds)
+        processing = data.get('processing_info')
+    if processing and processing.get('state') == 'failed':
+        raise RuntimeError(f'媒体处理失败: {processing.get("error")}')
+
+    return media_id, data.get('expires_after_secs')
+
+def _upload_media(image_path, creds, progress=None, cancel_event=None):
+    if X_MEDIA_UPLOAD_MODE == 'chunked':
+        chunked = True
+    elif X_MEDIA_UPLOAD_MODE == 'simple':
+        chunked = False
+    else:
+        chunked = image_path.lower().endswith('.gif') or os.path.getsize(image_path) > X_MEDIA_CHUNKED_THRESHOLD
+    if chunked:
+        return _upload_media_chunked(image_path, creds, progress, cancel_event)
+    return _upload_media_v1(image_path, creds)
+
+def _upload_media_cached(image_path, creds, progress=None, cancel_event=None):
+    """同一账号上传过的相同图片直接复用 media_id，重试和重新发布都不必再传"""
+    name = os.path.basename(image_path)
+    key = f'{_account_key(creds)}:{file_hash(image_path)}'
+
+    media_id = cache_store.get_value(X_MEDIA_CACHE_NAMESPACE, key)
+    if media_id:
+        _emit(progress, f'X: 复用已上传的图片 {name}')
+        return media_id
+
+    _emit(progress, f'X: 上传图片 {name}')
+    _checkpoint(cancel_event)
+    media_id, expires_after = _upload_media(image_path, creds, progress, cancel_event)
+    ttl = (expires_after or X_MEDIA_DEFAULT_TTL) - X_MEDIA_TTL_MARGIN
+    if ttl > 0:
+        cache_store.set_value(X_MEDIA_CACHE_NAMESPACE, key, media_id, ttl)
     return media_id
 
 def _get_xdk_client(creds):
@@ -91,40 +280,65 @@ def _get_xdk_client(creds):
         creds['access_token'],
         creds['access_token_secret']
     )
-    return Client(auth=oauth1)
+    client = Client(auth=oauth1)
+    # 记录 xdk 请求返回的 x-rate-limit-* 响应头
+    account = _account_key(creds)
+    client.session.hooks['response'].append(
+        lambda response, *args, **kwargs: rate_limiter.observe('twitter', account, response.headers, response.status_code)
+    )
+    return client
 
-def publish_to_twitter(content, image_paths=None, progress=None):
+def publish_to_twitter(content, image_paths=None, progress=None, cancel_event=None):
     creds = _get_x_env()
     _emit(progress, 'X: 初始化客户端')
     client = _get_xdk_client(creds)
 
-    media_ids = []
+    upload_paths = []
     for image_path in image_paths or []:
         if not image_path:
             continue
         if not os.path.exists(image_path):
             _emit(progress, f'X: 未找到图片 {image_path}')
             continue
-        _emit(progress, f'X: 上传图片 {os.path.basename(image_path)}')
-        media_ids.append(_upload_media_v1(image_path, creds))
+        upload_paths.append(_platform_image(image_path, 'x'))
+
+    _checkpoint(cancel_event)
+    # 多张图片并行上传，按提交顺序取结果，保证 media_id 的顺序和图片顺序一致
+    futures = [
+        _media_executor.submit(_upload_media_cached, path, creds, progress, cancel_event)
+        for path in upload_paths
+    ]
+    try:
+        media_ids = [_wait_future(future, cancel_event) for future in futures]
+    except PublishCancelled:
+        for future in futures:
+            future.cancel()
+        raise
 
     body = {'text': content}
     if media_ids:
         body['media'] = {'media_ids': media_ids}
 
+    # 发出推文之后就无法撤回，这里是最后一个取消检查点
+    _checkpoint(cancel_event)
     _emit(progress, 'X: 发送内容')
-    response = client.posts.create(body=body)
+    try:
+        response = client.posts.create(body=body)
+    except requests.HTTPError as e:
+        if e.response is not None:
+            _check_rate_limit(e.response, creds)
+        raise
     _emit(progress, 'X: 发布完成')
     return response
 
-def _load_cookies(context, progress=None):
+def _read_cookies():
     if not os.path.exists(COOKIES_FILE):
         raise FileNotFoundError(f'未找到 {COOKIES_FILE}')
 
     with open(COOKIES_FILE, 'r', encoding='utf-8') as f:
         raw_cookies = json.load(f)
 
-    cookies = [{
+    return [{
         'name': c['name'],
         'value': c['value'],
         'domain': c['domain'],
@@ -134,16 +348,20 @@ def _load_cookies(context, progress=None):
         'secure': c.get('secure', False)
     } for c in raw_cookies]
 
-    context.add_cookies(cookies)
+def _write_cookies(cookies):
+    with open(COOKIES_FILE, 'w', encoding='utf-8') as f:
+        json.dump(cookies, f, indent=2, ensure_ascii=False)
+
+def _load_cookies(context, progress=None):
+    context.add_cookies(_read_cookies())
     _emit(progress, '知乎: Cookies 已加载')
 
 def _save_cookies(context, progress=None):
-    cookies = context.cookies()
-    with open(COOKIES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cookies, f, indent=2, ensure_ascii=False)
+    _write_cookies(context.cookies())
     _emit(progress, '知乎: Cookies 已保存')
 
 def _copy_image_to_clipboard(image_path, progress=None):
+    """将图片复制到剪贴板（Windows 专用，仅在 ZHIHU_IMAGE_MODE=clipboard 时使用）"""
     absolute_path = Path(image_path).resolve()
     img = Image.open(absolute_path)
     output = io.BytesIO()
@@ -160,50 +378,124 @@ def _copy_image_to_clipboard(image_path, progress=None):
 
 import re
 
+# 图片上传、发布想法对应的接口，用于判断这一步是否真正完成
+ZHIHU_UPLOAD_URL_PATTERN = re.compile(os.getenv('ZHIHU_UPLOAD_URL_PATTERN', r'api\.zhihu\.com/images|zhimg\.com/upload'))
+ZHIHU_PUBLISH_URL_PATTERN = re.compile(os.getenv('ZHIHU_PUBLISH_URL_PATTERN', r'/api/v4/(pins|content/publish)'))
+
 def _remove_hashtags(text):
     """移除文本中的 hashtag (#话题)"""
     return re.sub(r'#\S+', '', text).strip()
 
-def _post_idea(page, content, image_paths, progress=None):
-    _emit(progress, '知乎: 打开想法输入框')
-    page.get_by_text('分享此刻的想法').click()
-    page.wait_for_timeout(1500)
+@contextmanager
+def _timed_step(progress, label):
+    """记录一个步骤的耗时，写入进度日志"""
+    start = time.perf_counter()
+    yield
+    elapsed = (time.perf_counter() - start) * 1000
+    _emit(progress, f'{label}，耗时 {elapsed:.0f}ms')
 
-    _emit(progress, '知乎: 填写内容')
-    # 过滤掉 hashtag
-    clean_content = _remove_hashtags(content)
-    editor = page.get_by_role('textbox').nth(1)
-    editor.fill(clean_content)
-    # 给编辑器一点时间渲染
-    page.wait_for_timeout(500)
+def _is_upload_response(response):
+    return response.request.method == 'POST' and bool(ZHIHU_UPLOAD_URL_PATTERN.search(response.url))
 
-    # 尝试关闭知乎的 hashtag 联想下拉（避免遮挡发布按钮）
+def _is_publish_response(response):
+    return response.request.method == 'POST' and bool(ZHIHU_PUBLISH_URL_PATTERN.search(response.url))
+
+def _wait_response(page, predicate, action, timeout, progress=None, label=''):
+    """执行 action 并等待匹配的网络响应；超时只记录日志，不中断流程"""
     try:
-        page.keyboard.press('Escape')
-        page.wait_for_timeout(200)
-    except Exception:
-        # 如果 Esc 失败，不影响后续流程
-        pass
+        with page.expect_response(predicate, timeout=timeout) as info:
+            action()
+        return info.value
+    except PlaywrightTimeoutError:
+        _emit(progress, f'{label}: 等待响应超时 ({timeout}ms)，继续')
+        return None
+
+def _sliced_wait(wait, timeout, cancel_event=None):
+    """
+    把一次 Playwright 等待拆成 CANCEL_SLICE_MS 的小段，每段之间检查取消。
+    wait(timeout) 超时抛 PlaywrightTimeoutError；总时长超过 timeout 时同样抛出。
+    """
+    if cancel_event is None:
+        return wait(timeout)
+    deadline = time.monotonic() + timeout / 1000
+    while True:
+        _checkpoint(cancel_event)
+        remaining = int((deadline - time.monotonic()) * 1000)
+        if remaining <= 0:
+            raise PlaywrightTimeoutError(f'Timeout {timeout}ms exceeded.')
+        try:
+            return wait(min(remaining, CANCEL_SLICE_MS))
+        except PlaywrightTimeoutError:
+            continue
 
-    if image_paths:
-        for img_path in image_paths:
-            if img_path and os.path.exists(img_path):
-                _emit(progress, f'知乎: 处理图片 {os.path.basename(img_path)}')
-                _copy_image_to_clipboard(img_path, progress)
-                editor.focus()
-                page.wait_for_timeout(300)
-                page.keyboard.press('Control+V')
-                # 等待图片粘贴完成，时间不宜过长以加快整体发布速度
-                page.wait_for_timeout(3000)
+def _wait_uploads(page, count, action, progress=None, cancel_event=None):
+    """执行 action 后等待 count 个图片上传请求全部返回"""
+    uploaded = []
 
-    _emit(progress, '知乎: 点击发布')
-    # 再次尝试关闭可能遮挡按钮的浮层（如 hashtag 下拉、提示条等）
+    def on_response(response):
+        if _is_upload_response(response):
+            uploaded.append(response)
+
+    page.on('response', on_response)
+    try:
+        action()
+        deadline = time.monotonic() + ZHIHU_UPLOAD_TIMEOUT / 1000
+        while len(uploaded) < count:
+            _checkpoint(cancel_event)
+            remaining = int((deadline - time.monotonic()) * 1000)
+            if remaining <= 0:
+                raise PlaywrightTimeoutError('upload timeout')
+            try:
+                page.wait_for_event('response', _is_upload_response,
+                                    timeout=min(remaining, CANCEL_SLICE_MS) if cancel_event else remaining)
+            except PlaywrightTimeoutError:
+                # 分段等待时单段超时只是为了检查取消，总超时由 deadline 判断
+                if cancel_event is None:
+                    raise
+    except PlaywrightTimeoutError:
+        _emit(progress, f'知乎: 已确认 {len(uploaded)}/{count} 张图片上传，等待超时 ({ZHIHU_UPLOAD_TIMEOUT}ms)，继续')
+    finally:
+        page.remove_listener('response', on_response)
+
+    failed = [r for r in uploaded if r.status >= 400]
+    if failed:
+        raise RuntimeError(f'知乎图片上传失败: {failed[0].status}')
+
+def _attach_images(page, image_paths, progress=None, cancel_event=None):
+    """把所有图片一次性交给编辑器的文件输入框，不经过系统剪贴板"""
+    files = [str(Path(p).resolve()) for p in image_paths]
+
+    def action():
+        file_input = page.locator(ZHIHU_IMAGE_INPUT_SELECTOR)
+        if file_input.count() > 0:
+            file_input.first.set_input_files(files)
+            return
+        # 页面上还没有文件输入框时，点击图片按钮拿到文件选择器
+        with page.expect_file_chooser(timeout=ZHIHU_EDITOR_TIMEOUT) as chooser_info:
+            page.locator(ZHIHU_IMAGE_BUTTON_SELECTOR).first.click()
+        chooser_info.value.set_files(files)
+
+    _wait_uploads(page, len(files), action, progress, cancel_event)
+
+def _paste_images_via_clipboard(page, editor, image_paths, progress=None, cancel_event=None):
+    for img_path in image_paths:
+        _checkpoint(cancel_event)
+        name = os.path.basename(img_path)
+        _emit(progress, f'知乎: 处理图片 {name}')
+        with _timed_step(progress, f'知乎: 图片 {name} 上传完成'):
+            _copy_image_to_clipboard(img_path, progress)
+            editor.focus()
+            _wait_uploads(page, 1, lambda: page.keyboard.press('Control+V'), progress, cancel_event)
+
+def _dismiss_popups(page):
+    # 尝试关闭知乎的 hashtag 联想下拉（避免遮挡发布按钮）
     try:
         page.keyboard.press('Escape')
-        page.wait_for_timeout(200)
     except Exception:
+        # 如果 Esc 失败，不影响后续流程
         pass
 
+def _click_publish(page):
     try:
         # 优先按无障碍角色定位按钮，使用 force 避免前景小元素拦截点击
         page.get_by_role('button', name='发布').click(timeout=5000, force=True)
@@ -217,125 +509,106 @@ def _post_idea(page, content, image_paths, progress=None):
                 page.keyboard.press('Control+Enter')
             except Exception:
                 pass
-    # 等待发布过程完成
-    page.wait_for_timeout(1500)
-    
+
+def _post_idea(page, content, image_paths, progress=None, cancel_event=None):
+    _checkpoint(cancel_event)
+    _emit(progress, '知乎: 打开想法输入框')
+    with _timed_step(progress, '知乎: 编辑器就绪'):
+        _sliced_wait(lambda t: page.get_by_text('分享此刻的想法').click(timeout=t), ZHIHU_EDITOR_TIMEOUT, cancel_event)
+        editor = page.get_by_role('textbox').nth(1)
+        _sliced_wait(lambda t: editor.wait_for(state='visible', timeout=t), ZHIHU_EDITOR_TIMEOUT, cancel_event)
+
+    _checkpoint(cancel_event)
+    _emit(progress, '知乎: 填写内容')
+    with _timed_step(progress, '知乎: 内容已填写'):
+        # 过滤掉 hashtag
+        clean_content = _remove_hashtags(content)
+        editor.fill(clean_content)
+        _dismiss_popups(page)
+
+    image_paths = [p for p in (image_paths or []) if p and os.path.exists(p)]
+    if image_paths:
+        if ZHIHU_IMAGE_MODE == 'clipboard':
+            _paste_images_via_clipboard(page, editor, image_paths, progress, cancel_event)
+        else:
+            _emit(progress, f'知乎: 上传 {len(image_paths)} 张图片')
+            with _timed_step(progress, f'知乎: {len(image_paths)} 张图片上传完成'):
+                _attach_images(page, image_paths, progress, cancel_event)
+
+    # 点击发布之后就无法撤回，这里是最后一个取消检查点
+    _checkpoint(cancel_event)
+    _emit(progress, '知乎: 点击发布')
+    # 再次尝试关闭可能遮挡按钮的浮层（如 hashtag 下拉、提示条等）
+    _dismiss_popups(page)
+    with _timed_step(progress, '知乎: 发布请求完成'):
+        response = _wait_response(
+            page, _is_publish_response, lambda: _click_publish(page),
+            ZHIHU_PUBLISH_TIMEOUT, progress, '知乎: 发布'
+        )
+    if response is not None and response.status >= 400:
+        raise RuntimeError(f'知乎发布接口返回 {response.status}')
+
     _emit(progress, '知乎: 发布完成')
+    if response is None:
+        return None
+    try:
+        return _pin_id(response.json())
+    except Exception:
+        return None
+
+def _pin_id(data):
+    """从发布接口返回的 JSON 里取想法 ID，取不到时返回 None"""
+    pin_id = data.get('id') if isinstance(data, dict) else None
+    return str(pin_id) if pin_id else None
+
+def _warm_zhihu_page(context, page):
+    """浏览器槽位启动时调用：先注入 cookies 再打开首页，省掉一次 reload"""
+    if os.path.exists(COOKIES_FILE):
+        _load_cookies(context)
+    page.goto(ZHIHU_URL)
+    page.wait_for_load_state('domcontentloaded')
+
+def _reset_zhihu_page(context, page):
+    """每次发布结束后回到首页，下一次发布可以直接开始输入"""
+    page.goto(ZHIHU_URL)
+    page.wait_for_load_state('domcontentloaded')
+
+def _get_zhihu_pool():
+    return get_pool('zhihu', warmup=_warm_zhihu_page, reset=_reset_zhihu_page)
+
+def start_zhihu_pool():
+    """提前启动知乎浏览器池（预热登录态）"""
+    _get_zhihu_pool().start()
 
-def publish_to_zhihu(content, image_paths=None, progress=None):
+def publish_to_zhihu(content, image_paths=None, progress=None, cancel_event=None):
     # 收集多个图片路径
-    valid_image_paths = [p for p in (image_paths or []) if p and os.path.exists(p)]
+    valid_image_paths = [_platform_image(p, 'zhihu') for p in (image_paths or []) if p and os.path.exists(p)]
 
-    _emit(progress, '知乎: 启动浏览器')
-    browser = None
+    def task(page, context):
+        _emit(progress, '知乎: 已获取预热的浏览器')
+        pin_id = _post_idea(page, content, valid_image_paths, progress, cancel_event)
+        _save_cookies(context, progress)
+        return pin_id
+
+    _checkpoint(cancel_event)
+    _emit(progress, '知乎: 等待浏览器')
     try:
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=False)
-            context = browser.new_context(viewport=None)
-
-            page = context.new_page()
-
-            # 参考 zhihu_post.py 的流程：先打开首页 -> 加载 cookies -> 刷新 -> 发布
-            _emit(progress, '知乎: 打开首页')
-            page.goto(ZHIHU_URL)
-            page.wait_for_timeout(1500)
-
-            if os.path.exists(COOKIES_FILE):
-                _load_cookies(context, progress)
-                _emit(progress, '知乎: 刷新页面以应用 Cookies')
-                page.reload()
-                page.wait_for_timeout(2000)
-
-            _post_idea(page, content, valid_image_paths, progress)
-            _save_cookies(context, progress)
-            
-        return True
+        # 取消后浏览器槽位会丢弃当前页面并重建 context
+        return _get_zhihu_pool().run(task, cancel_event=cancel_event)
+    except CancelledError:
+        raise PublishCancelled()
+    except PublishCancelled:
+        raise
     except Exception as e:
         _emit(progress, f'知乎: 发布出错 - {str(e)}')
         raise
-    finally:
-        if browser:
-            try:
-                browser.close()
-            except:
-                pass
 
-import concurrent.futures
-
-def publish_to_both(content, platforms, image_paths=None, progress=None, cancel_event=None):
+def publish_to_both(content, platforms, image_paths=None, progress=None, cancel_event=None, on_result=None):
     """
-    同时发布到多个平台（并行处理）
+    同时发布到多个平台（并行处理），保留给旧调用方；调度逻辑在 services.platforms 中
     cancel_event: threading.Event, 可用于取消发布
+    on_result: 每个平台有结果时回调 on_result(platform, success)，用于及时持久化
     """
-    results = {'twitter': False, 'zhihu': False, 'messages': []}
-    platforms_set = set(platforms or [])
-    
-    if not platforms_set:
-        results['messages'].append('未选择发布平台')
-        return results
-    
-    # 检查是否已取消
-    if cancel_event and cancel_event.is_set():
-        _emit(progress, '发布已取消')
-        results['messages'].append('发布已被用户取消')
-        return results
-    
-    # 定义每个平台的发布任务
-    def publish_twitter_task():
-        try:
-            if cancel_event and cancel_event.is_set():
-                return 'cancelled'
-            _emit(progress, 'X: 开始发布')
-            publish_to_twitter(content, image_paths=image_paths, progress=progress)
-            return 'success'
-        except Exception as e:
-            traceback.print_exc()
-            return f'error: {e}'
-    
-    def publish_zhihu_task():
-        try:
-            if cancel_event and cancel_event.is_set():
-                return 'cancelled'
-            _emit(progress, '知乎: 开始发布')
-            publish_to_zhihu(content, image_paths=image_paths, progress=progress)
-            return 'success'
-        except Exception as e:
-            traceback.print_exc()
-            return f'error: {e}'
-    
-    # 使用线程池并行发布
-    tasks = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        if 'twitter' in platforms_set:
-            tasks['twitter'] = executor.submit(publish_twitter_task)
-        if 'zhihu' in platforms_set:
-            tasks['zhihu'] = executor.submit(publish_zhihu_task)
-        
-        # 等待所有任务完成
-        for platform, future in tasks.items():
-            try:
-                # 检查是否被取消
-                if cancel_event and cancel_event.is_set():
-                    _emit(progress, f'{platform}: 发布被取消')
-                    results[platform] = False
-                    results['messages'].append(f'{platform} 发布被取消')
-                    continue
-                    
-                result = future.result()
-                
-                if result == 'success':
-                    results[platform] = True
-                    results['messages'].append(f'{"X" if platform == "twitter" else "知乎"} 发布成功')
-                elif result == 'cancelled':
-                    results[platform] = False
-                    results['messages'].append(f'{"X" if platform == "twitter" else "知乎"} 发布被取消')
-                else:
-                    results[platform] = False
-                    error_msg = result.replace('error: ', '')
-                    results['messages'].append(f'{"X" if platform == "twitter" else "知乎"} 发布失败: {error_msg}')
-                    
-            except Exception as e:
-                results[platform] = False
-                results['messages'].append(f'{"X" if platform == "twitter" else "知乎"} 发布失败: {e}')
-    
-    return results
+    from services.platforms import publish_to_platforms
+    return publish_to_platforms(content, platforms, image_paths=image_paths, progress=progress,
+                                cancel_event=cancel_event, on_result=on_result)
@@ -0,0 +1,158 @@
+"""
+按平台 + 账号的令牌桶限流。
+
+- 每个 (平台, 账号) 一个令牌桶，按 RATE_LIMIT_* 配置的速率补充，允许少量突发
+- X 接口返回的 x-rate-limit-* 响应头（以及 429）会把该账号封锁到重置时间，
+  封锁时间写入 cache_store，多个进程共享
+- 需要等待的时间超过 RATE_LIMIT_MAX_WAIT 时抛出 RateLimited，由任务队列安排稍后重试，不占着 worker 干等
+"""
+import asyncio
+import os
+import threading
+import time
+
+from services import cache_store
+
+# 每小时最多发布次数、允许的突发数
+RATE_LIMITS = {
+    'twitter': (float(os.getenv('RATE_LIMIT_TWITTER_PER_HOUR', '50')), int(os.getenv('RATE_LIMIT_TWITTER_BURST', '5'))),
+    'zhihu': (float(os.getenv('RATE_LIMIT_ZHIHU_PER_HOUR', '20')), int(os.getenv('RATE_LIMIT_ZHIHU_BURST', '2'))),
+}
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '30'))
+# 429 但没有给出重置时间时的默认封锁时长（秒）
+RATE_LIMIT_DEFAULT_BLOCK = 60
+RATE_LIMIT_POLL_INTERVAL = 0.2
+BLOCK_NAMESPACE = 'rate_block'
+
+
+class RateLimited(Exception):
+    """触发限流，retry_after 秒后才能再次发布"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, per_hour, burst):
+        self.rate = per_hour / 3600
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """有令牌就取走并返回 0，否则返回还需等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            if self.rate <= 0:
+                return float('inf')
+            return (1 - self.tokens) / self.rate
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _bucket(platform, key):
+    limit = RATE_LIMITS.get(platform)
+    if not limit:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get((platform, key))
+        if bucket is None:
+            bucket = TokenBucket(*limit)
+            _buckets[(platform, key)] = bucket
+        return bucket
+
+
+def _blocked_for(platform, key):
+    try:
+        until = cache_store.get_value(BLOCK_NAMESPACE, f'{platform}:{key}')
+    except Exception:
+        return 0
+    return max(0, until - time.time()) if until else 0
+
+
+def block_until(platform, key, until):
+    ttl = until - time.time()
+    if ttl > 0:
+        cache_store.set_value(BLOCK_NAMESPACE, f'{platform}:{key}', until, ttl)
+
+
+def observe(platform, key, headers, status=None):
+    """
+    根据响应头更新限流状态，返回封锁到的时间戳（未封锁返回 None）。
+    X 的响应头：x-rate-limit-remaining 剩余次数，x-rate-limit-reset 重置时间（epoch 秒）
+    """
+    headers = headers or {}
+    remaining = headers.get('x-rate-limit-remaining')
+    reset = headers.get('x-rate-limit-reset')
+    retry_after = headers.get('retry-after')
+    exhausted = remaining is not None and str(remaining).isdigit() and int(remaining) <= 0
+    if status != 429 and not exhausted:
+        return None
+
+    if reset and str(reset).isdigit():
+        until = float(reset)
+    elif retry_after and str(retry_after).isdigit():
+        until = time.time() + float(retry_after)
+    else:
+        until = time.time() + RATE_LIMIT_DEFAULT_BLOCK
+    block_until(platform, key, until)
+    return until
+
+
+def _next_wait(platform, key):
+    """0 表示已取得令牌，否则返回需要等待的秒数"""
+    blocked = _blocked_for(platform, key)
+    if blocked:
+        return blocked
+    bucket = _bucket(platform, key)
+    return bucket.reserve() if bucket else 0
+
+
+def _label(platform):
+    return 'X' if platform == 'twitter' else ('知乎' if platform == 'zhihu' else platform)
+
+
+def acquire(platform, key, cancel_event=None, max_wait=RATE_LIMIT_MAX_WAIT):
+    """
+    取得一次发布的令牌。等待不超过 max_wait 秒，否则抛出 RateLimited；
+    等待期间 cancel_event 被设置时返回 False。
+    """
+    waited = 0
+    while True:
+        wait = _next_wait(platform, key)
+        if wait <= 0:
+            return True
+        if waited + wait > max_wait:
+            raise RateLimited(f'{_label(platform)} 发布频率受限，约 {wait:.0f} 秒后可用', wait)
+        step = min(wait, RATE_LIMIT_POLL_INTERVAL * 5)
+        if cancel_event is not None:
+            if cancel_event.wait(step):
+                return False
+        else:
+            time.sleep(step)
+        waited += step
+
+
+async def acquire_async(platform, key, cancel_event=None, max_wait=RATE_LIMIT_MAX_WAIT):
+    """acquire 的协程版本"""
+    waited = 0
+    while True:
+        wait = _next_wait(platform, key)
+        if wait <= 0:
+            return True
+        if waited + wait > max_wait:
+            raise RateLimited(f'{_label(platform)} 发布频率受限，约 {wait:.0f} 秒后可用', wait)
+        step = min(wait, RATE_LIMIT_POLL_INTERVAL)
+        await asyncio.sleep(step)
+        waited += step
+        if cancel_event is not None and cancel_event.is_set():
+            return False
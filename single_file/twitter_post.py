@@ -19,6 +19,9 @@ IMAGE_PATHS = [
 ]
 # ===============================================
 
+# 复用连接，多张图片上传时不必每次重新握手
+_session = requests.Session()
+
 def _load_env():
     """加载环境变量"""
     env_path = Path(__file__).resolve().parent / '.env'
@@ -45,7 +48,7 @@ def _upload_media(image_path, creds):
     
     with open(image_path, 'rb') as f:
         files = {'media': f}
-        response = requests.post(url, auth=oauth, files=files, timeout=60)
+        response = _session.post(url, auth=oauth, files=files, timeout=60)
     
     if response.status_code >= 400:
         raise RuntimeError(f'媒体上传失败: {response.status_code} {response.text}')
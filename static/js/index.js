@@ -13,6 +13,7 @@
 
     let progressDrawer, progressList, progressResult, cancelPublishBtn, progressActions;
     let publishTimer = null;
+    let publishStream = null;
     let currentJobId = null;
     let autoCloseTimer = null;
     const CHAR_LIMIT = 140;
@@ -56,7 +57,7 @@
     function renderImages() {
         const previewArea = document.querySelector('.image-preview-area');
         imageGrid.innerHTML = images.map((img, index) => `
-            <div class="image-item" data-id="${img.id}" data-index="${index}" draggable="true">
+            <div class="image-item ${img.status === 'processing' ? 'processing' : ''} ${img.status === 'error' ? 'error' : ''}" data-id="${img.id}" data-index="${index}" draggable="true" title="${img.status === 'processing' ? '图片处理中...' : ''}">
                 <div class="drag-handle">
                     <span class="icon" style="width: 12px; height: 12px;">
                         <svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24"><path d="M0 0h24v24H0z" fill="none"/><path d="M11 18c0 1.1-.9 2-2 2s-2-.9-2-2 .9-2 2-2 2 .9 2 2zm-2-8c-1.1 0-2 .9-2 2s.9 2 2 2 2-.9 2-2-.9-2-2-2zm0-6c-1.1 0-2 .9-2 2s.9 2 2 2 2-.9 2-2-.9-2-2-2zm6 4c1.1 0 2-.9 2-2s-.9-2-2-2-2 .9-2 2 .9 2 2 2zm0 2c-1.1 0-2 .9-2 2s.9 2 2 2 2-.9 2-2-.9-2-2-2zm0 6c-1.1 0-2 .9-2 2s.9 2 2 2 2-.9 2-2-.9-2-2-2z" fill="currentColor"/></svg>
@@ -150,43 +151,116 @@
         }
     }
     
+    const CHUNK_RETRIES = 3;
+
+    // 分片上传：init -> 逐个 PUT 分片 -> finalize，断线后从服务端已收到的分片继续
+    async function uploadFileChunked(file) {
+        const init = await Common.fetchAPI('/api/upload/init', {
+            method: 'POST',
+            body: JSON.stringify({ filename: file.name, size: file.size })
+        });
+        if (!init.success) throw new Error(init.message || '上传初始化失败');
+
+        const { upload_id: uploadId, chunk_size: chunkSize, total_chunks: totalChunks } = init;
+        let received = new Set();
+
+        for (let attempt = 0; ; attempt++) {
+            try {
+                for (let index = 0; index < totalChunks; index++) {
+                    if (received.has(index)) continue;
+                    const chunk = file.slice(index * chunkSize, Math.min(file.size, (index + 1) * chunkSize));
+                    const response = await fetch(`/api/upload/${uploadId}/chunk/${index}`, {
+                        method: 'PUT',
+                        headers: { 'Content-Type': 'application/octet-stream' },
+                        body: chunk
+                    });
+                    const data = await response.json();
+                    if (!data.success) throw new Error(data.message || '分片上传失败');
+                    received.add(index);
+                }
+                break;
+            } catch (error) {
+                if (attempt >= CHUNK_RETRIES) throw error;
+                await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)));
+                const status = await Common.fetchAPI(`/api/upload/${uploadId}`).catch(() => null);
+                if (status && status.success) received = new Set(status.received);
+            }
+        }
+
+        const done = await Common.fetchAPI(`/api/upload/${uploadId}/finalize`, { method: 'POST' });
+        if (!done.success) throw new Error(done.message || '图片上传失败');
+        return done.image;
+    }
+
     fileInput.addEventListener('change', async (e) => {
         const files = Array.from(e.target.files || []);
         if (files.length === 0) return;
         fileInput.value = '';
 
-        const formData = new FormData();
-        files.forEach(file => formData.append('images', file));
-
-        try {
-            const response = await fetch('/api/upload', {
-                method: 'POST',
-                body: formData
-            });
-            const data = await response.json();
-            console.log('上传响应:', data);
-            
-            if (!data.success) {
-                const errorMsg = data.errors ? data.errors.join('\n') : (data.message || '图片上传失败');
-                Common.showToast(errorMsg, 'error');
-                return;
-            }
-            
-            images = images.concat(data.images || []);
-            console.log('当前图片列表:', images);
-            renderImages();
-            
-            if (data.errors && data.errors.length > 0) {
-                Common.showToast(data.errors.join('\n'), 'error');
+        const settled = await Promise.allSettled(files.map(uploadFileChunked));
+        const uploaded = [];
+        const errors = [];
+        settled.forEach((result, i) => {
+            if (result.status === 'fulfilled') {
+                uploaded.push(result.value);
             } else {
-                Common.showToast(`成功上传 ${data.images.length} 张图片`, 'success');
+                console.error('上传错误:', result.reason);
+                errors.push(result.reason.message || `${files[i].name}: 上传失败`);
             }
-        } catch (error) {
-            console.error('上传错误:', error);
-            Common.showToast('图片上传失败，请检查网络连接', 'error');
+        });
+        console.log('上传结果:', uploaded, errors);
+
+        if (uploaded.length === 0) {
+            Common.showToast(errors.join('\n') || '图片上传失败', 'error');
+            return;
+        }
+
+        // 内容相同的图片服务端只存一份，已在列表中的不重复添加
+        const existingIds = new Set(images.map(img => img.id));
+        images = images.concat(uploaded.filter(img => !existingIds.has(img.id)));
+        console.log('当前图片列表:', images);
+        renderImages();
+        watchImageProcessing();
+
+        if (errors.length > 0) {
+            Common.showToast(errors.join('\n'), 'error');
+        } else {
+            Common.showToast(`成功上传 ${uploaded.length} 张图片`, 'success');
         }
     });
     
+    // 图片在服务端后台缩放，轮询直到全部处理完成
+    let imageStatusTimer = null;
+
+    function watchImageProcessing() {
+        if (imageStatusTimer) return;
+        imageStatusTimer = setInterval(async () => {
+            const pending = images.filter(img => img.status === 'processing');
+            if (pending.length === 0) {
+                clearInterval(imageStatusTimer);
+                imageStatusTimer = null;
+                return;
+            }
+            try {
+                const ids = pending.map(img => img.id).join(',');
+                const data = await Common.fetchAPI(`/api/upload/status?ids=${encodeURIComponent(ids)}`);
+                if (!data.success) return;
+                let changed = false;
+                images.forEach(img => {
+                    // 服务端没有记录的图片（旧数据）视为已就绪
+                    const status = data.images[img.id] || 'ready';
+                    if (status !== img.status) {
+                        img.status = status;
+                        changed = true;
+                    }
+                });
+                if (changed) renderImages();
+            } catch (error) {
+                console.error('图片状态获取失败:', error);
+            }
+        }, 800);
+    }
+
     document.querySelectorAll('.platform-btn').forEach(btn => {
         btn.addEventListener('click', () => {
             btn.classList.toggle('active');
@@ -299,7 +373,7 @@
             // 显示取消按钮
             if (progressActions) progressActions.style.display = 'block';
 
-            publishTimer = setInterval(() => pollPublishStatus(currentJobId, content), 1000);
+            watchPublishStatus(currentJobId, content);
         } catch (error) {
             console.error('Error:', error);
             progressResult.textContent = '发布失败，请检查控制台';
@@ -308,6 +382,62 @@
         }
     });
 
+    // 优先用 SSE 接收进度，浏览器不支持或连接反复失败时退回轮询
+    function watchPublishStatus(jobId, originalContent) {
+        if (!window.EventSource) {
+            startPolling(jobId, originalContent);
+            return;
+        }
+
+        let failures = 0;
+        publishStream = new EventSource(`/api/publish/stream/${jobId}`);
+
+        publishStream.addEventListener('step', (e) => {
+            failures = 0;
+            appendProgress(JSON.parse(e.data));
+        });
+
+        publishStream.addEventListener('status', (e) => {
+            failures = 0;
+            const job = JSON.parse(e.data);
+            if (['done', 'error', 'cancelled'].includes(job.status)) {
+                closeStream();
+                handleJobFinished(job, originalContent);
+            } else {
+                showRetryWait(job);
+            }
+        });
+
+        publishStream.addEventListener('missing', (e) => {
+            closeStream();
+            const data = JSON.parse(e.data);
+            progressResult.textContent = data.message || '任务状态获取失败';
+            progressResult.classList.add('error');
+            stopPublishing();
+        });
+
+        publishStream.onerror = () => {
+            // EventSource 会带着 Last-Event-ID 自动重连，连续失败才改用轮询
+            failures++;
+            if (failures >= 3) {
+                closeStream();
+                startPolling(jobId, originalContent);
+            }
+        };
+    }
+
+    function closeStream() {
+        if (publishStream) {
+            publishStream.close();
+            publishStream = null;
+        }
+    }
+
+    function startPolling(jobId, originalContent) {
+        if (publishTimer) clearInterval(publishTimer);
+        publishTimer = setInterval(() => pollPublishStatus(jobId, originalContent), 1000);
+    }
+
     async function pollPublishStatus(jobId, originalContent) {
         try {
             const response = await fetch(`/api/publish/status/${jobId}`);
@@ -322,37 +452,10 @@
             const job = data.job;
             renderProgress(job.steps || []);
 
-            if (job.status === 'done') {
-                progressResult.textContent = job.message || '发布完成';
-                progressResult.classList.add(job.success ? 'success' : 'error');
-                if (progressActions) progressActions.style.display = 'none';
-                if (job.success) {
-                    contentInput.value = '';
-                    images = [];
-                    renderImages();
-                    updateCharCounter();
-                    autoCloseTimer = setTimeout(() => {
-                        progressDrawer.classList.remove('show');
-                    }, 3000);
-                } else if (originalContent) {
-                    contentInput.value = originalContent;
-                }
-                stopPublishing();
-                return;
-            }
-
-            if (job.status === 'error') {
-                progressResult.textContent = job.message || '发布失败';
-                progressResult.classList.add('error');
-                if (progressActions) progressActions.style.display = 'none';
-                stopPublishing();
-            }
-
-            if (job.status === 'cancelled') {
-                progressResult.textContent = job.message || '发布已取消';
-                progressResult.classList.add('error');
-                if (progressActions) progressActions.style.display = 'none';
-                stopPublishing();
+            if (['done', 'error', 'cancelled'].includes(job.status)) {
+                handleJobFinished(job, originalContent);
+            } else {
+                showRetryWait(job);
             }
         } catch (error) {
             console.error('Error:', error);
@@ -362,13 +465,59 @@
         }
     }
 
-    function renderProgress(steps) {
-        progressList.innerHTML = steps.map(step => `
+    // 有平台失败、等待自动重试时显示下次重试时间
+    function showRetryWait(job) {
+        if (job.status === 'retry_wait' && job.next_run_at) {
+            const at = new Date(job.next_run_at * 1000).toLocaleTimeString();
+            progressResult.textContent = `部分平台发布失败，将于 ${at} 自动重试（第 ${job.retry_count} 次）`;
+        } else if (job.status === 'running') {
+            progressResult.textContent = '';
+        }
+    }
+
+    function handleJobFinished(job, originalContent) {
+        if (progressActions) progressActions.style.display = 'none';
+
+        if (job.status === 'done') {
+            progressResult.textContent = job.message || '发布完成';
+            progressResult.classList.add(job.success ? 'success' : 'error');
+            if (job.success) {
+                contentInput.value = '';
+                images = [];
+                renderImages();
+                updateCharCounter();
+                autoCloseTimer = setTimeout(() => {
+                    progressDrawer.classList.remove('show');
+                }, 3000);
+            } else if (originalContent) {
+                contentInput.value = originalContent;
+            }
+        } else if (job.status === 'error') {
+            progressResult.textContent = job.message || '发布失败';
+            progressResult.classList.add('error');
+        } else if (job.status === 'cancelled') {
+            progressResult.textContent = job.message || '发布已取消';
+            progressResult.classList.add('error');
+        }
+        stopPublishing();
+    }
+
+    function progressItemHtml(step) {
+        return `
             <div class="progress-item">
                 <span class="progress-time">${Common.escapeHtml(step.time || '')}</span>
                 <span>${Common.escapeHtml(step.message || '')}</span>
             </div>
-        `).join('');
+        `;
+    }
+
+    function renderProgress(steps) {
+        progressList.innerHTML = steps.map(progressItemHtml).join('');
+        progressList.scrollTop = progressList.scrollHeight;
+    }
+
+    function appendProgress(step) {
+        progressList.insertAdjacentHTML('beforeend', progressItemHtml(step));
         progressList.scrollTop = progressList.scrollHeight;
     }
 
@@ -380,6 +529,7 @@
             clearInterval(publishTimer);
             publishTimer = null;
         }
+        closeStream();
         currentJobId = null;
         if (progressActions) progressActions.style.display = 'none';
     }
@@ -417,6 +567,7 @@
     const draftPanel = document.getElementById('draftPanel');
     const draftList = document.getElementById('draftList');
     const newDraftBtn = document.getElementById('newDraftBtn');
+    const refineAllDraftsBtn = document.getElementById('refineAllDraftsBtn');
     let autoSaveTimer = null;
 
     function getDrafts() {
@@ -448,6 +599,7 @@
         contentInput.value = draft.content || '';
         images = draft.images || [];
         renderImages();
+        watchImageProcessing();
         updateCharCounter();
         currentDraftId = draft.id;
         localStorage.setItem('echo_current_draft_id', currentDraftId);
@@ -524,6 +676,66 @@
         });
     }
 
+    // 为所有未加标签的草稿添加标签，每次请求最多 REFINE_BATCH_MAX_ITEMS 条
+    async function refineAllDrafts() {
+        saveCurrentDraft();
+        const pending = getDrafts().filter(d => (d.content || '').trim() && !/(^|\s)#\S+\s*$/.test(d.content));
+        if (pending.length === 0) {
+            Common.showToast('没有需要添加标签的草稿', 'info');
+            return;
+        }
+
+        const batchSize = window.REFINE_BATCH_MAX_ITEMS || 100;
+        const refined = new Map();
+        let failedMessage = null;
+        if (refineAllDraftsBtn) refineAllDraftsBtn.disabled = true;
+        try {
+            for (let start = 0; start < pending.length; start += batchSize) {
+                const chunk = pending.slice(start, start + batchSize);
+                const response = await fetch('/api/refine/batch', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ items: chunk.map(d => ({ id: d.id, content: d.content })) })
+                });
+                const data = await response.json();
+                if (!data.success) {
+                    failedMessage = data.message || '批量添加标签失败';
+                    break;
+                }
+                data.results.filter(r => r.success).forEach(r => refined.set(r.id, r.content));
+            }
+        } catch (error) {
+            failedMessage = '网络错误: ' + error.message;
+        } finally {
+            if (refineAllDraftsBtn) refineAllDraftsBtn.disabled = false;
+        }
+
+        // 前面已经成功的批次照常保存
+        if (refined.size > 0) {
+            const drafts = getDrafts();
+            drafts.forEach(d => {
+                if (refined.has(d.id)) {
+                    d.content = refined.get(d.id);
+                    d.updatedAt = new Date().toISOString();
+                }
+            });
+            saveDrafts(drafts);
+            if (currentDraftId && refined.has(currentDraftId)) {
+                contentInput.value = refined.get(currentDraftId);
+                updateCharCounter();
+            }
+            renderDraftList();
+        }
+        if (failedMessage) {
+            Common.showToast(refined.size > 0 ? `已为 ${refined.size} 篇草稿添加标签，其余失败: ${failedMessage}` : failedMessage, 'error');
+        } else {
+            Common.showToast(`已为 ${refined.size} 篇草稿添加标签`, 'success');
+        }
+    }
+
+    window.refineAllDrafts = refineAllDrafts;
+    if (refineAllDraftsBtn) refineAllDraftsBtn.addEventListener('click', refineAllDrafts);
+
     // 自动保存
     contentInput.addEventListener('input', () => {
         if (autoSaveTimer) clearTimeout(autoSaveTimer);
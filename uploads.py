@@ -0,0 +1,458 @@
+"""
+上传图片的存储与后台处理。
+
+图片按内容 SHA-256 命名存储，相同内容只保存、处理一次；
+文件保存后立即返回，缩放等 CPU 密集的工作交给进程池并行处理；
+处理状态写在 uploaded_image 表里，发布任务只等待自己用到的图片。
+"""
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, PostImage, PublishJob, UploadedImage
+from services.image_service import VARIANT_DIR, file_hash, process_upload
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
+# 分片上传的临时目录：每个上传一个子目录，包含 meta.json、data.part 和已收到分片的标记
+CHUNK_DIR = os.path.join(UPLOAD_DIR, '.chunks')
+
+# 进程池大小，0 表示使用 CPU 核数
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '0')) or None
+IMAGE_MAX_SIZE = 2048
+# 发布时等待图片处理完成的最长时间（秒）
+IMAGE_READY_TIMEOUT = float(os.getenv('IMAGE_READY_TIMEOUT', '60'))
+# 没有被任何历史记录引用的图片保留多久（秒），草稿里的图片在此期间不会被删
+UPLOAD_ORPHAN_MAX_AGE = int(os.getenv('UPLOAD_ORPHAN_MAX_AGE', str(7 * 24 * 3600)))
+UPLOAD_CLEANUP_INTERVAL = int(os.getenv('UPLOAD_CLEANUP_INTERVAL', '3600'))
+# 历史记录被删除后，不再被引用的图片再保留多久（秒）
+UPLOAD_RELEASED_MAX_AGE = int(os.getenv('UPLOAD_RELEASED_MAX_AGE', '600'))
+UPLOAD_CLEANUP_BATCH = 500
+MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+# 未完成的分片上传保留多久（秒）
+CHUNK_SESSION_MAX_AGE = 24 * 3600
+_UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+_app = None
+_executor = None
+_executor_lock = threading.Lock()
+# 本进程提交到进程池、还没处理完的图片：image_id -> future
+_futures = {}
+_futures_lock = threading.Lock()
+# 本进程中有图片处理完成时通知等待者
+_ready = threading.Condition()
+
+
+def init_app(app):
+    global _app
+    _app = app
+
+
+def _get_executor(reset=False):
+    global _executor
+    with _executor_lock:
+        if reset and _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+        if _executor is None:
+            # 统一使用 spawn：Windows 上本来就是 spawn，Linux 上避免在多线程进程里 fork
+            _executor = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+def _set_status(image_id, status, error=None):
+    with _app.app_context():
+        db.session.execute(
+            update(UploadedImage).where(UploadedImage.id == image_id)
+            .values(status=status, error=error)
+        )
+        db.session.commit()
+    with _ready:
+        _ready.notify_all()
+
+
+def submit(image_id, abs_path):
+    """把一张已保存的图片交给进程池处理"""
+    try:
+        future = _get_executor().submit(process_upload, abs_path, IMAGE_MAX_SIZE)
+    except BrokenProcessPool:
+        # 子进程意外退出后进程池不可再用，重建一次
+        future = _get_executor(reset=True).submit(process_upload, abs_path, IMAGE_MAX_SIZE)
+
+    def on_done(f):
+        try:
+            f.result()
+            _set_status(image_id, 'ready')
+        except Exception as e:
+            traceback.print_exc()
+            _set_status(image_id, 'error', str(e))
+        finally:
+            with _futures_lock:
+                if _futures.get(image_id) is f:
+                    del _futures[image_id]
+
+    with _futures_lock:
+        _futures[image_id] = future
+    future.add_done_callback(on_done)
+    return future
+
+
+def _in_progress(image_id):
+    with _futures_lock:
+        return image_id in _futures
+
+
+def recover_processing():
+    """
+    上次退出（重启或崩溃）时还在处理的图片，进程池里的任务已经丢了，状态会一直停在 processing：
+    文件还在的重新处理，文件不在的标记为 error。返回重新提交的数量
+    """
+    with _app.app_context():
+        rows = db.session.execute(
+            select(UploadedImage.id, UploadedImage.path).where(UploadedImage.status == 'processing')
+        ).all()
+    resubmitted = 0
+    for image_id, path in rows:
+        if _in_progress(image_id):
+            continue
+        abs_path = os.path.join(_app.root_path, path)
+        if os.path.exists(abs_path):
+            submit(image_id, abs_path)
+            resubmitted += 1
+        else:
+            _set_status(image_id, 'error', '图片文件不存在')
+    if rows:
+        print(f"重新处理 {resubmitted} 张上次未处理完的图片")
+    return resubmitted
+
+
+def get_statuses(image_ids):
+    rows = db.session.execute(
+        select(UploadedImage.id, UploadedImage.status).where(UploadedImage.id.in_(image_ids))
+    ).all()
+    return {image_id: status for image_id, status in rows}
+
+
+def _normalize(path):
+    return path.replace('\\', '/').lstrip('/')
+
+
+def wait_until_ready(image_paths, timeout=IMAGE_READY_TIMEOUT):
+    """等待给定图片处理完成，返回超时后仍在处理中的路径"""
+    paths = [_normalize(p) for p in image_paths or [] if p]
+    if not paths:
+        return []
+
+    deadline = time.time() + timeout
+    while True:
+        with _app.app_context():
+            pending = db.session.execute(
+                select(UploadedImage.path).where(
+                    UploadedImage.path.in_(paths),
+                    UploadedImage.status == 'processing'
+                )
+            ).scalars().all()
+        remaining = deadline - time.time()
+        if not pending or remaining <= 0:
+            return pending
+        # 其他进程处理的图片没有通知，最多 0.5 秒重新查一次
+        with _ready:
+            _ready.wait(min(0.5, remaining))
+
+
+def ingest_file(tmp_path, content_hash, ext):
+    """
+    把一个已经算好哈希的临时文件放入上传目录。
+    同样的内容已经存在时直接删除临时文件并返回已有记录，跳过保存和缩放；
+    已有记录的保留期从这次上传重新计算，草稿还在用它时不会被后台清理删掉。
+    返回 (UploadedImage, 是否新文件)
+    """
+    existing = db.session.get(UploadedImage, content_hash)
+    if existing:
+        existing.created_at = time.time()
+        existing.released_at = None
+    if existing and os.path.exists(os.path.join(_app.root_path, existing.path)):
+        os.remove(tmp_path)
+        db.session.commit()
+        if existing.status == 'processing' and not _in_progress(existing.id):
+            # 处理它的进程已经退出，本进程没有对应的任务，重新处理
+            submit(existing.id, os.path.join(_app.root_path, existing.path))
+        return existing, False
+
+    filename = f'{content_hash}.{ext}'
+    save_path = os.path.join(UPLOAD_DIR, filename)
+    if os.path.exists(save_path):
+        # 另一个请求刚保存了同样的内容，不能覆盖它可能已缩放过的文件
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, save_path)
+
+    if existing:
+        # 记录还在但文件被删了，重新处理
+        existing.status = 'processing'
+        existing.path = f'static/uploads/{filename}'
+        image = existing
+    else:
+        image = UploadedImage(id=content_hash, path=f'static/uploads/{filename}', status='processing')
+        db.session.add(image)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return db.session.get(UploadedImage, content_hash), False
+
+    submit(image.id, save_path)
+    return image, True
+
+
+def store_upload(stream, ext):
+    """边读边写入临时文件并计算 SHA-256，不把整个文件读进内存"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_DIR, f'.{uuid.uuid4().hex}.part')
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as out:
+            for block in iter(lambda: stream.read(1024 * 1024), b''):
+                digest.update(block)
+                out.write(block)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return ingest_file(tmp_path, digest.hexdigest(), ext)
+
+
+def change_refs(image_paths, delta):
+    """
+    调整图片的引用计数（不提交，和调用方的历史记录改动放在同一个事务里）。
+    image_paths 可以是 URL（/static/...）或相对路径。减少引用时记下时间，供后台清理使用
+    """
+    counts = Counter(_normalize(p) for p in image_paths or [] if p)
+    for path, n in counts.items():
+        db.session.execute(
+            update(UploadedImage).where(UploadedImage.path == path)
+            .values(ref_count=UploadedImage.ref_count + delta * n,
+                    released_at=time.time() if delta < 0 else None)
+        )
+
+
+def _still_referenced(path):
+    """引用计数之外的兜底检查：历史记录或未结束的任务里是否还在使用"""
+    url = '/' + path
+    in_history = db.session.execute(
+        select(PostImage.id).where(PostImage.path == url).limit(1)
+    ).first()
+    if in_history:
+        return True
+    in_job = db.session.execute(
+        select(PublishJob.id).where(
+            PublishJob.status.in_(('queued', 'running', 'retry_wait')),
+            PublishJob.image_paths.contains(path)
+        ).limit(1)
+    ).first()
+    return bool(in_job)
+
+
+def cleanup_orphans():
+    """
+    删除没有被引用且超过保留期的图片及其各平台版本，返回删除的数量。
+    从未被引用的（草稿里的）图片保留 UPLOAD_ORPHAN_MAX_AGE，历史被删除后释放的保留 UPLOAD_RELEASED_MAX_AGE
+    """
+    now = time.time()
+    removed = 0
+    with _app.app_context():
+        candidates = UploadedImage.query.filter(
+            UploadedImage.ref_count <= 0,
+            or_(UploadedImage.created_at < now - UPLOAD_ORPHAN_MAX_AGE,
+                UploadedImage.released_at < now - UPLOAD_RELEASED_MAX_AGE),
+            UploadedImage.status != 'processing'
+        ).limit(UPLOAD_CLEANUP_BATCH).all()
+        for image in candidates:
+            if _still_referenced(image.path):
+                continue
+            abs_path = os.path.join(_app.root_path, image.path)
+            if os.path.exists(abs_path):
+                try:
+                    content_hash = file_hash(abs_path)
+                    for variant in glob.glob(os.path.join(str(VARIANT_DIR), f'{content_hash}_*')):
+                        os.remove(variant)
+                    os.remove(abs_path)
+                except OSError as e:
+                    print(f"清理图片失败 {image.path}: {e}")
+                    continue
+            db.session.delete(image)
+            removed += 1
+        db.session.commit()
+    if removed:
+        print(f"已清理 {removed} 张未被引用的图片")
+    return removed
+
+
+def _session_dir(upload_id):
+    if not _UPLOAD_ID_RE.match(upload_id or ''):
+        raise ValueError('上传任务不存在')
+    path = os.path.join(CHUNK_DIR, upload_id)
+    if not os.path.isdir(path):
+        raise ValueError('上传任务不存在或已过期')
+    return path
+
+
+def _load_meta(session_dir):
+    with open(os.path.join(session_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _received_chunks(session_dir):
+    return sorted(int(name) for name in os.listdir(os.path.join(session_dir, 'received')))
+
+
+def init_chunked(ext, size):
+    """创建一个分片上传任务，大小在这里就先检查，不必等文件传完"""
+    if size <= 0:
+        raise ValueError('文件为空')
+    if size > MAX_FILE_SIZE:
+        raise ValueError('文件大小超过20MB限制')
+
+    upload_id = uuid.uuid4().hex
+    session_dir = os.path.join(CHUNK_DIR, upload_id)
+    os.makedirs(os.path.join(session_dir, 'received'))
+    meta = {
+        'ext': ext,
+        'size': size,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'total_chunks': (size + UPLOAD_CHUNK_SIZE - 1) // UPLOAD_CHUNK_SIZE,
+        'created_at': time.time()
+    }
+    with open(os.path.join(session_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    # 预先建好目标文件，分片按偏移直接写入
+    with open(os.path.join(session_dir, 'data.part'), 'wb') as f:
+        f.truncate(size)
+    return {'upload_id': upload_id, 'chunk_size': meta['chunk_size'], 'total_chunks': meta['total_chunks']}
+
+
+def write_chunk(upload_id, index, stream, content_length):
+    """把一个分片边读边写到 data.part 的对应位置；同一分片可以重复上传"""
+    session_dir = _session_dir(upload_id)
+    meta = _load_meta(session_dir)
+    if index < 0 or index >= meta['total_chunks']:
+        raise ValueError('分片序号无效')
+    offset = index * meta['chunk_size']
+    expected = min(meta['chunk_size'], meta['size'] - offset)
+    if content_length is not None and content_length != expected:
+        raise ValueError(f'分片大小不正确，应为 {expected} 字节')
+
+    # 重传分片时先撤销标记，写入失败也不会被当成已收到
+    marker = os.path.join(session_dir, 'received', str(index))
+    if os.path.exists(marker):
+        os.remove(marker)
+
+    written = 0
+    with open(os.path.join(session_dir, 'data.part'), 'r+b') as f:
+        f.seek(offset)
+        while written < expected:
+            block = stream.read(min(64 * 1024, expected - written))
+            if not block:
+                break
+            f.write(block)
+            written += len(block)
+    if written != expected or stream.read(1):
+        raise ValueError(f'分片大小不正确，应为 {expected} 字节')
+
+    # 标记文件写在数据之后，存在即表示分片完整
+    open(marker, 'wb').close()
+    return {'received': len(_received_chunks(session_dir)), 'total_chunks': meta['total_chunks']}
+
+
+def chunked_status(upload_id):
+    """返回已收到的分片，客户端断线后据此续传"""
+    session_dir = _session_dir(upload_id)
+    meta = _load_meta(session_dir)
+    return {
+        'received': _received_chunks(session_dir),
+        'chunk_size': meta['chunk_size'],
+        'total_chunks': meta['total_chunks']
+    }
+
+
+def finalize_chunked(upload_id):
+    """所有分片到齐后计算哈希并入库，随即开始后台缩放"""
+    session_dir = _session_dir(upload_id)
+    meta = _load_meta(session_dir)
+    received = _received_chunks(session_dir)
+    if len(received) != meta['total_chunks']:
+        missing = sorted(set(range(meta['total_chunks'])) - set(received))
+        raise ValueError(f'还有 {len(missing)} 个分片未上传')
+
+    data_path = os.path.join(session_dir, 'data.part')
+    digest = hashlib.sha256()
+    with open(data_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    try:
+        return ingest_file(data_path, digest.hexdigest(), meta['ext'])
+    finally:
+        shutil.rmtree(session_dir, ignore_errors=True)
+
+
+def cleanup_stale_chunks():
+    if not os.path.isdir(CHUNK_DIR):
+        return
+    cutoff = time.time() - CHUNK_SESSION_MAX_AGE
+    for name in os.listdir(CHUNK_DIR):
+        path = os.path.join(CHUNK_DIR, name)
+        if not os.path.isdir(path):
+            continue
+        # 收到新分片时只有 received 目录的修改时间会变
+        received_dir = os.path.join(path, 'received')
+        mtime = max(os.path.getmtime(path), os.path.getmtime(received_dir) if os.path.isdir(received_dir) else 0)
+        if mtime < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+_cleanup_requested = threading.Event()
+
+
+def request_cleanup():
+    """删除历史记录后调用：提前唤醒后台清理（释放后的图片仍要等满 UPLOAD_RELEASED_MAX_AGE）"""
+    _cleanup_requested.set()
+
+
+def _maintenance_loop():
+    try:
+        recover_processing()
+    except Exception:
+        traceback.print_exc()
+    while True:
+        try:
+            # 每轮最多处理 UPLOAD_CLEANUP_BATCH 张，删满一批说明可能还有，继续下一批
+            while cleanup_orphans() >= UPLOAD_CLEANUP_BATCH:
+                pass
+            cleanup_stale_chunks()
+        except Exception:
+            traceback.print_exc()
+        if _cleanup_requested.wait(UPLOAD_CLEANUP_INTERVAL):
+            _cleanup_requested.clear()
+            # 等释放的图片过了保留期再清理
+            time.sleep(UPLOAD_RELEASED_MAX_AGE)
+
+
+def start_maintenance():
+    threading.Thread(target=_maintenance_loop, name='upload-cleanup', daemon=True).start()